@@ -0,0 +1,182 @@
+"""
+Benchmark harness timing the hot paths of the analysis code on synthetic data.
+
+Usage (from the lephare_scripts directory):
+    python -m benchmarks.run_benchmarks --sizes 10000 100000 1000000
+
+For each catalogue size, the synthetic files are generated in a temporary LEPHARE
+directory and each benchmark is timed (best of --repeat runs).
+The results are appended to a JSON lines file together with the current git commit,
+and compared to the latest results of a previous commit to spot regressions.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks import synthetic_data as sd
+
+SCRIPTPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RESULTS = os.path.join(SCRIPTPATH, "benchmarks", "results.jsonl")
+# Slowdown factor above which a benchmark is reported as a regression
+REGRESSION_THRESHOLD = 1.2
+
+
+def read_args():
+    """Reads out the arguments given by the user."""
+    parser = argparse.ArgumentParser(
+        description="Time the hot paths of the analysis code on synthetic data.")
+    parser.add_argument("-s", "--sizes", type=int, nargs="+", default=[10000, 100000],
+                        help="Catalogue sizes (number of rows) to benchmark.")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="Number of repetitions per benchmark (the best one is kept).")
+    parser.add_argument("-b", "--benchmarks", type=str, nargs="+", default=None,
+                        help="Only run the benchmarks with the given names.")
+    parser.add_argument("-o", "--output", type=str, default=DEFAULT_RESULTS,
+                        help="JSON lines file the results are appended to.")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+def give_git_commit():
+    """Returns the short hash of the current commit (with a marker for local changes)."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPTPATH,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               cwd=SCRIPTPATH, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty.strip() else "")
+
+
+def time_function(func, repeat):
+    """Returns the best wall time of repeat calls to func."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def give_benchmarks(files):
+    """Returns a dictionary with the benchmark names as keys and functions (without
+    arguments) as values, running on the given synthetic files.
+    The analysis modules can only be imported after the environment has been set up."""
+    from argparse import Namespace
+
+    import astropy.units as u
+    import numpy as np
+    from astropy.coordinates import SkyCoord
+    from astropy.table import Table
+
+    import output_scripts.spec_helper as sh
+    import output_scripts.template_analysis_plots as ta
+    import util.chunked_stats as c_s
+    import util.my_tools as mt
+    import util.photoz_fitter as p_f
+    from util.quantile_sketch import KLLSketch
+
+    out_df = mt.read_fits_as_dataframe(files["out_fits_pointlike"])
+    out_df["Type"] = "pointlike"
+    prepared_df = mt.add_filter_columns(out_df.copy())
+    temp_df = mt.read_template_library()
+    sweep, vhs = Table.read(files["sweep"]), Table.read(files["vhs"])
+    grid = p_f.TemplateGrid(temp_df[temp_df["Type"] == "pointlike"])
+    rng = np.random.default_rng(0)
+    fit_fluxes = grid.fluxes[rng.integers(len(grid), size=p_f.BLOCK_SIZE)]
+    fit_errors = 0.1 * fit_fluxes + 1e-31
+    fit_fluxes = fit_fluxes + rng.normal(0, 1, fit_fluxes.shape) * fit_errors
+    spec_args = Namespace(ytype=sh.YAxisUnit.mag, context=-1, allowed_filters=-1)
+
+    def parse_spectrum():
+        sh.Spectrum(files["spec"], spec_args, plot=False)
+
+    def crossmatch():
+        parent = SkyCoord(sweep["RA"], sweep["DEC"], unit=u.deg)
+        other = SkyCoord(vhs["RA"], vhs["DEC"], unit=u.deg)
+        _, sep, _ = other.match_to_catalog_sky(parent)
+        return sep < 1 * u.arcsec
+
+    return {
+        "read_ascii_as_df": lambda: mt.read_ascii_as_df(files["out_ascii_pointlike"]),
+        "read_fits_as_dataframe": lambda: mt.read_fits_as_dataframe(files["out_fits_pointlike"]),
+        "add_filter_columns": lambda: mt.add_filter_columns(out_df.copy()),
+        "give_output_statistics": lambda: mt.give_output_statistics(prepared_df),
+        "give_count_df": lambda: ta.give_count_df(prepared_df, "pointlike"),
+        "chunked_output_aggregates": lambda: [
+            aggregate.update(prepared_df) for aggregate in
+            (c_s.OutputStatistics(), c_s.TemplateCounts())],
+        "kll_sketch": lambda: KLLSketch().update(abs(prepared_df["ZMeasure"])),
+        "fit_block": lambda: p_f.fit_block(grid, fit_fluxes, fit_errors, fit_fluxes > 0),
+        "read_template_library": mt.read_template_library,
+        "construct_template_dict": lambda: mt.construct_template_dict(temp_df),
+        "spectrum_parsing": parse_spectrum,
+        "crossmatch": crossmatch,
+    }
+
+
+def read_previous_results(fpath, commit):
+    """Returns the latest result of any other commit for each (benchmark, size) pair."""
+    previous = {}
+    if not os.path.isfile(fpath):
+        return previous
+    with open(fpath, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["commit"] != commit:
+                previous[(record["benchmark"], record["size"])] = record
+    return previous
+
+
+def compare_results(results, previous):
+    """Prints a comparison of the results to the previous ones, flagging regressions."""
+    regressions = 0
+    print(f"{'benchmark':<26}{'size':>10}{'time [s]':>12}{'previous':>12}{'ratio':>8}")
+    for record in results:
+        old = previous.get((record["benchmark"], record["size"]))
+        line = f"{record['benchmark']:<26}{record['size']:>10}{record['seconds']:>12.4f}"
+        if old is not None:
+            ratio = record["seconds"] / old["seconds"]
+            line += f"{old['seconds']:>12.4f}{ratio:>8.2f}"
+            if ratio > REGRESSION_THRESHOLD:
+                line += f"  <-- regression (vs. {old['commit']})"
+                regressions += 1
+        print(line)
+    return regressions
+
+
+def run_benchmarks(args):
+    """Generates the data for each size, runs the benchmarks and stores the results."""
+    commit = give_git_commit()
+    date = datetime.now().isoformat(timespec="seconds")
+    results = []
+    with tempfile.TemporaryDirectory(prefix="lephare_bench_") as root:
+        paths = sd.setup_lephare_environment(root)
+        sys.path.insert(0, SCRIPTPATH)
+        for size in args.sizes:
+            start = time.perf_counter()
+            files = sd.generate_dataset(paths, size, args.seed)
+            print(f"Generated the synthetic data for {size} rows in "
+                  f"{time.perf_counter() - start:.1f} s.")
+            for name, func in give_benchmarks(files).items():
+                if args.benchmarks is not None and name not in args.benchmarks:
+                    continue
+                seconds = time_function(func, args.repeat)
+                results.append({"commit": commit, "date": date, "benchmark": name,
+                                "size": size, "seconds": seconds})
+    previous = read_previous_results(args.output, commit)
+    regressions = compare_results(results, previous)
+    with open(args.output, "a", encoding="utf-8") as f:
+        for record in results:
+            f.write(json.dumps(record) + "\n")
+    return regressions
+
+
+if __name__ == "__main__":
+    sys.exit(1 if run_benchmarks(read_args()) > 0 else 0)
@@ -0,0 +1,267 @@
+"""
+Generator for synthetic catalogues and LePhare files used by the benchmarks.
+
+The files mimic the layout of the real ones (sweep/VHS/GALEX/HSC-like input tables,
+LePhare .out and .fits outputs, _mag_lib.dat template libraries and .spec files)
+so the analysis code can be run on them without any real survey data.
+As util.my_tools reads its config on import, setup_lephare_environment needs to be
+called before importing it.
+"""
+import os
+from configparser import ConfigParser
+
+import numpy as np
+import pandas as pd
+from astropy.table import Table
+
+# These need to be synced with startup.py
+BAND_DICT = {
+    "galex": ["FUV", "NUV"],
+    "sweep": ["g", "r", "z", "W1", "W2", "W3", "W4"],
+    "vhs": ["Y", "J", "H", "Ks"],
+    "hsc": ["i_hsc", "i2_hsc"],
+    "kids": ["i_kids"],
+    "ls10": ["i_ls10"],
+}
+BAND_LIST = BAND_DICT["galex"] + BAND_DICT["sweep"][:3] + BAND_DICT["vhs"] + \
+    BAND_DICT["sweep"][3:] + BAND_DICT["hsc"] + BAND_DICT["kids"] + BAND_DICT["ls10"]
+# Rough fractions of sources with photometry in each of the surveys
+AVAILABILITY = {"galex": 0.3, "sweep": 0.95, "vhs": 0.6,
+                "hsc": 0.2, "kids": 0.15, "ls10": 0.9}
+STEM = "bench"
+TTYPES = ("pointlike", "extended")
+# Columns of the LePhare output preceding the magnitudes (see baseline_out.para)
+OUT_COLUMNS = ["IDENT", "Z_BEST", "Z_ML", "CHI_BEST", "MOD_BEST", "EXTLAW_BEST", "EBV_BEST",
+               "PDZ_BEST", "SCALE_BEST", "NBAND_USED", "Z_SEC", "CHI_SEC", "MOD_SEC",
+               "CONTEXT", "ZSPEC"]
+# Field the synthetic sources are scattered in (roughly eFEDS)
+RA_RANGE, DEC_RANGE = (126., 146.), (-3., 6.)
+
+
+def setup_lephare_environment(root):
+    """Creates the directory structure and config files expected by util.my_tools
+    in the given root directory and points the LEPHARE environment variable to it.
+    returns:
+        Dictionary with the most important paths."""
+    root = os.path.abspath(root) + "/"
+    paths = {"data": root + "data/", "match": root + "data/matches/",
+             "scripts": root + "lephare_scripts/", "plot": root + "plots/",
+             "other": root + "other/", "cat": root + "cats/",
+             "params": root + "lephare_scripts/lephare_parameters/",
+             "config": root + "lephare_scripts/config/",
+             "lepharedir": root + "lephare_dir/", "lepharework": root + "lephare_work/",
+             "jystilts": root + "other/programs/jystilts.jar",
+             "current_config": "bench_config.ini"}
+    for subdir in ["lephare_output/", "lephare_input/", "matches/", "lephare_files/templates/"]:
+        os.makedirs(paths["data"] + subdir, exist_ok=True)
+    for key in ["plot", "cat", "config"]:
+        os.makedirs(paths[key], exist_ok=True)
+    os.makedirs(paths["params"] + "template_lists/", exist_ok=True)
+    config = ConfigParser()
+    config["PATHS"] = paths
+    config["BAND_DICT"] = {survey: str(bands) for survey, bands in BAND_DICT.items()}
+    config["BANDS"] = {"listed": str(BAND_LIST)}
+    with open(paths["config"] + "general.ini", "w", encoding="utf8") as f:
+        config.write(f)
+    config = ConfigParser()
+    config["GENERAL"] = {"logging_level": 30, "use_pointlike": True, "use_extended": True,
+                         "print_commands_only": True, "ask_overwrite": False,
+                         "overwrite_policy": "overwrite"}
+    config["CAT_ASSEMBLY"] = {"assemble_cat": False, "cat_stem": STEM}
+    config["LEPHARE"] = {"para_stem": STEM, "filter_stem": STEM, "template_stem": STEM,
+                         "forbidden_bands": "['i_hsc', 'i2_hsc', 'i_kids', 'i_ls10']",
+                         "input_stem": STEM, "output_stem": STEM,
+                         "run_filters": False, "run_templates": False, "run_zphota": False}
+    config["PLOTTING"] = {"rasterize": True, "num_processes": 1}
+    with open(paths["config"] + paths["current_config"], "w", encoding="utf8") as f:
+        config.write(f)
+    os.environ["LEPHARE"] = root[:-1]
+    return paths
+
+
+def give_random_positions(num, rng):
+    """Returns ra and dec uniformly distributed on the sphere within the field."""
+    ra = rng.uniform(*RA_RANGE, num)
+    sin_dec = rng.uniform(*np.sin(np.radians(DEC_RANGE)), num)
+    return ra, np.degrees(np.arcsin(sin_dec))
+
+
+def give_random_mags(num, rng, availability=1., mean=21.5):
+    """Returns magnitudes following a rising number count distribution, with
+    the non-available entries set to -99."""
+    mags = mean + 2.5 * np.log10(rng.uniform(0.01, 1, num)) + rng.normal(0, 0.5, num)
+    mags[rng.uniform(size=num) > availability] = -99.
+    return mags
+
+
+def give_random_redshifts(num, rng):
+    """Returns spectroscopic redshifts for roughly a third of the sources (-99. otherwise)."""
+    zspec = rng.gamma(2, 0.4, num)
+    zspec[rng.uniform(size=num) > 0.3] = -99.
+    return zspec
+
+
+def make_sweep_table(num, rng):
+    """Produces a table resembling a LS sweep file."""
+    ra, dec = give_random_positions(num, rng)
+    table = Table({"RELEASE": np.full(num, 10000, dtype=np.int16),
+                   "BRICKID": rng.integers(0, 600000, num, dtype=np.int32),
+                   "OBJID": np.arange(num, dtype=np.int32) % 100000,
+                   "RA": ra, "DEC": dec,
+                   "TYPE": rng.choice(np.array(["PSF", "REX", "EXP", "DEV", "SER"]), num)})
+    for band in BAND_DICT["sweep"]:
+        flux = 10**(-0.4 * (give_random_mags(num, rng) - 22.5))
+        table["FLUX_" + band.upper()] = flux.astype(np.float32)
+        table["FLUX_IVAR_" + band.upper()] = (1 / (0.05 * flux)**2).astype(np.float32)
+    table["SPECZ"] = give_random_redshifts(num, rng).astype(np.float32)
+    return table
+
+
+def make_matched_survey_table(parent, survey, rng, sigma_arcsec=0.3):
+    """Produces a table of a survey with counterparts to a fraction of the parent
+    sources (with gaussian positional offsets and a small systematic shift)."""
+    num = len(parent)
+    matched = rng.uniform(size=num) < AVAILABILITY[survey]
+    num_matched = matched.sum()
+    offsets = rng.normal(0.1, sigma_arcsec, (2, num_matched)) / 3600
+    dec = parent["DEC"][matched] + offsets[1]
+    ra = parent["RA"][matched] + offsets[0] / np.cos(np.radians(dec))
+    table = Table({"ID": np.arange(num_matched, dtype=np.int64), "RA": ra, "DEC": dec})
+    for band in BAND_DICT[survey]:
+        mags = give_random_mags(num_matched, rng, 0.95)
+        table[band.upper() + "_MAG"] = mags.astype(np.float32)
+        table[band.upper() + "_MAG_ERR"] = np.where(
+            mags > 0, rng.uniform(0.01, 0.2, num_matched), -99.).astype(np.float32)
+    return table
+
+
+def make_output_frame(num, rng, start_ident=0):
+    """Produces a DataFrame resembling a LePhare output catalogue with
+    magnitudes for all bands in BAND_LIST."""
+    zspec = give_random_redshifts(num, rng)
+    zbest = np.where(zspec > 0, zspec, rng.gamma(2, 0.4, num))
+    zbest = zbest + rng.normal(0, 0.05, num) * (1 + zbest)
+    # Some catastrophic outliers:
+    outliers = rng.uniform(size=num) < 0.1
+    zbest[outliers] = rng.uniform(0, 4, outliers.sum())
+    zbest = np.clip(zbest, 0.01, 6)
+    data = {"IDENT": np.arange(start_ident, start_ident + num),
+            "Z_BEST": zbest, "Z_ML": zbest + rng.normal(0, 0.02, num),
+            "CHI_BEST": rng.chisquare(8, num), "MOD_BEST": rng.integers(1, 40, num),
+            "EXTLAW_BEST": rng.integers(0, 3, num), "EBV_BEST": rng.choice([0., 0.1, 0.2], num),
+            "PDZ_BEST": rng.uniform(50, 100, num), "SCALE_BEST": rng.lognormal(0, 1, num),
+            "NBAND_USED": rng.integers(3, 14, num), "Z_SEC": rng.uniform(0, 4, num),
+            "CHI_SEC": rng.chisquare(12, num), "MOD_SEC": rng.integers(1, 40, num),
+            "CONTEXT": np.full(num, -1), "ZSPEC": zspec}
+    for survey, bands in BAND_DICT.items():
+        for band in bands:
+            data["mag_" + band] = give_random_mags(num, rng, AVAILABILITY[survey])
+    for survey, bands in BAND_DICT.items():
+        for band in bands:
+            mags = data["mag_" + band]
+            data["mag_err_" + band] = np.where(mags > 0, rng.uniform(0.01, 0.3, num), -99.)
+    # Keep the band order of the LePhare output
+    columns = OUT_COLUMNS + [f"mag_{band}" for band in BAND_LIST] + \
+        [f"mag_err_{band}" for band in BAND_LIST]
+    return pd.DataFrame(data)[columns]
+
+
+def write_output_ascii(fpath, num, rng, chunksize=1000000):
+    """Writes a LePhare-like .out file with num rows in chunks to limit memory usage."""
+    mag_cols = [f"MAG_OBS{i}" for i in range(len(BAND_LIST))] + \
+        [f"ERR_MAG_OBS{i}" for i in range(len(BAND_LIST))]
+    with open(fpath, "w", encoding="utf-8") as f:
+        f.write("#######################################\n")
+        f.write("# Synthetic LePhare output for benchmarking\n")
+        f.write("# Format topcat: \n")
+        f.write("# " + " ".join(OUT_COLUMNS + mag_cols) + "\n")
+        for start in range(0, num, chunksize):
+            df = make_output_frame(min(chunksize, num - start), rng, start)
+            df.to_csv(f, sep=" ", header=False, index=False, float_format="%.5g")
+
+
+def write_output_fits(fpath, num, rng):
+    """Writes a LePhare-like output .fits file (as rewritten by rewrite_fits_header)."""
+    Table.from_pandas(make_output_frame(num, rng)).write(fpath, overwrite=True)
+
+
+def write_template_library(fpath, num_models, rng, ebvs=(0., 0.1, 0.2), zstep=0.02, zmax=6.):
+    """Writes a LePhare-like _mag_lib.dat file with magnitudes and k-corrections
+    for num_models templates at each of the given E(B-V) values on a redshift grid."""
+    redshifts = np.arange(0, zmax + zstep / 2, zstep)
+    num_z, num_bands = len(redshifts), len(BAND_LIST)
+    blocks = []
+    for model in range(1, num_models + 1):
+        # Smooth colour tracks with a template-dependent slope:
+        slopes = rng.normal(0, 0.5, num_bands)
+        for ebv in ebvs:
+            mags = 20 + 2.5 * np.log10(1 + redshifts)[:, None] * (1 + slopes) + \
+                ebv * np.linspace(3, 0.5, num_bands) + rng.normal(0, 0.02, (num_z, num_bands))
+            kcor = rng.normal(0, 0.3, (num_z, num_bands))
+            info = np.column_stack([np.full(num_z, model), np.zeros(num_z), np.full(num_z, ebv),
+                                    np.zeros(num_z), np.full(num_z, 1e9), redshifts,
+                                    5 * np.log10(np.maximum(redshifts, 1e-3) * 4300e5)])
+            blocks.append(np.hstack([info, mags, kcor]))
+    header = "# model ext_law E(B-V) L_IR age redshift distance_modulus " + \
+        "mag_vector kcor_vector em_line_vector\n"
+    with open(fpath, "w", encoding="utf-8") as f:
+        f.write(header)
+        np.savetxt(f, np.vstack(blocks), fmt="%.5g")
+
+
+def write_template_list(fpath, num_models):
+    """Writes a template list with num_models (made-up) template names."""
+    with open(fpath, "w", encoding="utf-8") as f:
+        f.writelines(f"SYNTH/template_{i:03d}.sed\n" for i in range(1, num_models + 1))
+
+
+def write_spec_file(fpath, rng, num_pdf=301, num_model_lines=1000):
+    """Writes a LePhare-like .spec file as parsed by output_scripts.spec_helper.Spectrum."""
+    num_filt = len(BAND_LIST)
+    lines = ["# Ident Zspec Zphot\n", f"1 {rng.uniform(0, 3):.4f} {rng.uniform(0, 3):.4f}\n",
+             "#\n", f"FILTERS {num_filt}\n", "#\n", f"PDF {num_pdf}\n",
+             "# Type Nline Model Library Nband Zphot Zinf Zsup Chi2 PDF Extlaw EB-V Lir Age Mass SFR SSFR\n"]
+    for i, model_type in enumerate(["GAL-1", "GAL-2", "GAL-FIR", "GAL-STOCH", "QSO", "STAR"]):
+        nline = num_model_lines if i in [0, 4, 5] else 0
+        lines.append(f"{model_type} {nline} {i + 1} 1 {num_filt} 0.5000 0.4000 0.6000 "
+                     "10.0000 90.0000 0 0.0000 0.0000 1.0000 1.0000 1.0000 1.0000\n")
+    for i in range(num_filt):
+        mag = rng.uniform(18, 24)
+        lines.append(f"{mag:.4f} 0.0500 {3000 + 2000 * i:.1f} 500.0 0.0 0.0 0.0 "
+                     f"1.0000 {mag + rng.normal(0, 0.1):.4f}\n")
+    zgrid = np.linspace(0, 6, num_pdf)
+    lines += [f"{z:.4f} {np.exp(-(z - 1)**2):.5f} {np.exp(-(z - 2)**2):.5f}\n" for z in zgrid]
+    for nline in [num_model_lines, num_model_lines, num_model_lines]:
+        wavelengths = np.geomspace(900, 5e5, nline)
+        lines += [f"{wl:.2f} {rng.uniform(18, 26):.4f}\n" for wl in wavelengths]
+    with open(fpath, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+
+
+def generate_dataset(paths, num_rows, seed=42, num_models=40):
+    """Writes all synthetic files for a catalogue with num_rows sources (split between
+    the pointlike and extended ttypes) into the directories given in paths.
+    returns:
+        Dictionary with the paths of the generated files."""
+    rng = np.random.default_rng(seed)
+    files = {}
+    sweep = make_sweep_table(num_rows, rng)
+    for survey in ["sweep", "vhs", "galex", "hsc"]:
+        fpath = f"{paths['cat']}{survey}_{num_rows}.fits"
+        table = sweep if survey == "sweep" else make_matched_survey_table(sweep, survey, rng)
+        table.write(fpath, overwrite=True)
+        files[survey] = fpath
+    output_dir = paths["data"] + "lephare_output/"
+    template_dir = paths["data"] + "lephare_files/templates/"
+    for ttype in TTYPES:
+        num = num_rows // 2
+        files[f"out_ascii_{ttype}"] = f"{output_dir}{STEM}_{ttype}.out"
+        write_output_ascii(files[f"out_ascii_{ttype}"], num, rng)
+        files[f"out_fits_{ttype}"] = f"{output_dir}{STEM}_{ttype}.fits"
+        write_output_fits(files[f"out_fits_{ttype}"], num, rng)
+        files[f"maglib_{ttype}"] = f"{template_dir}{STEM}_{ttype}_mag_lib.dat"
+        write_template_library(files[f"maglib_{ttype}"], num_models, rng)
+        write_template_list(f"{paths['params']}template_lists/{STEM}_{ttype}.list", num_models)
+    files["spec"] = f"{output_dir}Id000000001.spec"
+    write_spec_file(files["spec"], rng)
+    return files
@@ -13,6 +13,7 @@ import pandas as pd
 import util.configure_matplotlib as cm
 import util.my_tools as mt
 from matplotlib.patches import Patch
+from util.chunked_stats import BandSummary
 
 
 def plot_r_band_magnitude(df, stem="", title=""):
@@ -33,20 +34,22 @@ def plot_r_band_magnitude(df, stem="", title=""):
                    stem=stem, name="r_band_hist")
 
 
-def construct_band_availability_dataframe(df, desired_bands):
+def construct_band_availability_dataframe(df, desired_bands, summary=None):
     """Count the number of available photometry for each band and assign colours to them depending on the surveys they stem from.
+    The counts are cumulative, i. e. each band only counts the sources also available in the previous ones.
+    A precomputed BandSummary can be provided instead of the df.
     returns a band_count_df with the bands as an index."""
+    if summary is None:
+        summary = BandSummary.from_dataframe(df)
     counts, source_nums = {}, {}
     for ttype in ["extended", "pointlike"]:
-        subset = df[df["Type"] == ttype]
-        total_length = len(subset)
-        for band in desired_bands:
-            refname = f"mag_{band}" if band != "ZSPEC" else band
-            subset = subset[subset[refname] > 0]
+        total_length = summary.give_source_num(ttype)
+        nums = summary.give_cumulative_availability(ttype, desired_bands)
+        for band, num in zip(desired_bands, nums):
             if band in counts:
-                counts[band][ttype] = len(subset) / total_length
+                counts[band][ttype] = num / total_length
             else:
-                counts[band] = {ttype: len(subset) / total_length}
+                counts[band] = {ttype: num / total_length}
         source_nums[ttype] = total_length
     band_count_df = pd.DataFrame(counts).T
     print(band_count_df)
@@ -61,21 +64,13 @@ def construct_band_availability_dataframe(df, desired_bands):
     return band_count_df, source_nums
 
 
-def construct_num_band_dataframe(df, allowed_bands):
-    """Count how many bands are available for each source and return a dataframe reflecting this distribution."""
-    max_band_num = len(allowed_bands)
-    count_dict = {}
-    # Counts the number of not-nan-entries for each row
-    df["num_bands"] = df[allowed_bands].count(axis=1)
-    for i in range(max_band_num + 1):
-        with_z = df[df["ZSPEC"] > 0]
-        without_z = df[~(df["ZSPEC"] > 0)]
-        count_dict[i] = {}
-        count_dict[i]["with_z"] = len(with_z[with_z["num_bands"] == i])
-        count_dict[i]["without_z"] = len(
-            without_z[without_z["num_bands"] == i])
-    band_count_df = pd.DataFrame(count_dict).T
-    return band_count_df
+def construct_num_band_dataframe(df, allowed_bands, summary=None):
+    """Count how many bands are available for each source and return a dataframe reflecting this distribution.
+    A precomputed BandSummary can be provided instead of the df."""
+    if summary is None:
+        summary = BandSummary.from_dataframe(df)
+    bands = [band.replace("mag_", "", 1) for band in allowed_bands]
+    return summary.give_band_number_counts(bands)
 
 
 def construct_availability_bar_plots(band_count_df, ax, title, source_nums):
@@ -111,18 +106,21 @@ def construct_availability_bar_plots(band_count_df, ax, title, source_nums):
                  int(num * source_nums["pointlike"]) for num in band_count_df["pointlike"]], label_type='edge', rotation=90, padding=2.5, size="x-small")
 
 
-def plot_input_distribution(df, band_list: list, consider_specz=True, title=""):
+def plot_input_distribution(df, band_list: list, consider_specz=True, title="", summary=None):
     """Produce a bar plot of the relative input distribution for pointlike and extended.
     Parameters:
         df: Input or output Dataframe with magnitude columns in each band.
-        glb_context: Global context to identify the used bands"""
+        glb_context: Global context to identify the used bands
+        summary: Precomputed BandSummary, used instead of the df."""
+    if summary is None:
+        summary = BandSummary.from_dataframe(df)
     if consider_specz:
         band_list = list(band_list) + ["ZSPEC"]
     band_count_df, source_nums = construct_band_availability_dataframe(
-        df, band_list)
+        df, band_list, summary)
     fig, axes = plt.subplots(1, 1, figsize=cm.set_figsize(fraction=.8))
     if title == "default":
-        title = f"Photometry in the eFEDS field  ({len(df)} sources in total)"
+        title = f"Photometry in the eFEDS field  ({summary.give_source_num()} sources in total)"
     construct_availability_bar_plots(band_count_df, axes, title, source_nums)
     survey_dict = {survey: mt.give_survey_color(
         survey) for survey in set(band_count_df["Survey"])}
@@ -138,11 +136,11 @@ def plot_input_distribution(df, band_list: list, consider_specz=True, title=""):
     return fig
 
 
-def plot_band_number_distribution(df, stem="", glb_context=-1, title=""):
+def plot_band_number_distribution(df, stem="", glb_context=-1, title="", summary=None):
     """Construct a bar plot with the number of possible bands for each of the sources."""
     allowed_bands = [
         f"mag_{band}" for band in mt.give_bands_for_context(glb_context)]
-    band_count_df = construct_num_band_dataframe(df, allowed_bands)
+    band_count_df = construct_num_band_dataframe(df, allowed_bands, summary)
     fig, ax = plt.subplots(1, 1, figsize=cm.set_figsize(fraction=.8))
     ax.grid(True, axis="y")
     labels = list(band_count_df.index)
@@ -1,42 +1,180 @@
-
 # %%
+import os
+from io import StringIO
+
+import numpy as np
 import pandas as pd
 import util.my_tools as mt
 
+# Speed of light in Angstrom/s
+C_ANGSTROM = 2.99792458e18
+
+
+class FilterStore:
+    """Container for a set of filter transmission curves, stored in two contiguous
+    arrays (wavelengths in Angstrom and transmissions) with the curve of the i-th filter
+    being located at offsets[i]:offsets[i + 1].
+    The derived quantities (mean wavelength, FWHM, AB corrections) are kept in a table,
+    and the store can be cached as a .npz file."""
+
+    def __init__(self, names, wavelengths, transmissions, offsets, ab_cor=None):
+        self.names = list(names)
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        self.transmissions = np.asarray(transmissions, dtype=float)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ab_cor = np.full(len(self.names), np.nan) if ab_cor is None \
+            else np.asarray(ab_cor, dtype=float)
+        self._weights = self._give_trapezoid_weights()
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_curves(cls, curves: dict, ab_cor=None):
+        """Constructs the store from a dictionary with the filter names as keys and
+        (wavelength, transmission) pairs as values."""
+        lengths = [len(wl) for wl, _ in curves.values()]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        wavelengths = np.concatenate([np.asarray(wl, dtype=float) for wl, _ in curves.values()])
+        transmissions = np.concatenate(
+            [np.asarray(trans, dtype=float) for _, trans in curves.values()])
+        return cls(list(curves), wavelengths, transmissions, offsets, ab_cor)
+
+    @classmethod
+    def from_transmission_file(cls, fpath):
+        """Parses a transmission file, in which each filter is given by a '# <name>' line
+        followed by a line of comma-separated wavelengths and one of transmissions."""
+        with open(fpath, "r", encoding="utf-8") as f:
+            lines = [line for line in f.read().splitlines() if line.strip() != ""]
+        curves = {}
+        for i, line in enumerate(lines):
+            if line.startswith("# "):
+                curves[line[2:].strip()] = (
+                    np.array(lines[i + 1].split(","), dtype=float),
+                    np.array(lines[i + 2].split(","), dtype=float))
+        return cls.from_curves(curves)
+
+    @classmethod
+    def from_filter_fpaths(cls, band_to_fpath: dict):
+        """Reads the raw LePhare filter files (two columns: wavelength in Angstrom and
+        transmission, with '#' comments) at the given paths for the given bands."""
+        curves = {}
+        for band, fpath in band_to_fpath.items():
+            data = np.loadtxt(fpath, comments="#", ndmin=2)
+            curves[band] = (data[:, 0], data[:, 1])
+        return cls.from_curves(curves)
+
+    @classmethod
+    def from_filter_files(cls, band_to_fname: dict, directory):
+        """Reads the raw LePhare filter files with the given names in directory."""
+        return cls.from_filter_fpaths({band: os.path.join(directory, fname)
+                                       for band, fname in band_to_fname.items()})
+
+    @classmethod
+    def load(cls, fpath):
+        """Reads a store cached with save."""
+        with np.load(fpath, allow_pickle=False) as data:
+            return cls(data["names"].tolist(), data["wavelengths"], data["transmissions"],
+                       data["offsets"], data["ab_cor"])
+
+    def save(self, fpath):
+        """Caches the store as a .npz file."""
+        np.savez(fpath, names=np.array(self.names), wavelengths=self.wavelengths,
+                 transmissions=self.transmissions, offsets=self.offsets, ab_cor=self.ab_cor)
+
+    def give_curve(self, name):
+        """Returns the wavelengths and transmissions of the filter with the given name."""
+        i = self.names.index(name)
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.wavelengths[start:stop], self.transmissions[start:stop]
+
+    def subset(self, names):
+        """Returns a store only containing the given filters (in the given order)."""
+        indices = [self.names.index(name) for name in names]
+        return FilterStore.from_curves({name: self.give_curve(name) for name in names},
+                                       self.ab_cor[indices])
+
+    def _give_trapezoid_weights(self):
+        """Returns the weights of the trapezoidal integration over the wavelengths of each filter."""
+        diffs = np.diff(self.wavelengths) / 2
+        # The differences between the last point of one filter and the first of the next don't count:
+        diffs[self.offsets[1:-1] - 1] = 0
+        weights = np.zeros(len(self.wavelengths))
+        weights[:-1] += diffs
+        weights[1:] += diffs
+        return weights
+
+    def _integrate(self, values):
+        """Integrates values (given at all wavelengths, possibly with leading axes) over each filter."""
+        return np.add.reduceat(values * self._weights, self.offsets[:-1], axis=-1)
+
+    def give_derived_table(self):
+        """Returns a DataFrame with the mean wavelength and the FWHM of each filter
+        (both in micron) and the AB corrections (if known)."""
+        lambda_mean = self._integrate(self.transmissions * self.wavelengths) / \
+            self._integrate(self.transmissions)
+        fwhm = np.zeros(len(self))
+        for i, name in enumerate(self.names):
+            wl, trans = self.give_curve(name)
+            above = np.flatnonzero(trans >= trans.max() / 2)
+            fwhm[i] = wl[above[-1]] - wl[above[0]] if len(above) > 0 else 0
+        return pd.DataFrame({"Lbda_mean": lambda_mean / 1e4, "FWHM": fwhm / 1e4,
+                             "AB-cor": self.ab_cor}, index=self.names)
+
+    def give_synthetic_magnitudes(self, sed_wavelengths, sed_flux, redshifts=(0,)):
+        """Integrates an SED (f_lambda on the rest-frame wavelengths in Angstrom) through all
+        filters at once for each of the redshifts.
+        returns:
+            Array of shape (len(redshifts), len(self)) with the AB magnitudes, up to a constant
+            offset depending on the normalization of the SED (which cancels in colours)."""
+        redshifts = np.atleast_1d(np.asarray(redshifts, dtype=float))
+        # The rest-frame wavelengths at which the SED is seen through the filters:
+        rest_wl = self.wavelengths[None, :] / (1 + redshifts[:, None])
+        flux = np.interp(rest_wl, sed_wavelengths, sed_flux, left=0, right=0) / \
+            (1 + redshifts[:, None])
+        # Photon-counting mean f_nu = int(f_lambda R lambda) / int(R c / lambda)
+        numerator = self._integrate(flux * self.transmissions * self.wavelengths)
+        denominator = self._integrate(self.transmissions * C_ANGSTROM / self.wavelengths)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return -2.5 * np.log10(numerator / denominator) - 48.6
+
+
+def give_filter_store(consider_context=False):
+    """Returns the FilterStore of the current transmission file, using the cached .npz version
+    if it is newer than the transmission and overview files.
+    The AB corrections are taken from the overview file if it is available."""
+    fpath = mt.give_filterfile_fpath(overview=False)
+    overview_fpath = mt.give_filterfile_fpath()
+    cache_fpath = os.path.splitext(fpath)[0] + ".npz"
+    if os.path.isfile(cache_fpath) and mt.is_file_fresh(cache_fpath, [fpath, overview_fpath]):
+        store = FilterStore.load(cache_fpath)
+    else:
+        store = FilterStore.from_transmission_file(fpath)
+        if os.path.isfile(overview_fpath):
+            overview = read_filter_overview_file().set_index("Band_intern")
+            store.ab_cor = overview["AB-cor"].reindex(
+                [name.lower() for name in store.names]).to_numpy(dtype=float)
+        try:
+            store.save(cache_fpath)
+        except OSError as e:
+            mt.LOGGER.warning("Could not cache the filter store at %s (%s).", cache_fpath, e)
+    if consider_context:
+        bands = mt.give_bands_for_context(mt.CONTEXT)
+        store = store.subset([name for name in store.names if name in bands])
+    return store
+
 
 def read_filter_transmission_file(consider_context=False):
     """Reads and returns a .filt file from LePhare and converts it to a pandas
     dataframe."""
-    fpath = mt.give_filterfile_fpath(overview=False)
-    filter_wls = {}
-    filter_trans = {}
-    with open(fpath, "r") as f:
-        for line in f.readlines():
-            if line.startswith("# "):
-                # We can be sure that this is always called first
-                name = line.strip("# ")[:-1]
-            else:
-                if name in filter_wls:
-                    filter_trans[name] = [
-                        float(val) for val in line.strip("\n").split(", ")]
-                else:
-                    filter_wls[name] = [float(val)
-                                        for val in line.strip("\n").split(", ")]
-    if consider_context:
-        bands = list(filter_wls.keys())
-        for band in bands:
-            if band not in mt.give_bands_for_context(mt.CONTEXT):
-                del filter_wls[band]
-                del filter_trans[band]
+    store = give_filter_store(consider_context)
+    lambda_means = store.give_derived_table()["Lbda_mean"] * 1000  # to nm
     df_dict = {}
-    overview = read_filter_overview_file()
-    for key, wl in filter_wls.items():
-        band_info = overview[overview["Band_intern"] == key.lower()]
-        filter_df = pd.DataFrame(
-            {"lambda": wl, "trans": filter_trans[key]})
-        lambda_mean = float(band_info['Lbda_mean']) * 1000  # to nm
-        survey = band_info['Survey_intern'].iloc[0]
-        df_dict[f"{lambda_mean:6.0f}>{key}>{survey}"] = filter_df
+    for name in store.names:
+        wl, trans = store.give_curve(name)
+        filter_df = pd.DataFrame({"lambda": wl, "trans": trans})
+        survey = mt.give_survey_for_band(name)
+        df_dict[f"{lambda_means[name]:6.0f}>{name}>{survey}"] = filter_df
     df = pd.concat(df_dict, axis=1)
     return df
 
@@ -58,11 +196,13 @@ def read_filter_overview_file():
             skipped = lines.index(line)
             break
     colnames = [name for name in line.strip("# ").split()]
-    df = pd.read_csv(fname, delim_whitespace=True,
-                     skiprows=skipped, comment="#", names=colnames, skipfooter=1, engine='python')
+    # Only keep the table rows (dropping comments and the runtime info in the last line):
+    rows = [row for row in lines[skipped + 1:]
+            if not row.startswith("#") and len(row.split()) == len(colnames)]
+    df = pd.read_csv(StringIO("".join(rows)), delim_whitespace=True, names=colnames)
     fname_band_dict = {fname: band for band,
                        fname in mt.GEN_CONFIG["FILTERS"].items()}
-    df["Band_intern"] = df["NAME"].apply(lambda name: fname_band_dict[name])
+    df["Band_intern"] = df["NAME"].map(fname_band_dict)
     df["Band"] = df["Band_intern"].apply(
         lambda name: mt.give_latex_band_name(name))
     df["Survey_intern"] = df["Band_intern"].apply(
@@ -3,6 +3,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import output_scripts.specz_photz_plots as s_p
 import pandas as pd
+import util.chunked_stats as c_s
 import util.configure_matplotlib as cm
 import util.my_tools as mt
 
@@ -16,8 +17,13 @@ import input_scripts.filter_coverage_plot as f_c
 class InputPlotContainer:
     """Convenience class for containing and plotting the input data."""
 
-    def __init__(self, save_figures=False):
-        self.df = mt.read_saved_df(cat_type="in_processed")
+    def __init__(self, save_figures=False, out_of_core=False):
+        # In the out-of-core mode, the catalogues are never loaded completely, but only
+        # read chunk by chunk or projected onto the columns needed for a plot:
+        self.out_of_core = out_of_core
+        self.df = None if out_of_core else mt.read_saved_df(cat_type="in_processed")
+        # All availability and magnitude plots are rendered from the (cached) band summary:
+        self.summary = c_s.give_band_summary(self.df)
         self.ext = "extended" in mt.USED_TTYPES
         self.plike = "pointlike" in mt.USED_TTYPES
         self.produce_both = self.ext & self.plike
@@ -26,12 +32,29 @@ class InputPlotContainer:
                 "Please specify a valid ttype [pointlike, extended or both] to plot the specz-photoz-plot.")
         self.stem = mt.CUR_CONFIG["LEPHARE"]["input_stem"]
         self.save_figures = save_figures
+        # The data files, used to check whether existing figures are up to date:
+        self.dependencies = list(mt.give_saved_df_fpaths("in_processed").values())
 
     def _quicksave_fig(self, fig, name, dir_=""):
         """Shortcut to save a given figure in the correct dir"""
         if self.save_figures:
             dir_ = "/" + dir_ if dir_ != "" else ""
-            cm.save_figure(fig, name, f"input_analysis{dir_}", self.stem)
+            cm.save_figure(fig, name, f"input_analysis{dir_}", self.stem,
+                           dependencies=self.dependencies)
+
+    def _give_separation_df(self, survey_name):
+        """Returns the DataFrame needed for the separation plots of the survey."""
+        if not self.out_of_core:
+            return self.df
+        columns = ["ra", "dec"] + [f"{prefix}_{survey_name}" for prefix in
+                                   ["ra", "dec", "delta_ra", "delta_dec", "sep_to", "true_sep"]]
+
+        def is_matched(data):
+            """Only reads the rows with a counterpart in the survey (if its columns are available)."""
+            if f"ra_{survey_name}" not in data.columns.names:
+                return np.ones(len(data), dtype=bool)
+            return np.isfinite(data[f"ra_{survey_name}"])
+        return c_s.read_projected_df("in_processed", columns, row_filter=is_matched)
 
     def plot_separation(self, survey_name_to_radius: dict):
         """Generate separation scatter plots and histograms to each of the survey_names in [survey_name_to_radius].
@@ -41,8 +64,11 @@ class InputPlotContainer:
                 the initial matches as values.
         """
         for survey_name, radius in survey_name_to_radius.items():
-            scatter_fig, hist_fig = sep_p.plot_separation(
-                self.df, survey_name, radius)
+            figs = sep_p.plot_separation(
+                self._give_separation_df(survey_name), survey_name, radius)
+            if figs is None:
+                continue
+            scatter_fig, hist_fig = figs
             self._quicksave_fig(
                 scatter_fig, f"{survey_name}_sep_histogram", "separation")
             self._quicksave_fig(
@@ -58,11 +84,25 @@ class InputPlotContainer:
         """
         band_list = tuple([
             band for band in band_list if band in mt.give_bands_for_context(context)])
-        fig = m_d.plot_magnitude_dist(self.df, band_list, split_ttype=True)
+        fig = m_d.plot_magnitude_dist(
+            self.df, band_list, split_ttype=True, summary=self.summary)
         name = "magnitude_distribution"
         if context > 0:
             name += "_" + str(context)
         self._quicksave_fig(fig, name)
+        self.log_magnitude_limits(band_list)
+
+    def log_magnitude_limits(self, band_list=tuple(mt.BAND_LIST), percentiles=(50, 90, 95)):
+        """Logs the estimated percentiles of the magnitudes in each band, the highest one
+        serving as an estimate of the magnitude limit."""
+        header = "Band\t" + "\t".join(f"{perc}%" for perc in percentiles)
+        lines = [header]
+        for band in band_list:
+            if self.summary.give_num_good(band) == 0:
+                continue
+            mags = self.summary.give_magnitude_percentiles(band, percentiles)
+            lines.append(f"{band}\t" + "\t".join(f"{mag:.2f}" for mag in mags))
+        mt.LOGGER.info("Magnitude percentiles of the input sources:\n%s", "\n".join(lines))
 
     def plot_input_dist(self, band_list=tuple(mt.BAND_LIST), context=-1, consider_specz=True):
         """Produce a bar plot of the distribution of sources for a given set of 
@@ -77,7 +117,8 @@ class InputPlotContainer:
         """
         band_list = tuple([
             band for band in band_list if band in mt.give_bands_for_context(context)])
-        fig = av.plot_input_distribution(self.df, band_list, consider_specz)
+        fig = av.plot_input_distribution(
+            self.df, band_list, consider_specz, summary=self.summary)
         name = "availability_distribution"
         if context > 0:
             name += "_" + str(context)
@@ -86,6 +127,10 @@ class InputPlotContainer:
     def plot_comparison_photz_vs_specz(self):
         """Produces a comparison plot to analyse the photo-z from the RF-classifier of the
         optically selected AGN."""
+        if self.out_of_core:
+            mt.LOGGER.warning(
+                "The photo-z comparison plot is not available in the out-of-core mode.")
+            return
         df = self.df.rename(columns={"opt_agn_phot_z": "ZBEST"})
         df = mt.add_filter_columns(df)
         fig, axes = plt.subplots(2, 2, figsize=cm.set_figsize(
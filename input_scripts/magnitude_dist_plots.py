@@ -16,9 +16,16 @@ import pandas as pd
 import util.configure_matplotlib as cm
 import util.my_tools as mt
 from matplotlib.patches import Patch
+from util.chunked_stats import BandSummary
 
 
-def plot_magnitude_dist(df: pd.DataFrame, band_list=tuple(mt.BAND_LIST), split_ttype=False):
+def plot_binned_hist(ax, counts, bins, **kwargs):
+    """Plots a (normalized) histogram of already binned counts on the given ax."""
+    # An empty histogram can't be normalized
+    ax.hist(bins[:-1], bins=bins, weights=counts, density=counts.sum() > 0, **kwargs)
+
+
+def plot_magnitude_dist(df: pd.DataFrame, band_list=tuple(mt.BAND_LIST), split_ttype=False, summary=None):
     """Plot the distribution of sources for a given set of photometric bands.
         Parameters:
             [df]: Pandas DataFrame
@@ -27,7 +34,11 @@ def plot_magnitude_dist(df: pd.DataFrame, band_list=tuple(mt.BAND_LIST), split_t
                 Plots for these requested photometric bands will be produced.
             [context]: int = -1
                 Only consider the bands fitting the context
+            [summary]: BandSummary
+                Precomputed summary of the input data, used instead of the df.
     """
+    if summary is None:
+        summary = BandSummary.from_dataframe(df)
     num_plots = len(band_list)
     num_cols = min(floor(num_plots**0.5), 4)  # at most 4 cols
     num_rows = ceil(num_plots / num_cols)
@@ -47,14 +58,14 @@ def plot_magnitude_dist(df: pd.DataFrame, band_list=tuple(mt.BAND_LIST), split_t
         is_on_bottom = row == num_rows - 1 or row == num_rows - \
             2 and col >= num_cols - num_in_last_row
         ax = axes[row][col]
+        ax.grid(True)
         if split_ttype:
-            ext = df[df["Type"] == "extended"][f"mag_{band}"]
-            plike = df[df["Type"] == "pointlike"][f"mag_{band}"]
-            n_ext, n_plike = len(ext[ext > 0]), len(plike[plike > 0])
-            ext.hist(ax=ax, label=f"Ext ({n_ext})",
-                     bins=np.arange(10, 25, 0.5), density=True, histtype="stepfilled", alpha=0.5, ec="gray")
-            plike.hist(ax=ax, label=f"Poi ({n_plike})",
-                       bins=np.arange(10, 25, 0.5), density=True, histtype="stepfilled", alpha=0.5, ec="gray")
+            n_ext = summary.give_num_good(band, "extended")
+            n_plike = summary.give_num_good(band, "pointlike")
+            plot_binned_hist(ax, summary.give_histogram(band, "extended"), summary.bins,
+                             label=f"Ext ({n_ext})", histtype="stepfilled", alpha=0.5, ec="gray")
+            plot_binned_hist(ax, summary.give_histogram(band, "pointlike"), summary.bins,
+                             label=f"Poi ({n_plike})", histtype="stepfilled", alpha=0.5, ec="gray")
             title = mt.generate_pretty_band_name(band)
             surv_color = mt.give_survey_color(mt.give_survey_for_band(band))
             ax.text(0.1, 0.8, title, bbox=dict(
@@ -62,11 +73,11 @@ def plot_magnitude_dist(df: pd.DataFrame, band_list=tuple(mt.BAND_LIST), split_t
             ax.legend(loc=(0.4, 0.6), prop={"size": "small"}, frameon=False)
 
         else:
-            n_sources = mt.give_amount_of_good_photometry(df, band)
+            n_sources = summary.give_num_good(band)
             label = f"{mt.generate_pretty_band_name(band)} ($N={n_sources}$)"
             surv_color = mt.give_survey_color(mt.give_survey_for_band(band))
-            df[f"mag_{band}"].hist(ax=ax, label=label,
-                                   color=surv_color, bins=np.arange(10, 25, 0.5), density=True, histtype="stepfilled", ec="black")
+            plot_binned_hist(ax, summary.give_histogram(band), summary.bins, label=label,
+                             color=surv_color, histtype="stepfilled", ec="black")
             ax.legend(loc="upper left")
         if is_on_bottom:
             ax.set_xlabel("Mag")
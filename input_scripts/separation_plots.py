@@ -12,9 +12,15 @@ import numpy as np
 import util.configure_matplotlib as cm
 import util.my_tools as mt
 from matplotlib.offsetbox import AnchoredText
-from scipy.stats import gaussian_kde, rayleigh
+from scipy.ndimage import gaussian_filter, map_coordinates
+from scipy.stats import rayleigh
 
 NBINS = 40
+# Resolution and smoothing (in bins) of the binned density estimate:
+DENSITY_BINS = 256
+DENSITY_SMOOTHING = 2
+# Maximum number of points drawn in the scatter plot:
+MAX_SCATTER_POINTS = 20000
 
 
 class ColumnMissingError(Exception):
@@ -49,12 +55,38 @@ def arrange_subplots(axes):
     return main, xhist, yhist
 
 
+def give_point_density(x, y, lim):
+    """Estimates the point density at each of the given points using a binned
+    kernel density estimate, i. e. a 2d histogram smoothed with a gaussian kernel
+    that is interpolated back to the positions of the points.
+    This scales linearly with the number of points, contrary to a full gaussian KDE."""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    hist, _, _ = np.histogram2d(x, y, bins=DENSITY_BINS,
+                                range=[[-lim, lim], [-lim, lim]])
+    density = gaussian_filter(hist, sigma=DENSITY_SMOOTHING, mode="constant")
+    # Convert the coordinates to (fractional) bin indices for the interpolation:
+    binwidth = 2 * lim / DENSITY_BINS
+    coords = np.vstack([(x + lim) / binwidth - 0.5, (y + lim) / binwidth - 0.5])
+    return map_coordinates(density, coords, order=1, mode="nearest")
+
+
+def give_scatter_subsample(num, seed=42):
+    """Returns the indices of at most MAX_SCATTER_POINTS randomly drawn points."""
+    if num <= MAX_SCATTER_POINTS:
+        return np.arange(num)
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(num, size=MAX_SCATTER_POINTS, replace=False))
+
+
 def scatter_points(x, y, ax, lim, true_radius=None):
-    """Produce the central scatter plot, including main lines and circles corresponding to the data used."""
-    xy = np.vstack([x, y])
-    z = gaussian_kde(xy)(xy)
-    ax.scatter(x, y, label=f"{len(x)} sources", c=z,
-               marker=".", cmap="viridis", s=1)
+    """Produce the central scatter plot, including main lines and circles corresponding to the data used.
+    The density is estimated on all points, while only a random subsample is drawn."""
+    z = give_point_density(x, y, lim)
+    indices = give_scatter_subsample(len(x))
+    # Draw the densest points last so they are not hidden:
+    indices = indices[np.argsort(z[indices], kind="stable")]
+    ax.scatter(np.asarray(x)[indices], np.asarray(y)[indices], label=f"{len(x)} sources",
+               c=z[indices], marker=".", cmap="viridis", s=1)
     ax.set_xlabel(r"$\Delta$ RA [arcsec]")
     ax.set_ylabel(r"$\Delta$ Dec [arcsec]", labelpad=0.1)
     ax.set_xlim((-lim, lim))
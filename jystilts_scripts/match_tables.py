@@ -1,7 +1,7 @@
 
 
 import os
-from sys import path
+from sys import argv, path
 
 WORKPATH = os.environ["LEPHARE"] + "/"
 # This is needed to be able to import custom modules
@@ -10,16 +10,20 @@ path.append(WORKPATH + "lephare_scripts/jystilts_scripts/modules")
 import jy_tools as jt
 import table_io as t_io
 
+if jt.is_incremental():
+    # Only needed (and imported) for the incremental ingestion
+    import incremental as inc
 
-def load_and_clean_tables():
-    """Read the tables."""
+
+def load_and_clean_tables(cats):
+    """Read the tables of the given catalogues."""
     # , "xray_agn"]  # "assef_agn"
     tables = {}
-    for catname in CATS:
+    for catname in cats:
         table = t_io.read_table(catname)
         table = t_io.pre_clean_table(catname, table)
         tables[catname] = table
-    jt.LOGGER.debug("Loaded tables from the following catalogs:\n%s", CATS)
+    jt.LOGGER.debug("Loaded tables from the following catalogs:\n%s", cats)
     return tables
 
 
@@ -53,26 +57,56 @@ def process_match(match):
     return tables
 
 
-def process_for_lephare(tables):
-    """Function to clean the tables and output them such that they can be used by LePhare."""
+def process_for_lephare(tables, kept_ttypes=()):
+    """Function to clean the tables and output them such that they can be used by LePhare.
+    The existing input files of the kept_ttypes are not overwritten."""
     for ttype in ["pointlike", "extended"]:
         if not ttype in tables.keys():
             jt.LOGGER.warning("You did not initialize the %s table.", ttype)
             return
+        if ttype in kept_ttypes:
+            jt.LOGGER.info("Keeping the existing %s LePhare input table.", ttype)
+            continue
         if jt.CUR_CONFIG.getboolean("CAT_ASSEMBLY", "write_lephare_input"):
             table = t_io.process_for_lephare(tables[ttype])
             jt.write_lephare_input(table, ttype)
+            jt.write_ident_map(tables[ttype], ttype)
+
+
+def update_incrementally(cats, checksums):
+    """Processes only the new files of the given catalogues (with the file checksums
+    given by inc.give_checksums) and merges them into the processed tables (see the
+    incremental module)."""
+    tables = inc.run_incremental_update(cats, checksums)
+    if tables is None:
+        tables = dict((ttype, jt.read_processed_table(ttype))
+                      for ttype in ["pointlike", "extended"])
+    for ttype in ["pointlike", "extended"]:
+        tables[ttype] = t_io.filter_for_testing(tables[ttype])
+    jt.write_info_file(tables["pointlike"], tables["extended"])
+    return tables
 
 
 if __name__ == "__main__":
     CATS = ["vhs", "sweep", "opt_agn", "eros", "hsc", "kids", "ls10"]
     STEM = jt.CUR_CONFIG.get("CAT_ASSEMBLY", "cat_stem")
-    # Dictionary with the table names as keys and the tables as values
-    TABLE_DICT = load_and_clean_tables()
-
-    MATCH = match_tables(TABLE_DICT)
-    PROCESSED = process_match(MATCH)
-    process_for_lephare(PROCESSED)
+    # The checksums of the catalogue files for the incremental mode
+    CHECKSUMS = None
+    if jt.is_incremental():
+        CHECKSUMS = inc.give_checksums(CATS)
+    if CHECKSUMS is not None and inc.can_update_incrementally(CHECKSUMS):
+        PROCESSED = update_incrementally(CATS, CHECKSUMS)
+    else:
+        # Dictionary with the table names as keys and the tables as values
+        TABLE_DICT = load_and_clean_tables(CATS)
+
+        MATCH = match_tables(TABLE_DICT)
+        PROCESSED = process_match(MATCH)
+        if CHECKSUMS is not None:
+            # Record the processed files for the next incremental update
+            inc.write_manifest(CHECKSUMS)
+    # The ttypes whose LePhare input is to be kept are given as arguments
+    process_for_lephare(PROCESSED, argv[1:])
 
 
 # region_boundaries = s_region.get_region(eFEDS=True)  # Get the region as a minmaxlist
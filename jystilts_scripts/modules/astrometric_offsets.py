@@ -0,0 +1,139 @@
+"""Helper module for removing the systematic astrometric offsets between the
+parent (sweep) positions and the positions of the matched surveys.
+The offsets are determined separately in each HEALPix cell, so spatially varying
+offsets across large fields are taken into account.
+All surveys are treated at once, so the number of passes over the table does
+not grow with the number of matched surveys."""
+import stilts
+
+import jy_tools as jt
+
+# HEALPix level of the cells the offsets are determined in (level 4 ~ 13.4 deg**2 per cell)
+HEALPIX_LEVEL = 4
+# Cells with fewer matches than this fall back to the offsets of the whole field
+MIN_CELL_MATCHES = 30
+# Sources further out than CLIP_FACTOR robust standard deviations are discarded
+CLIP_FACTOR = 3
+# Conversion factor from the median absolute deviation to a standard deviation
+MAD_TO_STD = 1.4826
+# All surveys for which the photometry can be discarded (the parent survey is sweep)
+MATCHED_SURVEYS = ["galex", "vhs", "hsc", "kids", "ls10"]
+CELL_COL = "offset_cell"
+
+
+def give_available_surveys(table):
+    """Returns the surveys of MATCHED_SURVEYS for which separation columns are present in the table."""
+    colnames = [str(column.name).lower() for column in table.columns()]
+    return [cat for cat in MATCHED_SURVEYS if "delta_ra_" + cat in colnames]
+
+
+def give_global_statistics(table, cols):
+    """Calculates the median and the number of non-null entries of each of the
+    given columns on the whole table in a single pass.
+    returns:
+        Dictionary with the column names as keys and (median, ngood) tuples as values."""
+    stats = table.cmd_keepcols(" ".join(cols)).cmd_stats("Median", "NGood")
+    return dict((col, (stats.getCell(i, 0), stats.getCell(i, 1))) for i, col in enumerate(cols))
+
+
+def add_cell_statistics(table, aggcols):
+    """Groups the table by HEALPix cell, evaluates the aggregations given via aggcols
+    (in the '<expr>;<aggregator>;<name>' format of tgroup) and joins them back onto each row."""
+    stats = stilts.tgroup(in_=table, keys=CELL_COL, aggcols=" ".join(aggcols))
+    stats = jt.change_colnames(stats, [CELL_COL], [CELL_COL + "_stats"])
+    table = stilts.tmatch2(in1=table, in2=stats, matcher="exact", values1=CELL_COL,
+                           values2=CELL_COL + "_stats", join="all1", find="best")
+    return table.cmd_delcols(CELL_COL + "_stats")
+
+
+def give_fallback_expr(count_col, colname, global_value):
+    """Returns an expression using the cell value of colname if the cell contains
+    enough good values of the column it is computed from (counted in count_col),
+    and the global value otherwise."""
+    return "%s >= %d ? %s : %s" % (count_col, MIN_CELL_MATCHES, colname, repr(float(global_value)))
+
+
+def recentre_offsets(table, cats):
+    """Adds the new_delta_ra_*, new_delta_dec_* and true_sep_* columns for each of the surveys
+    in cats, with the median offsets of each HEALPix cell subtracted."""
+    cols = [prefix + cat for cat in cats for prefix in ["delta_ra_", "delta_dec_"]]
+    global_stats = give_global_statistics(table, cols)
+    # Each column gets its own count, as e.g. the Dec offsets may be missing where the
+    # RA offsets are not
+    aggcols = ["%s;ngood;n_%s" % (col, col) for col in cols]
+    aggcols += ["%s;median;med_%s" % (col, col) for col in cols]
+    table = add_cell_statistics(table, aggcols)
+    for cat in cats:
+        for coord in ["ra", "dec"]:
+            colname = "delta_%s_%s" % (coord, cat)
+            centre = give_fallback_expr("n_" + colname, "med_" + colname,
+                                        global_stats[colname][0])
+            table = table.cmd_addcol("new_" + colname, "%s - (%s)" % (colname, centre))
+        sep_expr = "sqrt(pow(new_delta_ra_" + cat + \
+            ", 2) + pow(new_delta_dec_" + cat + ", 2))"
+        table = table.cmd_addcol("true_sep_" + cat, sep_expr, "-units deg")
+        jt.LOGGER.debug("Global median offsets for %s: %s, %s (deg)", cat,
+                        global_stats["delta_ra_" + cat][0], global_stats["delta_dec_" + cat][0])
+    return table
+
+
+def add_clipping_radii(table, cats):
+    """Adds a max_sep_* column for each of the surveys in cats containing the
+    clipping radius (CLIP_FACTOR robust standard deviations of the separations
+    around their median) in the cell of each source."""
+    sep_cols = ["true_sep_" + cat for cat in cats]
+    global_meds = give_global_statistics(table, sep_cols)
+    table = add_cell_statistics(
+        table, ["%s;median;med_%s" % (col, col) for col in sep_cols] +
+        ["%s;ngood;n_%s" % (col, col) for col in sep_cols])
+    for cat in cats:
+        med_expr = give_fallback_expr(
+            "n_true_sep_" + cat, "med_true_sep_" + cat, global_meds["true_sep_" + cat][0])
+        table = table.cmd_addcol("centre_sep_" + cat, med_expr)
+        table = table.cmd_addcol(
+            "abs_dev_" + cat, "abs(true_sep_%s - centre_sep_%s)" % (cat, cat))
+    dev_cols = ["abs_dev_" + cat for cat in cats]
+    global_mads = give_global_statistics(table, dev_cols)
+    table = add_cell_statistics(
+        table, ["%s;median;mad_%s" % (col, cat) for col, cat in zip(dev_cols, cats)])
+    for cat in cats:
+        # The deviations are available wherever the separations are
+        mad_expr = give_fallback_expr(
+            "n_true_sep_" + cat, "mad_" + cat, global_mads["abs_dev_" + cat][0])
+        radius_expr = "centre_sep_%s + %s * %s * (%s)" % (
+            cat, CLIP_FACTOR, MAD_TO_STD, mad_expr)
+        table = table.cmd_addcol("max_sep_" + cat, radius_expr, "-units deg")
+    return table
+
+
+def discard_offset_outliers(table):
+    """Recentres the offsets of all matched surveys on the median offsets of their
+    HEALPix cell and sets the photometry of any match that is further out than the
+    robust clipping radius of the cell to -99. so it isn't considered."""
+    cats = give_available_surveys(table)
+    ngoods = give_global_statistics(table, ["delta_ra_" + cat for cat in cats])
+    cats = [cat for cat in cats if ngoods["delta_ra_" + cat][1] > 0]
+    if len(cats) == 0:
+        jt.LOGGER.warning("No matched surveys found to recentre the offsets for.")
+        return table
+    jt.LOGGER.info("Recentring the match offsets of %s on HEALPix level %d cells.",
+                   ", ".join(cats), HEALPIX_LEVEL)
+    table = table.cmd_addcol(CELL_COL, "healpixNestIndex(%d, ra, dec)" % HEALPIX_LEVEL)
+    table = recentre_offsets(table, cats)
+    table = add_clipping_radii(table, cats)
+    colnames = [str(column.name).lower() for column in table.columns()]
+    for cat in cats:
+        cut = "true_sep_%s < max_sep_%s" % (cat, cat)
+        for band in jt.BAND_DICT[cat]:
+            for colname in ["c_flux_" + band, "c_flux_err_" + band]:
+                if colname.lower() not in colnames:
+                    continue
+                table = table.cmd_replacecol(
+                    colname, cut + " ? " + colname + " : -99.")
+    # Remove the helper columns, only keeping the recentred separations and radii
+    helper_cols = [CELL_COL]
+    for cat in cats:
+        helper_cols += ["n_delta_ra_" + cat, "n_delta_dec_" + cat, "n_true_sep_" + cat,
+                        "med_delta_ra_" + cat, "med_delta_dec_" + cat,
+                        "med_true_sep_" + cat, "centre_sep_" + cat, "abs_dev_" + cat, "mad_" + cat]
+    return table.cmd_delcols(" ".join(helper_cols))
@@ -0,0 +1,191 @@
+"""Helper module for the incremental ingestion of new catalogue files.
+A manifest stores the md5 checksums of all catalogue files that have been processed.
+On an incremental run, only the parent (sweep) sources of new sweep files are matched
+and processed, and the resulting rows are appended to the existing processed tables.
+Their IDENTs continue after the largest existing one, so the IDENTs of the existing
+sources stay the same.
+Anything else requires a full rebuild, which is done automatically: If a catalogue
+file has been changed or removed, the rows of the sources no longer in it can't be
+removed from the processed tables, and if any of the other catalogues has changed,
+the astrometric offsets of the matches would only be determined on a subset of the
+sources. The offsets of the new sweep sources are determined on their own, which is
+fine as the sweep files cover disjoint regions of the sky.
+The manifest is a plain text file with a 'catalogue<TAB>file name<TAB>md5' line
+for each file, as jython has no json module."""
+import os
+
+import stilts
+
+import jy_tools as jt
+import table_io as t_io
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+PARENT = "sweep"
+
+
+def give_manifest_fpath():
+    """Provides the path of the manifest of the processed catalogue files."""
+    path = jt.GEN_CONFIG.get("PATHS", "match")
+    stem = jt.CUR_CONFIG.get("CAT_ASSEMBLY", "cat_stem")
+    return path + stem + "_ingest_manifest.txt"
+
+
+def give_file_checksum(fpath, blocksize=2**20):
+    """Returns the md5 checksum of the file at fpath."""
+    checksum = md5()
+    f = open(fpath, "rb")
+    try:
+        block = f.read(blocksize)
+        while block:
+            checksum.update(block)
+            block = f.read(blocksize)
+    finally:
+        f.close()
+    return checksum.hexdigest()
+
+
+def give_checksums(cats):
+    """Returns a dictionary with the catalogue names as keys and dictionaries of the
+    file names and checksums of the files read for them as values."""
+    checksums = {}
+    for name in cats:
+        checksums[name] = dict((fname, give_file_checksum(jt.CATPATH + name + "/" + fname))
+                               for fname in t_io.give_catalogue_fnames(name))
+    return checksums
+
+
+def read_manifest():
+    """Reads the manifest, returning None if there is none or if it can't be read
+    (e. g. if it has been written in an older format)."""
+    fpath = give_manifest_fpath()
+    if not os.path.isfile(fpath):
+        return None
+    manifest = {}
+    f = open(fpath, "r")
+    try:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 3:
+                jt.LOGGER.warning("Could not read the manifest at %s.", fpath)
+                return None
+            manifest.setdefault(fields[0], {})[fields[1]] = fields[2]
+    finally:
+        f.close()
+    return manifest
+
+
+def write_manifest(checksums):
+    """Writes the checksums of the processed files into the manifest."""
+    fpath = give_manifest_fpath()
+    f = open(fpath, "w")
+    try:
+        for name in sorted(checksums):
+            for fname in sorted(checksums[name]):
+                f.write("%s\t%s\t%s\n" % (name, fname, checksums[name][fname]))
+    finally:
+        f.close()
+    jt.LOGGER.info("Wrote the manifest of the processed catalogue files to %s", fpath)
+
+
+def give_rebuild_reasons(manifest, checksums):
+    """Returns the reasons why the processed tables need to be rebuilt from scratch
+    (removed or changed files, and new files of catalogues other than the parent)."""
+    reasons = []
+    for name in sorted(set(manifest) | set(checksums)):
+        known, files = manifest.get(name, {}), checksums.get(name, {})
+        for fname in sorted(known):
+            if fname not in files:
+                reasons.append("the %s file %s has been removed" % (name, fname))
+            elif files[fname] != known[fname]:
+                reasons.append("the %s file %s has changed" % (name, fname))
+        new_fnames = [fname for fname in sorted(files) if fname not in known]
+        if name != PARENT and new_fnames:
+            reasons.append("the %s files %s are new" % (name, ", ".join(new_fnames)))
+    return reasons
+
+
+def give_new_parent_fnames(manifest, checksums):
+    """Returns the names of the parent files that are not in the manifest."""
+    known = manifest.get(PARENT, {})
+    return [fname for fname in sorted(checksums.get(PARENT, {})) if fname not in known]
+
+
+def can_update_incrementally(checksums):
+    """Checks whether an incremental update is possible, i. e. whether a manifest and the
+    processed tables of a previous run are available, and whether nothing apart from
+    new parent files has been added since then (which would require a full rebuild)."""
+    fpaths = [give_manifest_fpath()] + \
+        [jt.give_processed_table_name(ttype) for ttype in ["pointlike", "extended"]]
+    manifest = None
+    if all([os.path.isfile(fpath) for fpath in fpaths]):
+        manifest = read_manifest()
+    if manifest is None:
+        return False
+    reasons = give_rebuild_reasons(manifest, checksums)
+    if reasons:
+        jt.LOGGER.warning("The tables are rebuilt from scratch as %s.", "; ".join(reasons))
+    return not reasons
+
+
+def give_max_ident(table):
+    """Returns the largest IDENT of the table (0 for an empty table)."""
+    if table.count_rows() == 0:
+        return 0
+    return int(table.cmd_keepcols("IDENT").cmd_stats("Maximum").getCell(0, 0))
+
+
+def append_processed_rows(old_tables, new_tables):
+    """Appends the rows of the new processed tables to the old ones."""
+    merged = {}
+    for ttype in ["pointlike", "extended"]:
+        old = old_tables[ttype]
+        colnames = [str(column.name) for column in old.columns()]
+        new = new_tables[ttype].cmd_keepcols(" ".join(colnames))
+        jt.LOGGER.info("Adding %d new rows to the %s table.", new.count_rows(), ttype)
+        merged[ttype] = old + new
+    return merged
+
+
+def write_merged_table(table, ttype):
+    """Writes the merged processed table, which is read from the file it replaces,
+    to a temporary file first."""
+    path = jt.give_processed_table_name(ttype)
+    table.write(path + ".tmp", fmt="fits")
+    os.remove(path)
+    os.rename(path + ".tmp", path)
+    jt.LOGGER.info("Successfully wrote the updated processed table to %s", path)
+
+
+def run_incremental_update(cats, checksums):
+    """Processes the new parent files (according to the checksums, see give_checksums) and
+    appends the results to the processed tables, which are written and returned (None
+    if nothing has changed)."""
+    new_fnames = give_new_parent_fnames(read_manifest(), checksums)
+    if not new_fnames:
+        jt.LOGGER.info("No new catalogue files found.")
+        return None
+    jt.LOGGER.info("New %s files: %s", PARENT, ", ".join(new_fnames))
+    tables = {}
+    for name in cats:
+        fnames = new_fnames if name == PARENT else None
+        tables[name] = t_io.pre_clean_table(name, t_io.read_table(name, fnames))
+    old_tables = dict((ttype, jt.read_processed_table(ttype))
+                      for ttype in ["pointlike", "extended"])
+    match = t_io.match_given_tables(tables)
+    with_sep = t_io.add_separation_columns(match)
+    new_tables = {}
+    new_tables["pointlike"], new_tables["extended"] = t_io.process_table(with_sep)
+    for ttype in ["pointlike", "extended"]:
+        # The IDENTs of the new sources continue after the existing ones
+        new_tables[ttype] = t_io.discard_problematic_matches(
+            new_tables[ttype], give_max_ident(old_tables[ttype]))
+    merged = append_processed_rows(old_tables, new_tables)
+    for ttype in ["pointlike", "extended"]:
+        write_merged_table(merged[ttype], ttype)
+    write_manifest(checksums)
+    return dict((ttype, jt.read_processed_table(ttype))
+                for ttype in ["pointlike", "extended"])
@@ -32,6 +32,13 @@ def init_logger():
 LOGGER = init_logger()
 
 
+def is_incremental():
+    """Checks whether the incremental ingestion is requested in the config (see the
+    incremental module)."""
+    return CUR_CONFIG.has_option("CAT_ASSEMBLY", "incremental") and \
+        CUR_CONFIG.getboolean("CAT_ASSEMBLY", "incremental")
+
+
 def stringlist_to_list(stringlist):
     """Transform a string that is in the "['a', 'b', 'c']" pattern into a list of strings ["a", "b", "c"].
     Handy to read out lists from config files."""
@@ -65,6 +72,14 @@ BAND_DICT = {}
 for pair in GEN_CONFIG.items("BAND_DICT"):
     BAND_DICT[pair[0]] = stringlist_to_list(pair[1])
 
+# Packed 64 bit source ID (RELEASE << 40 | BRICKID << 20 | OBJID) of the sweep sources,
+# carried as the sweep_ident column to identify them across catalogue versions, while
+# LePhare gets a compact running IDENT (the two are linked via the IDENT map)
+SOURCE_ID_EXPR = "(toLong(RELEASE) << 40) | (toLong(BRICKID) << 20) | toLong(OBJID)"
+# Selects the sources whose identifiers don't fit into their bits of the packed ID
+SOURCE_ID_OVERFLOW_EXPR = "RELEASE < 0 || RELEASE >= %d || BRICKID < 0 || BRICKID >= %d " \
+    "|| OBJID < 0 || OBJID >= %d" % (2**23, 2**20, 2**20)
+
 
 def give_nice_band_name(band, fluxtype="mag", err=False):
     """Helper function to unify band naming [SYNC with my_tools!]"""
@@ -177,6 +192,35 @@ def write_lephare_input(table, ttype):
         "The %s LePhare input table contains %d sources.", ttype, table.count_rows())
 
 
+def give_ident_map_name(ttype):
+    """Generates a uniform name for the table mapping the IDENTs of the LePhare input of
+    ttype to the packed sweep_idents [SYNC with my_tools!]"""
+    return give_lephare_filename(ttype, suffix="ident_map.fits")
+
+
+def write_ident_map(table, ttype):
+    """Writes the IDENT and sweep_ident columns of the processed table of type ttype,
+    so the LePhare output can be identified by the sweep_ident."""
+    path = give_ident_map_name(ttype)
+    table.cmd_keepcols("IDENT sweep_ident").write(path, fmt="fits")
+    LOGGER.debug("Successfully wrote the %s IDENT map to '%s'.", ttype, path)
+
+
+def add_sweep_idents(table, ttype):
+    """Adds the sweep_ident column to the LePhare output table of type ttype via the IDENT
+    map written with its input (the table is returned unchanged if there is none)."""
+    path = give_ident_map_name(ttype)
+    if not os.path.isfile(path):
+        LOGGER.warning("No IDENT map found at '%s', so the %s output has no sweep_ident.",
+                       path, ttype)
+        return table
+    colnames = [str(column.name) for column in table.columns()]
+    ident_map = change_colnames(stilts.tread(path, fmt="fits"), ["IDENT"], ["IDENT_map"])
+    table = stilts.tmatch2(in1=table, in2=ident_map, matcher="exact", values1="IDENT",
+                           values2="IDENT_map", join="all1", find="best")
+    return table.cmd_keepcols(" ".join(colnames + ["sweep_ident"]))
+
+
 def generate_info_text(pointlike, extended, stem):
     """Generates the text for the info file."""
     text = "Info on the matched and processed tables of '" + \
@@ -3,28 +3,33 @@ from sys import path as p
 
 import stilts
 
+import astrometric_offsets as a_o
 import jy_tools as jt
 
 p.append("C:/Program Files/Jystilts/stilts.jar")
 
 
+# Sky matching radii (in arcsec) of the catalogues matched to the parent catalogue
+MATCH_RADII = {"opt_agn": 0.1, "vhs": 0.5, "eros": 0.1, "hsc": 0.25, "galex": 3.5,
+               "kids": 1.5, "ls10": 0.1}
+
+
 # %% Reading and cleaning the tables before matching
-def read_table(name):
+def give_catalogue_fnames(name):
+    """Returns the names of the .fits files read for the catalogue in the jt.CATPATH/name
+    folder (all of them for sweep, the first one otherwise)."""
+    fnames = os.listdir(jt.CATPATH + name)
+    return fnames if name == "sweep" else fnames[:1]
+
+
+def read_table(name, fnames=None):
     """Returns a stilts table of the first .fits file in the jt.CATPATH/name
-    folder (sweep is different)"""
-    if name == "sweep":
-        tables = []
-        dirname = jt.CATPATH + "sweep"
-        for filename in os.listdir(dirname):
-            table = stilts.tread(jt.CATPATH + "sweep" +
-                                 "/" + filename, fmt="fits")
-            tables.append(table)
-        table = tables[0]
-        for t in tables[1:]:
-            table += t
-    else:  # Just take the first file of each directory
-        filename = os.listdir(jt.CATPATH + name)[0]
-        table = stilts.tread(jt.CATPATH + name + "/" + filename, fmt="fits")
+    folder (sweep is different), or of the given files of that folder concatenated."""
+    fnames = give_catalogue_fnames(name) if fnames is None else fnames
+    tables = [stilts.tread(jt.CATPATH + name + "/" + fname, fmt="fits") for fname in fnames]
+    table = tables[0]
+    for t in tables[1:]:
+        table += t
     return table
 
 
@@ -114,8 +119,12 @@ def clean_xray_agn(table):
 
 def clean_sweep(table):
     """Cleans the sweep table by selecting the relevant columns and by adding an ID column."""
-    # Generate an ID column from the three identifiers 'RELEASE BRICKID OBJID' mashed together
-    table = table.cmd_addcol("sweep_ident", 'concat(RELEASE, BRICKID, OBJID)')
+    # Generate a 64 bit ID column from the three identifiers 'RELEASE BRICKID OBJID'
+    num_overflow = table.cmd_select(jt.SOURCE_ID_OVERFLOW_EXPR).count_rows()
+    if num_overflow > 0:
+        raise ValueError("The identifiers of %d sweep sources are out of the range of the "
+                         "packed sweep_ident." % num_overflow)
+    table = table.cmd_addcol("sweep_ident", jt.SOURCE_ID_EXPR)
     columnlist = ["ra", "dec", "ra_ivar", "dec_ivar",
                   "type", "ebv", "ref_cat", "ref_id", "sweep_ident", "maskbits", "fitbits"]
     for band in jt.SWEEP_BANDS:
@@ -176,18 +185,17 @@ def match_given_tables(table_dict):
     """Performs the necessary matching while keeping all objects from the optical agn/sweep catalogue.
     Matches to all tables provided in table_list, but the optical agn as a default.
     Also filters irrelevant columns from the tables and puts them in a nice order"""
-    funcs = {"vhs": [match_table_vhs, 0.5],
-             "eros": [match_table_eros, 0.1],
-             "hsc": [match_table_hsc, 0.25],
-             "galex": [match_table_galex, 3.5],
-             "kids": [match_table_kids, 1.5],
-             "ls10": [match_table_ls10, 0.1]}
+    funcs = {"vhs": match_table_vhs,
+             "eros": match_table_eros,
+             "hsc": match_table_hsc,
+             "galex": match_table_galex,
+             "kids": match_table_kids,
+             "ls10": match_table_ls10}
     table = match_opt_agn_sweep(
-        table_dict["opt_agn"], table_dict["sweep"], 0.1)
-    for name, func in funcs.items():
+        table_dict["opt_agn"], table_dict["sweep"], MATCH_RADII["opt_agn"])
+    for name, matching_func in funcs.items():
         try:
-            matching_func = func[0]
-            radius = func[1]
+            radius = MATCH_RADII[name]
             if name == "galex":
                 table = matching_func(table, radius)
             else:
@@ -488,35 +496,15 @@ def convert_vega_mag_to_flux(point, extended):
 
 # %% Prepare the table for being written
 
-def discard_problematic_matches(table):
+def discard_problematic_matches(table, ident_offset=0):
     """Remove any matches that are too far out (adopting a circle around the systematic centre of the offsets).
-    In addition to that, an Identifier column is added."""
-    table = table.cmd_addcol("IDENT", "toInteger($index)")
-    # We want to use the medians as center points, and the stds as offsets
-    for cat in ["vhs", "galex"]:
-        cols_to_keep = "delta_ra_" + cat + " delta_dec_" + cat
-        stats = table.cmd_keepcols(cols_to_keep).cmd_stats("Median")
-        ra_med = stats.getCell(0, 0)
-        ra_expr = "delta_ra_" + cat + " - " + str(ra_med)
-        table = table.cmd_addcol("new_delta_ra_" + cat, ra_expr)
-        dec_med = stats.getCell(1, 0)
-        dec_expr = "delta_dec_" + cat + " - " + str(dec_med)
-        table = table.cmd_addcol("new_delta_dec_" + cat, dec_expr)
-        sep_expr = "sqrt(pow(new_delta_ra_" + cat + \
-            ", 2) + pow(new_delta_dec_" + cat + ", 2))"
-        table = table.cmd_addcol("true_sep_" + cat, sep_expr, "-units deg")
-        # Filter out anything that is at > 3 times the standard deviation
-        stdev = table.cmd_keepcols(
-            "true_sep_" + cat).cmd_stats("StDev").getCell(0, 0)
-        # Set the values with true_sep > 3*stdev to -99. so they aren't considered:
-        for band in jt.BAND_DICT[cat]:
-            expr = "true_sep_" + cat + " < " + \
-                str(3 * stdev) + " ? c_flux_" + band + " : -99."
-            table = table.cmd_replacecol("c_flux_" + band, expr)
-            err_expr = "true_sep_" + cat + " < " + \
-                str(3 * stdev) + " ? c_flux_err_" + band + " : -99."
-            table = table.cmd_replacecol("c_flux_err_" + band, err_expr)
-    return table
+    The centres and radii are determined robustly (median/MAD) for each HEALPix cell
+    and each of the matched surveys, see the astrometric_offsets module.
+    In addition to that, an Identifier column is added (starting after ident_offset).
+    It is kept as a compact 32 bit running number for LePhare, while the sources are
+    identified across catalogue versions by their packed sweep_ident column."""
+    table = table.cmd_addcol("IDENT", "toInteger($index + %d)" % ident_offset)
+    return a_o.discard_offset_outliers(table)
 
 
 def calculate_context(bands, excluded_bands):
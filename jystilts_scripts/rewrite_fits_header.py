@@ -27,6 +27,8 @@ def rewrite_output_file():
             "-name", jt.give_nice_band_name(band), "MAG_OBS" + str(i))
         table = table.cmd_colmeta(
             "-name", jt.give_nice_band_name(band, err=True), "ERR_MAG_OBS" + str(i))
+    # The packed sweep_ident identifies the sources across runs and catalogue versions
+    table = jt.add_sweep_idents(table, TTYPE)
     new_fpath = jt.give_lephare_filename(TTYPE, out=True, suffix="fits")
     table.write(new_fpath, fmt="fits")
 
@@ -2,8 +2,10 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import util.chunked_stats as c_s
 import util.configure_matplotlib as cm
 import util.my_tools as mt
+import util.synthetic_colours as s_c
 
 import output_scripts.specz_photz_plots as s_p
 import output_scripts.template_analysis_plots as ta
@@ -12,9 +14,23 @@ import output_scripts.template_analysis_plots as ta
 class OutputPlotContainer:
     """Convenience class containing the output- and template data."""
 
-    def __init__(self, save_figures=False):
-        self.df = mt.read_saved_df(cat_type="out")
-        # self.df = mt.read_saved_df(cat_type="in_processed")
+    def __init__(self, save_figures=False, rasterize=False, out_of_core=False):
+        # In the out-of-core mode, the statistics and template counts are aggregated chunk
+        # by chunk, and only the rows with good redshifts (which the plots use) are loaded:
+        self.out_of_core = out_of_core
+        self.template_counts = {}
+        if out_of_core:
+            stats, self.template_counts = c_s.give_chunked_output_aggregates()
+            for ttype, ttype_stats in stats.items():
+                stat_dict = ttype_stats.give_stat_dict()
+                mt.LOGGER.info("Chunk-wise statistics for %s: eta = %.4f, sig_NMAD = %.4f.",
+                               ttype, stat_dict["eta"], stat_dict["sig_nmad"])
+            columns = c_s.give_output_columns()
+            columns += [mt.give_nice_band_name(band) for band in mt.BAND_LIST]
+            columns += [mt.give_nice_band_name(band, err=True) for band in mt.BAND_LIST]
+            self.df = c_s.read_good_redshift_df(columns)
+        else:
+            self.df = mt.read_saved_df(cat_type="out")
         self.df_p = self.df[self.df["Type"] == "pointlike"]
         self.df_e = self.df[self.df["Type"] == "extended"]
         self.ext = "extended" in mt.USED_TTYPES
@@ -25,16 +41,29 @@ class OutputPlotContainer:
                 "Please specify a valid ttype [pointlike, extended or both] to plot the specz-photoz-plot.")
         self.stem = mt.CUR_CONFIG["LEPHARE"]["output_stem"]
         self.save_figures = save_figures
+        # Whether to draw the sources as rasterized density images:
+        self.rasterize = rasterize
+        # The data files, used to check whether existing figures are up to date:
+        self.dependencies = list(mt.give_saved_df_fpaths("out").values())
+        self.dependencies += [mt.give_temp_libname(ttype, "mag", suffix=".dat")
+                              for ttype in mt.USED_TTYPES]
         try:
             self.template_df = mt.read_template_library()
         except FileNotFoundError:
             mt.LOGGER.error("Couldn't locate template files.")
 
+    def _give_count_df(self, ttype):
+        """Returns the chunk-wise template counts for ttype (None if they have to be computed from the df)."""
+        if ttype not in self.template_counts:
+            return None
+        return self.template_counts[ttype].give_count_df()
+
     def _quicksave_fig(self, fig, name, dir_=""):
         """Shortcut to save a given figure in the correct dir"""
         if self.save_figures:
             dir_ = "/" + dir_ if dir_ != "" else ""
-            cm.save_figure(fig, name, f"output_analysis{dir_}", self.stem)
+            cm.save_figure(fig, name, f"output_analysis{dir_}", self.stem,
+                           dependencies=self.dependencies)
 
     def plot_specz_photo_z(self):
         """Wrapper function for producing specz_photo_z scatter plots"""
@@ -46,15 +75,17 @@ class OutputPlotContainer:
             s_p.set_subplot_positions(
                 main_plike, secondary_plike, is_left=True)
             s_p.set_subplot_positions(main_ext, secondary_ext, is_right=True)
-            s_p.plot_ttype(self.df, "pointlike", main_plike, secondary_plike)
-            s_p.plot_ttype(self.df, "extended", main_ext, secondary_ext)
+            s_p.plot_ttype(self.df, "pointlike", main_plike,
+                           secondary_plike, self.rasterize)
+            s_p.plot_ttype(self.df, "extended", main_ext,
+                           secondary_ext, self.rasterize)
             self._quicksave_fig(fig, "both_spec_z_phot_z")
             return
         fig, (main, secondary) = plt.subplots(
             2, 1, figsize=cm.set_figsize(width=0.5 * cm.LATEXWIDTH, height=0.5 * cm.LATEXWIDTH, fraction=1))
         s_p.set_subplot_positions(main, secondary)
         ttype = "extended" if self.ext else "pointlike"
-        s_p.plot_ttype(self.df, ttype, main, secondary)
+        s_p.plot_ttype(self.df, ttype, main, secondary, self.rasterize)
         self._quicksave_fig(fig, f"{ttype}_spec_z_phot_z")
 
     def plot_template_numbers(self):
@@ -62,13 +93,15 @@ class OutputPlotContainer:
         if self.produce_both:
             fig, (ax_plike, ax_ext) = plt.subplots(
                 1, 2, figsize=cm.set_figsize(height=2))
-            ta.plot_bar_template_outliers(self.df, ax_plike, "pointlike")
-            ta.plot_bar_template_outliers(self.df, ax_ext, "extended")
+            ta.plot_bar_template_outliers(
+                self.df, ax_plike, "pointlike", self._give_count_df("pointlike"))
+            ta.plot_bar_template_outliers(
+                self.df, ax_ext, "extended", self._give_count_df("extended"))
             self._quicksave_fig(fig, "both_used_templates", "templates")
             return
         fig, ax = plt.subplots(1, 1, figsize=cm.set_figsize(height=2))
         ttype = "extended" if self.ext else "pointlike"
-        ta.plot_bar_template_outliers(self.df, ax, ttype)
+        ta.plot_bar_template_outliers(self.df, ax, ttype, self._give_count_df(ttype))
         self._quicksave_fig(fig, f"{ttype}_used_templates", "templates")
 
     def plot_template_scores(self):
@@ -78,11 +111,17 @@ class OutputPlotContainer:
             ttype_list = ["pointlike", "extended"]
         for ttype in ttype_list:
             fig, ax = plt.subplots(1, 1, figsize=cm.set_figsize(height=2))
-            ta.plot_bar_template_scores(self.df, ax, ttype)
+            ta.plot_bar_template_scores(self.df, ax, ttype, self._give_count_df(ttype))
             self._quicksave_fig(
                 fig, f"score_plot_{ttype}", directory="templates")
 
-    def plot_color_vs_redshift(self, c1: str, c2: str, fitted_only=True, plot_sources=True, temp_nums: dict = None):
+    def give_synthetic_template_df(self):
+        """Computes the template magnitudes from the SEDs and filter curves (see
+        util.synthetic_colours) in the format of the template library."""
+        return pd.concat([s_c.compute_synthetic_colours(ttype).to_dataframe()
+                          for ttype in mt.USED_TTYPES if ttype != "star"])
+
+    def plot_color_vs_redshift(self, c1: str, c2: str, fitted_only=True, plot_sources=True, temp_nums: dict = None, use_synthetic=False):
         """Wrapper function to produce a color-redshift plot for the templates and sources.
         Parameters:
             c1: str
@@ -94,17 +133,21 @@ class OutputPlotContainer:
             plot_sources: bool=True
                 Scatter all sources with spec-z.
             temp_nums: dict<Int, str>
+            use_synthetic: bool=False
+                Use the template magnitudes computed from the SEDs instead of the magnitude library,
+                e.g. to explore new templates without running the template routine.
         """
-        temp_df = self.template_df[self.template_df["model"].apply(
-            lambda num: num in temp_nums)] if temp_nums is not None else self.template_df
+        template_df = self.give_synthetic_template_df() if use_synthetic else self.template_df
+        temp_df = template_df[template_df["model"].apply(
+            lambda num: num in temp_nums)] if temp_nums is not None else template_df
         if self.produce_both:
             fig, (ax_plike, ax_ext) = plt.subplots(1, 2, figsize=cm.set_figsize(
                 width=cm.LATEXWIDTH, height=0.5 * cm.LATEXWIDTH, fraction=1))
             fig.set_tight_layout(True)
             ta.plot_color_versus_redshift(
-                self.df, ax_plike, "pointlike", temp_df, c1, c2, fitted_only, plot_sources)
+                self.df, ax_plike, "pointlike", temp_df, c1, c2, fitted_only, plot_sources, self.rasterize)
             ta.plot_color_versus_redshift(
-                self.df, ax_ext, "extended", temp_df, c1, c2, fitted_only, plot_sources)
+                self.df, ax_ext, "extended", temp_df, c1, c2, fitted_only, plot_sources, self.rasterize)
             self._quicksave_fig(
                 fig, f"both_template_plot_{c1}-{c2}", directory="templates")
             return
@@ -112,7 +155,7 @@ class OutputPlotContainer:
             1, 1, figsize=cm.set_figsize(width=0.5 * cm.LATEXWIDTH, height=0.5 * cm.LATEXWIDTH, fraction=1))
         ttype = "extended" if self.ext else "pointlike"
         ta.plot_color_versus_redshift(
-            self.df, ax, ttype, temp_df, c1, c2, fitted_only, plot_sources)
+            self.df, ax, ttype, temp_df, c1, c2, fitted_only, plot_sources, self.rasterize)
         self._quicksave_fig(fig, f"{ttype}_template_plot_{c1}-{c2}")
 
 
@@ -0,0 +1,204 @@
+"""
+Module for comparing the LePhare outputs of two or more runs (output stems) source by source.
+
+Only the columns needed are read from the memory-mapped .fits outputs, and each run is
+aligned with the reference (first) run by the packed sweep_ident via the sorted ID index
+of its output (see util/source_index.py). As opposed to the IDENT, which is a running
+number of each catalogue assembly, it identifies the same source in runs based on
+different assemblies. Everything else is vectorized:
+    - the per-source differences in Z_BEST, CHI_BEST and MOD_BEST,
+    - the transition matrices between the photo-z classes (good, outlier, no fit)
+      of the sources with spec-z,
+    - the differences of eta and sig_NMAD grouped by the number of bands used, the
+      best-fit template of the reference run and the magnitude in the MAG_REF band.
+All of this is written into a single report, e.g. via
+    python -m output_scripts.run_comparison baseline_output new_templates_output
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import util.my_tools as mt
+import util.source_index as s_i
+from util import profiling
+
+# The column the runs are aligned by
+ID_COL = "sweep_ident"
+COMPARISON_COLUMNS = [ID_COL, "Z_BEST", "ZSPEC", "CHI_BEST", "MOD_BEST", "NBAND_USED"]
+# The photo-z classes of the sources with spec-z, used for the transition matrices
+CLASSES = ("good", "outlier", "no_fit")
+MAG_BINS = np.arange(16, 26, 1.)
+# Sources with |Z_BEST difference| / (1 + Z_BEST) above this are counted as changed
+CHANGE_THRESHOLD = 0.01
+
+
+def read_args():
+    """Reads out the arguments given by the user."""
+    parser = argparse.ArgumentParser(
+        description="Compare the LePhare outputs of two or more runs source by source.")
+    parser.add_argument("stems", type=str, nargs="+",
+                        help="Output stems of the runs, the first one is the reference.")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="Path of the report (next to the stats file by default).")
+    return parser.parse_args()
+
+
+def give_run_fpath(output_stem, ttype):
+    """Provides the path of the .fits output of ttype of the run with the given output stem."""
+    return mt.GEN_CONFIG.get("PATHS", "data") + f"lephare_output/{output_stem}_{ttype}.fits"
+
+
+def give_report_fpath(stems):
+    """Provides the default path of the report comparing the given runs."""
+    return mt.GEN_CONFIG["PATHS"]["params"] + "_vs_".join(stems) + "_comparison.txt"
+
+
+def give_ref_band(ttype):
+    """Returns the band used as MAG_REF for the absolute magnitude prior of ttype."""
+    mag_ref = mt.MAG_ABS_PRIORS.get(ttype, ("1",))[0]
+    return mt.BAND_LIST[int(mag_ref) - 1]
+
+
+def read_run(output_stem, ttype):
+    """Reads the columns needed for the comparison from the output of the given run."""
+    mag_col = mt.give_nice_band_name(give_ref_band(ttype))
+    fpath = give_run_fpath(output_stem, ttype)
+    if ID_COL not in mt.give_fits_column_names(fpath):
+        raise ValueError(f"The output {fpath} has no {ID_COL} column (it has been written "
+                         "without an IDENT map), so its sources can't be aligned reliably.")
+    df = mt.read_fits_as_dataframe(fpath, columns=COMPARISON_COLUMNS + [mag_col])
+    df = df[df[ID_COL] >= 0]
+    df = df.rename(columns={"Z_BEST": "ZBEST", mag_col: "MAG_REF"})
+    df["MAG_REF"] = df["MAG_REF"].where((df["MAG_REF"] > 0) & (df["MAG_REF"] < 50))
+    return mt.apply_dtype_plan(df)
+
+
+def give_photoz_classes(zbest, zspec):
+    """Returns the index (in CLASSES) of the photo-z class of each source."""
+    zbest, zspec = np.asarray(zbest), np.asarray(zspec)
+    is_outlier = np.abs(zbest - zspec) / (1 + zspec) > 0.15
+    return np.where(zbest <= 0, 2, is_outlier.astype(np.int8)).astype(np.int8)
+
+
+def give_transition_matrix(classes_ref, classes_new):
+    """Counts the sources going from each class of the reference run (rows) to each class
+    of the new run (columns)."""
+    num = len(CLASSES)
+    counts = np.bincount(classes_ref.astype(np.int64) * num + classes_new, minlength=num**2)
+    return pd.DataFrame(counts.reshape(num, num), index=[f"ref {c}" for c in CLASSES],
+                        columns=[f"new {c}" for c in CLASSES])
+
+
+def align_runs(ref_df, new_df, new_fpath=None):
+    """Joins the sources of both runs by their sweep_ident, the columns of the reference run
+    get a '_ref' and those of the new run a '_new' suffix (ZSPEC is only kept once)."""
+    comp = s_i.join_tables(ref_df, new_df.drop(columns="ZSPEC"), right_fpath=new_fpath,
+                           suffixes=("_ref", "_new"), id_col=ID_COL)
+    fitted = (comp["ZBEST_ref"] > 0) & (comp["ZBEST_new"] > 0)
+    comp["dZ"] = (comp["ZBEST_new"] - comp["ZBEST_ref"]).where(fitted)
+    comp["dZ_norm"] = comp["dZ"] / (1 + comp["ZBEST_ref"])
+    comp["dCHI"] = (comp["CHI_BEST_new"] - comp["CHI_BEST_ref"]).where(fitted)
+    comp["ModChanged"] = comp["MOD_BEST_new"] != comp["MOD_BEST_ref"]
+    return comp
+
+
+def give_delta_summary(comp):
+    """Summarizes the per-source differences of the aligned runs."""
+    fitted = comp["dZ"].notna()
+    abs_dz = comp.loc[fitted, "dZ_norm"].abs()
+    return pd.Series({
+        "common sources": len(comp),
+        "fitted in both": fitted.sum(),
+        "fitted in ref only": ((comp["ZBEST_ref"] > 0) & (comp["ZBEST_new"] <= 0)).sum(),
+        "fitted in new only": ((comp["ZBEST_ref"] <= 0) & (comp["ZBEST_new"] > 0)).sum(),
+        f"|dZ|/(1+z) > {CHANGE_THRESHOLD}": (abs_dz > CHANGE_THRESHOLD).sum(),
+        "median |dZ|/(1+z)": abs_dz.median(),
+        "95th perc. |dZ|/(1+z)": abs_dz.quantile(0.95),
+        "mean dCHI_BEST": comp["dCHI"].mean(),
+        "median dCHI_BEST": comp["dCHI"].median(),
+        "MOD_BEST changed": comp.loc[fitted, "ModChanged"].sum()})
+
+
+def give_run_statistics(comp, suffix):
+    """Returns the output statistics of one of the aligned runs on the common sources."""
+    df = comp[["ZSPEC", "CHI_BEST" + suffix]].rename(columns={"CHI_BEST" + suffix: "CHI_BEST"})
+    df["ZBEST"] = comp["ZBEST" + suffix]
+    return mt.give_output_statistics(mt.add_outlier_information(df))
+
+
+def give_grouped_metrics(comp, key, bins=None):
+    """Returns the number of sources with spec-z fitted in both runs, and eta and sig_NMAD
+    of both runs and their differences for each group of the key column (binned by
+    bins if given)."""
+    good = comp[(comp["ZSPEC"] > 0) & comp["dZ"].notna()]
+    groups = good[key] if bins is None else pd.cut(good[key], bins)
+    frame = pd.DataFrame({"group": groups})
+    for suffix in ("_ref", "_new"):
+        measure = (good["ZBEST" + suffix] - good["ZSPEC"]) / (1 + good["ZSPEC"])
+        frame["eta" + suffix] = measure.abs() > 0.15
+        frame["abs_measure" + suffix] = measure.abs()
+    grouped = frame.groupby("group", observed=True)
+    metrics = pd.DataFrame({"N": grouped.size()})
+    for suffix in ("_ref", "_new"):
+        metrics["eta" + suffix] = grouped["eta" + suffix].mean()
+        metrics["sig_nmad" + suffix] = 1.45 * grouped["abs_measure" + suffix].median()
+    metrics["d_eta"] = metrics["eta_new"] - metrics["eta_ref"]
+    metrics["d_sig_nmad"] = metrics["sig_nmad_new"] - metrics["sig_nmad_ref"]
+    return metrics
+
+
+def give_comparison_text(comp, ttype, ref_stem, new_stem):
+    """Returns the section of the report comparing the two aligned runs for ttype."""
+    stats = pd.DataFrame({ref_stem: give_run_statistics(comp, "_ref"),
+                          new_stem: give_run_statistics(comp, "_new")})
+    stats["difference"] = stats[new_stem] - stats[ref_stem]
+    with_specz = comp["ZSPEC"].to_numpy() > 0
+    zspec = comp["ZSPEC"].to_numpy()[with_specz]
+    matrix = give_transition_matrix(
+        give_photoz_classes(comp["ZBEST_ref"].to_numpy()[with_specz], zspec),
+        give_photoz_classes(comp["ZBEST_new"].to_numpy()[with_specz], zspec))
+    sections = [
+        ("Statistics on the common sources", stats.to_string(float_format="%.4f")),
+        ("Per-source differences", give_delta_summary(comp).to_string()),
+        ("Transitions of the sources with spec-z", matrix.to_string()),
+        ("By number of bands used (ref)",
+         give_grouped_metrics(comp, "NBAND_USED_ref").to_string(float_format="%.4f")),
+        ("By best-fit template (ref)",
+         give_grouped_metrics(comp, "MOD_BEST_ref").to_string(float_format="%.4f")),
+        (f"By {give_ref_band(ttype)} magnitude",
+         give_grouped_metrics(comp, "MAG_REF_ref", MAG_BINS).to_string(float_format="%.4f"))]
+    text = f"===== {ttype}: {new_stem} vs. {ref_stem} =====\n"
+    return text + "".join(f"\n--- {title} ---\n{table}\n" for title, table in sections)
+
+
+@profiling.profile_stage()
+def compare_runs(stems, report_fpath=None):
+    """Compares the outputs of the runs with the given output stems to those of the first
+    one for each of the used ttypes and writes a single report.
+    returns:
+        The path of the report."""
+    assert len(stems) > 1, "At least two output stems are needed for a comparison."
+    report_fpath = give_report_fpath(stems) if report_fpath is None else report_fpath
+    ref_stem = stems[0]
+    texts = []
+    for ttype in mt.USED_TTYPES:
+        ref_df = read_run(ref_stem, ttype)
+        profiling.record_rows(len(ref_df))
+        for new_stem in stems[1:]:
+            new_df = read_run(new_stem, ttype)
+            profiling.record_rows(len(new_df))
+            comp = align_runs(ref_df, new_df, give_run_fpath(new_stem, ttype))
+            mt.LOGGER.info("Aligned %d of the %d (ref) and %d (new) %s sources of %s and %s.",
+                           len(comp), len(ref_df), len(new_df), ttype, ref_stem, new_stem)
+            texts.append(give_comparison_text(comp, ttype, ref_stem, new_stem))
+    with open(report_fpath, "w", encoding="utf-8") as f:
+        f.write(f"Comparison of the runs {', '.join(stems)} (reference: {ref_stem})\n\n")
+        f.write("\n\n".join(texts))
+    mt.LOGGER.info("Wrote the comparison report to %s.", report_fpath)
+    return report_fpath
+
+
+if __name__ == "__main__":
+    ARGS = read_args()
+    compare_runs(ARGS.stems, ARGS.output)
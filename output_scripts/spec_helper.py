@@ -158,19 +158,25 @@ class Spectrum:
     """Convenience class containing the spectrum, responsible for
     producing the plots."""
 
-    def __init__(self, fname: str, args: argparse.Namespace):
+    def __init__(self, fname: str, args: argparse.Namespace, plot=True):
         with open(fname, "r") as f:
             lines = f.readlines()
         self.y_is_mag = args.ytype == YAxisUnit.mag  # flux or mag for y axis
         self.args = args
         self.fontsize = 20
+        self.parse(lines)
+        if plot:
+            self._init_plot()
+            self._plot_data()
+
+    def parse(self, lines):
+        """Reads the general info, models, filters, PDF and model spectra from the lines
+        of a .spec file."""
         self._read_general_info(lines)
         self._read_model_params(lines)
         self._read_filter_data(lines)
         self._read_pdf_data(lines)
         self._read_model_data(lines)
-        self._init_plot()
-        self._plot_data()
 
     def _read_general_info(self, lines):
         self.id = lines[1].split()[0]
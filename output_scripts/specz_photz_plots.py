@@ -6,11 +6,19 @@ import util.my_tools as mt
 from matplotlib.offsetbox import AnchoredText
 
 
-def make_scatter_plots(df, main_ax, secondary_ax, color="k"):
+def make_scatter_plots(df, main_ax, secondary_ax, color="k", rasterize=False):
     """Makes a scatter plot of the ZSPEC vs the ZBEST column on the given ax.
-    Distinguishes the i and non-i-band."""
+    Distinguishes the i and non-i-band.
+    If rasterize is True, the points are drawn as rasterized density images."""
     markerstyle = "."
     size = 1
+    if rasterize:
+        goods, outliers = df[~df["IsOutlier"]], df[df["IsOutlier"]]
+        cm.plot_points(main_ax, goods["ZSPEC"], goods["ZBEST"], color, markerstyle, size)
+        cm.plot_points(main_ax, outliers["ZSPEC"], outliers["ZBEST"], color, markerstyle, size,
+                       alpha=0.7)
+        cm.plot_points(secondary_ax, df["ZSPEC"], df["ZMeasure"], color, markerstyle, size)
+        return
     df[~df["IsOutlier"]].plot.scatter("ZSPEC", "ZBEST", s=size,  # label=label,
                                       color=color, ax=main_ax, marker=markerstyle)
     df[df["IsOutlier"]].plot.scatter(
@@ -80,19 +88,20 @@ def set_subplot_positions(main, secondary, is_left=False, is_right=False):
     secondary.set_position(rect_secondary)
 
 
-def plot_ttype(df, ttype, main, secondary):
+def plot_ttype(df, ttype, main, secondary, rasterize=False):
     """Wrapper function to filter the df for the ttype and plot it on the given axes"""
     df = df[df["HasGoodz"]]
     df = df[df["Type"] == ttype]
-    make_scatter_plots(df, main, secondary)
+    make_scatter_plots(df, main, secondary, rasterize=rasterize)
     main.set_title(mt.give_plot_title(ttype, True))
     max_z = 5 if ttype == "pointlike" else 2
     plot_auxiliary_lines(main, secondary, max_z,
                          label=mt.give_photoz_performance_label(df))
 
 
-def plot_photoz_vs_specz(df, ttype="both"):
-    """Makes a scatter plot of photo z vs spectro-z."""
+def plot_photoz_vs_specz(df, ttype="both", rasterize=False):
+    """Makes a scatter plot of photo z vs spectro-z (with the sources drawn as rasterized
+    density images if rasterize is True)."""
     df = df[df["HasGoodz"]]
     if ttype == "both":
         fig, axes = plt.subplots(2, 2, figsize=cm.set_figsize(
@@ -101,13 +110,13 @@ def plot_photoz_vs_specz(df, ttype="both"):
         main_ext, secondary_ext = axes[1]
         set_subplot_positions(main_plike, secondary_plike, is_left=True)
         set_subplot_positions(main_ext, secondary_ext, is_right=True)
-        plot_ttype(df, "pointlike", main_plike, secondary_plike)
-        plot_ttype(df, "extended", main_ext, secondary_ext)
+        plot_ttype(df, "pointlike", main_plike, secondary_plike, rasterize)
+        plot_ttype(df, "extended", main_ext, secondary_ext, rasterize)
     elif ttype is not None:
         fig, (main, secondary) = plt.subplots(
             2, 1, figsize=cm.set_figsize(width=0.5 * cm.LATEXWIDTH, height=0.5 * cm.LATEXWIDTH, fraction=1))
         set_subplot_positions(main, secondary)
-        plot_ttype(df, ttype, main, secondary)
+        plot_ttype(df, ttype, main, secondary, rasterize)
     else:
         mt.LOGGER.error(
             "Please specify a valid ttype [pointlike, extended or both] to plot the specz-photoz-plot.")
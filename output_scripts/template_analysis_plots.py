@@ -12,8 +12,9 @@ from matplotlib.transforms import Bbox
 
 def plot_color_versus_redshift(df: pd.DataFrame, ax, ttype: str,
                                temp_df: pd.DataFrame, c1: str, c2: str,
-                               fitted_only: bool, plot_sources: bool):
-    """Produce a color-redshift plot of colors c1-c2 for the sources and templates. """
+                               fitted_only: bool, plot_sources: bool, rasterize: bool = False):
+    """Produce a color-redshift plot of colors c1-c2 for the sources and templates.
+    If rasterize is True, the sources are drawn as rasterized density images."""
     # Select a subset of the source dataframe with valid spec-z and actual data points in both of the requested bands
     df = df[df["Type"] == ttype]
     temp_df = temp_df[temp_df["Type"] == ttype]
@@ -57,6 +58,10 @@ def plot_color_versus_redshift(df: pd.DataFrame, ax, ttype: str,
         if len(y) > 0:
             ymin = min(ymin, min(y))
             ymax = max(ymax, max(y))
+            if rasterize:
+                cm.plot_points(ax, z, y, style[0], style[1], 1,
+                               label=f"{label} ({len(y)})", alpha=0.5)
+                continue
             ax.plot(z, y, style, markersize=1,
                     label=f"{label} ({len(y)})", alpha=0.5)
     ax.set_ylim(floor(ymin * 2) / 2, ceil(ymax * 2) / 2)
@@ -134,9 +139,10 @@ def give_score_for_template(df, temp_num):
     return sum(outlier_scores) / len(subset)
 
 
-def give_templates_to_keep(df, ttype, removal_frac=0.25):
-    """Returns a list of the templates to keep via score selection + the a list of the discarded templates"""
-    count_df = give_count_df(df, ttype)
+def give_templates_to_keep(df, ttype, removal_frac=0.25, count_df=None):
+    """Returns a list of the templates to keep via score selection + the a list of the discarded templates.
+    A precomputed count_df (without threshold) can be provided instead of the df."""
+    count_df = give_count_df(df, ttype) if count_df is None else count_df.copy()
     count_df.sort_values("Score", inplace=True, ascending=False)
     quartil = int(len(count_df) * (1 - removal_frac))
     temps_to_keep = pd.concat(
@@ -145,10 +151,10 @@ def give_templates_to_keep(df, ttype, removal_frac=0.25):
     return [temp_num for temp_num in temps_to_keep.index]
 
 
-def give_templates_to_drop(df, ttype, removal_frac=0.25):
+def give_templates_to_drop(df, ttype, removal_frac=0.25, count_df=None):
     """Returns the a list of the discarded templates"""
-    count_df = give_count_df(df, ttype)
-    temps_to_keep = give_templates_to_keep(df, ttype, removal_frac)
+    count_df = give_count_df(df, ttype) if count_df is None else count_df
+    temps_to_keep = give_templates_to_keep(df, ttype, removal_frac, count_df)
     # Find the dropped templates:
     ds1, ds2 = set(count_df.index), set(temps_to_keep)
     discarded_temps = ds1.difference(ds2)
@@ -175,9 +181,14 @@ def give_count_df(df, ttype: str, threshold_factor=0):
     both["Score"] = both.index.map(
         lambda temp_num: give_score_for_template(df, temp_num))
     both["Bad_frac"] = both["Bad"].fillna(0) / both["Total"]
+    return apply_count_threshold(both, ttype, threshold_factor)
+
+
+def apply_count_threshold(both, ttype: str, threshold_factor=0):
+    """Combines the models of a count dataframe that were matched less often than
+    threshold_factor times the most used one into a single 'Other' row."""
     if threshold_factor == 0:
         return both
-    # Otherwise, adopt a threshold and a column containing 'other' templates.
     threshold = max(1, max(both["Total"]) * threshold_factor)
     mt.LOGGER.info(
         "Adopting threshold (number of most occurences for models to be combined in 'other') of %.0f for %s.", threshold, ttype)
@@ -195,11 +206,13 @@ def give_count_df(df, ttype: str, threshold_factor=0):
     return both
 
 
-def plot_bar_template_outliers(df, ax, ttype):
-    """Produce a bar plot on the given ax for the templates of ttype."""
-    df = df[df["Type"] == ttype]
-    df = df[df["HasGoodz"]]
-    both = give_count_df(df, ttype, threshold_factor=0.05)
+def plot_bar_template_outliers(df, ax, ttype, count_df=None):
+    """Produce a bar plot on the given ax for the templates of ttype.
+    A precomputed count_df (without threshold) can be provided instead of the df."""
+    if count_df is None:
+        both = give_count_df(df, ttype, threshold_factor=0.05)
+    else:
+        both = apply_count_threshold(count_df, ttype, threshold_factor=0.05)
     labels = both.index
 
     x = np.arange(len(labels))
@@ -221,9 +234,10 @@ def plot_bar_template_outliers(df, ax, ttype):
     return both
 
 
-def plot_bar_template_scores(df, ax, ttype):
-    """Plot the scores of the templates in a bar plot."""
-    count_df = give_count_df(df, ttype)
+def plot_bar_template_scores(df, ax, ttype, count_df=None):
+    """Plot the scores of the templates in a bar plot.
+    A precomputed count_df (without threshold) can be provided instead of the df."""
+    count_df = give_count_df(df, ttype) if count_df is None else count_df.copy()
     count_df.sort_values("Score", inplace=True, ascending=False)
     labels = count_df.index
 
@@ -253,7 +267,7 @@ def plot_bar_template_scores(df, ax, ttype):
     ax.grid(True, axis="y")
     ax.set_xticklabels(list(labels), minor=False, rotation=90, )
     dropping = [str(temp_num)
-                for temp_num in sorted(give_templates_to_drop(df, ttype))]
+                for temp_num in sorted(give_templates_to_drop(df, ttype, count_df=count_df))]
     drop_text = "Dropping:\n"
     for i, temp_num in enumerate(dropping):
         if i % 5 == 0 and i != 0:
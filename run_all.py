@@ -11,45 +11,69 @@ import util.runner_commands as r_c
 from input_scripts.input_plot_container import InputPlotContainer
 from output_scripts.output_plot_container import OutputPlotContainer
 from util.assert_config import assert_all
+from util import profiling
+from util.plot_scheduler import PlotScheduler
 
 # %%
 
 
 if __name__ == "__main__":
     mt.log_run_info()
-    assert_all()
+    with profiling.stage("assert_all"):
+        assert_all()
 
     if mt.CUR_CONFIG["CAT_ASSEMBLY"].getboolean("assemble_cat"):
         r_c.assemble_catalog()
 
     r_c.run_lephare_commands()
 
-    # Input-related plots:
-    i_p_c = InputPlotContainer(True)
+    # Both containers are loaded once and their plots are produced by the scheduler:
     plot_con = mt.CUR_CONFIG["PLOTTING"]
+    scheduler = PlotScheduler(plot_con.getint("num_processes", fallback=1))
+    out_of_core = plot_con.getboolean("out_of_core", fallback=False)
+
+    # Input-related plots:
+    with profiling.stage("load_input_container"):
+        input_args = (True, out_of_core)
+        scheduler.add_container("input", InputPlotContainer(*input_args),
+                                factory=(InputPlotContainer, input_args, {}))
 
     if plot_con.getboolean("input"):
-        i_p_c.plot_input_dist(context=mt.CONTEXT)
-        i_p_c.plot_magnitude_dist(context=mt.CONTEXT)
+        scheduler.add_task("input", "plot_input_dist", context=mt.CONTEXT)
+        scheduler.add_task("input", "plot_magnitude_dist", context=mt.CONTEXT)
 
     if plot_con.getboolean("sep"):
         radius_dict = {"vhs": 0.5, "eros": 0.1, "hsc": 0.25,
                        "galex": 3.5, "kids": 1.5}
-        i_p_c.plot_separation(radius_dict)
+        # Each survey can be plotted separately:
+        for survey_name, radius in radius_dict.items():
+            scheduler.add_task("input", "plot_separation", {survey_name: radius})
 
     if plot_con.getboolean("filters"):
-        i_p_c.plot_filters()
+        scheduler.add_task("input", "plot_filters")
 
     # Output-related plots:
-    o_p_c = OutputPlotContainer(True)
+    with profiling.stage("load_output_container"):
+        output_kwargs = {"rasterize": plot_con.getboolean("rasterize", fallback=False),
+                         "out_of_core": out_of_core}
+        scheduler.add_container("output", OutputPlotContainer(True, **output_kwargs),
+                                factory=(OutputPlotContainer, (True,), output_kwargs))
 
     if plot_con.getboolean("output"):
-        o_p_c.plot_specz_photo_z()
-        o_p_c.plot_template_numbers()
+        scheduler.add_task("output", "plot_specz_photo_z")
+        scheduler.add_task("output", "plot_template_numbers")
 
     if plot_con.getboolean("template"):
-        o_p_c.plot_color_vs_redshift("g", "r")
-        o_p_c.plot_template_scores()
+        scheduler.add_task("output", "plot_color_vs_redshift", "g", "r")
+        scheduler.add_task("output", "plot_template_scores")
+
+    with profiling.stage("plotting"):
+        failed_plots = scheduler.run()
+
+    profiling.write_report(mt.give_profile_fname())
+    if failed_plots:
+        raise RuntimeError(f"{len(failed_plots)} plot tasks failed: " +
+                           ", ".join(description for description, _ in failed_plots))
 
     # # %%
     # # Construct the input dataframe:
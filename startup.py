@@ -162,6 +162,12 @@ config["GENERAL"] = {
     "use_extended": True,
     "print_commands_only": False,
     "ask_overwrite": True,
+    # One of ask, overwrite, skip, skip_if_fresh, version or fail:
+    "overwrite_policy": "ask",
+    # Share the output, input and template tables between analysis processes as
+    # memory-mapped column files, evicting the least recently used ones above the size limit:
+    "dataset_cache": False,
+    "dataset_cache_gb": 8,
 }
 
 
@@ -173,6 +179,9 @@ config["CAT_ASSEMBLY"] = {
     "reduce_to_specz": False,
     "write_lephare_input": True,
     "write_info_file": True,
+    # Only process new sweep files, appending them to the processed tables (anything else
+    # triggers a full rebuild):
+    "incremental": False,
 }
 
 config["LEPHARE"] = {
@@ -187,6 +196,32 @@ config["LEPHARE"] = {
     "input_stem": "baseline",
     "output_stem": "baseline",
     "spec_out": False,
+    # Flag input sources with an rms colour distance to the templates above this (0 to disable):
+    "triage_threshold": 0,
+    # Backend for the photo-z fit, either lephare (zphota) or python (util/photoz_fitter.py):
+    "zphota_backend": "lephare",
+    # Number of processes used by the python backend:
+    "fit_processes": 1,
+    # Coarse-to-fine redshift search of the python backend (evaluating every n-th z step
+    # first, 1 for the exhaustive search), number of basins refined per source and their
+    # maximum chi2 difference to the best basin:
+    "fit_coarse_factor": 1,
+    "fit_top_k": 5,
+    "fit_tolerance": 25,
+    # Compare the coarse-to-fine search to the exhaustive one and write a validation report:
+    "fit_validate_search": False,
+    # Run the LePhare commands as a dependency graph with streamed output, overlapping
+    # the independent jobs of different ttypes:
+    "supervised": False,
+    # Maximum number of jobs running at once and the timeout of each job (in s, 0 for none):
+    "max_parallel_jobs": 2,
+    "job_timeout": 0,
+    # Maximum number of zphota fits running at once (the post-processing of a fit
+    # overlaps with the next one):
+    "max_parallel_fits": 1,
+    # Only fit the sources whose inputs or fit configuration changed since the last run,
+    # taking the results of the others from the fit cache:
+    "fit_cache": False,
 }
 
 config["PLOTTING"] = {
@@ -195,6 +230,10 @@ config["PLOTTING"] = {
     "filters": False,
     "output": True,
     "template": False,
+    "rasterize": False,
+    "num_processes": 1,
+    # Aggregate the catalogues chunk by chunk instead of loading them completely:
+    "out_of_core": False,
 }
 
 
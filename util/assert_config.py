@@ -46,11 +46,6 @@ def assert_catalog_assembly():
             mt.assert_file_exists(mt.give_processed_table_name(
                 "extended"), "processed extended")
 
-        if mt.CUR_CONFIG["CAT_ASSEMBLY"].getboolean("write_lephare_input"):
-            if use_plike:
-                mt.assert_file_overwrite(mt.give_lephare_filename("pointlike"))
-            if use_ext:
-                mt.assert_file_overwrite(mt.give_lephare_filename("extended"))
 
 # %% Assert LePhare stuff
 
@@ -111,6 +106,41 @@ def assert_plots():
 # mt.CUR_CONFIG["PLOTTING"].getboolean("template")
 
 
+# %% Overwrite planning:
+def plan_overwrites():
+    """Decides up front for all files produced in this run whether they may be
+    overwritten, so the run does not stop mid-way waiting for user input.
+    The files are planned in the order they are produced, so outputs depending
+    on rewritten files are never considered fresh."""
+    planned = []
+    cat_con = mt.CUR_CONFIG["CAT_ASSEMBLY"]
+    if cat_con.getboolean("write_lephare_input"):
+        planned += [(mt.give_lephare_filename(ttype), [mt.give_processed_table_name(ttype)])
+                    for ttype in mt.USED_TTYPES]
+    lep_con = mt.CUR_CONFIG["LEPHARE"]
+    if lep_con.getboolean("run_templates"):
+        ttypes = list(mt.USED_TTYPES)
+        if isfile(mt.give_temp_listname("star")):
+            ttypes.append("star")
+        planned += [(mt.give_temp_libname(ttype, "mag", suffix=".dat"),
+                     mt.give_template_dependencies(ttype)) for ttype in ttypes]
+    if lep_con.getboolean("run_zphota"):
+        planned += [(mt.give_lephare_filename(ttype, out=True), mt.give_zphota_dependencies(ttype))
+                    for ttype in mt.USED_TTYPES]
+    # Files that are versioned are only moved right before they are written
+    for fpath, dependencies in planned:
+        mt.assert_file_overwrite(fpath, dependencies, planning=True)
+    # The plot names are only known when producing them, so the user is asked once
+    # whether to overwrite or keep all existing ones:
+    plot_con = mt.CUR_CONFIG["PLOTTING"]
+    plotting = any(plot_con.getboolean(key, fallback=False)
+                   for key in ["input", "sep", "filters", "output", "template"])
+    if plotting and mt.give_overwrite_policy() == "ask":
+        plotpath = mt.GEN_CONFIG["PATHS"]["plot"]
+        overwrite = mt.get_yes_no_input(f"Overwrite existing plots in '{plotpath}'?")
+        mt.PLOT_OVERWRITE_POLICY = "overwrite" if overwrite else "skip"
+
+
 def assert_all():
     """Goes through all config assertion functions."""
     assert_general()
@@ -118,3 +148,4 @@ def assert_all():
     assert_lephare_assembly()
     assert_plots()
     mt.LOGGER.info("All assertions have been successful.")
+    plan_overwrites()
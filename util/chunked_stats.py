@@ -0,0 +1,403 @@
+"""
+Helper module for analysing catalogues that are too large to be loaded into memory.
+
+The fits files are memory-mapped and read in chunks of rows (and only the columns
+needed), and each chunk updates mergeable aggregates (counters and fixed-bin
+histograms) which provide the same results as the DataFrame-based functions
+used by the plot containers:
+    OutputStatistics -> mt.give_output_statistics (with a quantile sketch for sig_NMAD)
+    TemplateCounts -> ta.give_count_df
+    BandSummary -> the availability and magnitude distribution plots
+Each aggregate can be updated with DataFrame chunks and merged with another one,
+e.g. one computed on a different file or in a different process.
+"""
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+import util.my_tools as mt
+from util import profiling
+from util.quantile_sketch import KLLSketch, merge_sketches
+
+DEFAULT_CHUNKSIZE = 500000
+# The magnitude bins used for the magnitude distribution plots
+MAG_BINS = np.arange(10, 25, 0.5)
+# The bit of the availability patterns marking sources with spec-z
+ZSPEC_BIT = len(mt.BAND_LIST)
+
+
+def give_fits_colnames(fname):
+    """Returns the column names of the first table extension of the given fits file."""
+    with fits.open(fname, memmap=True) as hdul:
+        return list(hdul[1].columns.names)
+
+
+def iter_fits_chunks(fname, columns=None, chunksize=DEFAULT_CHUNKSIZE, row_filter=None):
+    """Iterates over a memory-mapped fits file and yields DataFrames of consecutive chunks of rows.
+    parameters:
+        [columns]: list<str>
+            Only decode these columns (all if None). Columns that are not in the file
+            are skipped, and the matching is case-insensitive.
+        [chunksize]: int
+            The maximum number of rows of each chunk.
+        [row_filter]: callable
+            Function taking a chunk of the FITS_rec and returning a boolean mask
+            of the rows to keep (see mt.read_fits_as_dataframe).
+    """
+    with fits.open(fname, memmap=True) as hdul:
+        data = hdul[1].data
+        available = {name.lower(): name for name in data.columns.names}
+        names = list(available.values()) if columns is None else \
+            [available[col.lower()] for col in columns if col.lower() in available]
+        for start in range(0, len(data), chunksize):
+            chunk = data[start:start + chunksize]
+            mask = None if row_filter is None else np.asarray(row_filter(chunk), dtype=bool)
+            col_dict = {}
+            for name in names:
+                array = chunk[name]
+                if array.ndim > 1:
+                    continue
+                if mask is not None:
+                    array = array[mask]
+                col_dict[name] = mt.give_native_column(data.columns[name], array)
+            yield pd.DataFrame(col_dict)
+
+
+def give_output_columns():
+    """Returns the columns needed for the chunk-wise output statistics."""
+    return ["Z_BEST", "ZSPEC", "CHI_BEST", "MOD_BEST"]
+
+
+def give_input_columns():
+    """Returns the columns needed to construct a BandSummary of the processed input tables."""
+    columns = ["ZSPEC"]
+    for band in mt.BAND_LIST:
+        band = band.replace('-', '_')
+        columns += [f"c_flux_{band}", f"c_flux_err_{band}"]
+    return columns
+
+
+def iter_saved_df_chunks(cat_type="out", columns=None, chunksize=DEFAULT_CHUNKSIZE):
+    """Chunk-wise equivalent of mt.read_saved_df, yielding (ttype, DataFrame) pairs.
+    Only the given columns are read, the outlier information (output) or the
+    magnitude columns (input) are added for each chunk."""
+    is_out = (cat_type == "out")
+    if columns is None:
+        columns = give_output_columns() if is_out else give_input_columns()
+    for ttype, fpath in mt.give_saved_df_fpaths(cat_type).items():
+        for df in iter_fits_chunks(fpath, columns, chunksize):
+            df["Type"] = mt.give_ttype_column(ttype, len(df))
+            df = mt.add_outlier_information(df) if is_out else mt.add_mag_columns(df)
+            profiling.record_rows(len(df))
+            yield ttype, mt.apply_dtype_plan(df)
+
+
+class OutputStatistics:
+    """Mergeable counterpart of mt.give_output_statistics for the sources with good redshifts."""
+
+    def __init__(self):
+        self.source_num = 0
+        self.outliers = 0
+        self.false_pos = 0
+        self.false_neg = 0
+        self.abs_zmeasure = KLLSketch()
+
+    def update(self, df):
+        """Adds a chunk of an output DataFrame with outlier information."""
+        df = df[df["HasGoodz"]]
+        self.source_num += len(df)
+        self.outliers += int(df["IsOutlier"].sum())
+        self.false_pos += int(df["IsFalsePositive"].sum())
+        self.false_neg += int(df["IsFalseNegative"].sum())
+        self.abs_zmeasure.update(np.abs(df["ZMeasure"].to_numpy()))
+
+    def merge(self, other):
+        """Adds the counts of another OutputStatistics instance."""
+        self.source_num += other.source_num
+        self.outliers += other.outliers
+        self.false_pos += other.false_pos
+        self.false_neg += other.false_neg
+        self.abs_zmeasure.merge(other.abs_zmeasure)
+        return self
+
+    def give_stat_dict(self):
+        """Returns a dictionary with 'eta', 'sig_nmad', 'psi_pos' and 'psi_neg' as keys."""
+        num = self.source_num if self.source_num > 0 else np.nan
+        return {"eta": self.outliers / num,
+                "sig_nmad": 1.45 * self.abs_zmeasure.median(),
+                "psi_pos": self.false_pos / num,
+                "psi_neg": self.false_neg / num}
+
+
+class TemplateCounts:
+    """Mergeable counterpart of ta.give_count_df, counting the good fits and outliers
+    and summing up the scores for each of the best-fit models of a single ttype."""
+
+    def __init__(self):
+        self.good = pd.Series(dtype=np.int64)
+        self.bad = pd.Series(dtype=np.int64)
+        self.score_sums = pd.Series(dtype=float)
+
+    def update(self, df):
+        """Adds a chunk of an output DataFrame (of a single ttype) with outlier information."""
+        df = df[df["HasGoodz"]]
+        models = df["MOD_BEST"].astype(np.int64)
+        outlier = df["IsOutlier"]
+        scores = np.exp(-abs(df["ZMeasure"].astype(float)) - df["CHI_BEST"] / 2)
+        self.good = self.good.add(models[~outlier].value_counts(), fill_value=0)
+        self.bad = self.bad.add(models[outlier].value_counts(), fill_value=0)
+        self.score_sums = self.score_sums.add(
+            scores.groupby(models).sum(), fill_value=0)
+
+    def merge(self, other):
+        """Adds the counts of another TemplateCounts instance."""
+        self.good = self.good.add(other.good, fill_value=0)
+        self.bad = self.bad.add(other.bad, fill_value=0)
+        self.score_sums = self.score_sums.add(other.score_sums, fill_value=0)
+        return self
+
+    def give_count_df(self):
+        """Returns the count DataFrame as provided by ta.give_count_df without threshold."""
+        # Models that were never counted as good or bad are NaN in give_count_df:
+        both = pd.concat([self.good.rename("Good"), self.bad.rename("Bad")], axis=1)
+        both = both.fillna(0).replace(0, np.nan)
+        if -99 in both.index:
+            both = both.drop(labels=[-99])
+        both["Total"] = both["Good"].fillna(0) + both["Bad"].fillna(0)
+        both = both.sort_values(by="Total", ascending=False)
+        both["Score"] = self.score_sums.reindex(both.index) / both["Total"]
+        both["Bad_frac"] = both["Bad"].fillna(0) / both["Total"]
+        return both
+
+
+class BandSummary:
+    """Mergeable summary of processed input catalogues, split by ttype.
+    It stores
+        the number of sources for each availability pattern (a bitmask of the bands
+            with photometry, with ZSPEC_BIT set for sources with spec-z),
+        the magnitude histograms (on MAG_BINS) for each band,
+        the number of sources with good photometry for each band,
+        a quantile sketch of the good magnitudes for each band (for magnitude limits),
+    which is all the availability and magnitude distribution plots need."""
+
+    def __init__(self, bands=tuple(mt.BAND_LIST), bins=MAG_BINS):
+        self.bands = tuple(bands)
+        self.bins = np.asarray(bins)
+        self.patterns = {}  # ttype -> pd.Series of counts with the bitmasks as index
+        self.histograms = {}  # (ttype, band) -> counts on the bins
+        self.num_good = {}  # (ttype, band) -> number of sources with mag > 0
+        self.sketches = {}  # (ttype, band) -> KLLSketch of the magnitudes > 0
+        # The files the summary has been constructed from, set when saving it:
+        self.sources = ()
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """Constructs the summary of a DataFrame with magnitude columns."""
+        summary = cls()
+        summary.update(df)
+        return summary
+
+    def save(self, fpath, sources=()):
+        """Stores the summary at fpath, noting the files it has been constructed from."""
+        self.sources = tuple(sources)
+        with open(fpath, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        mt.LOGGER.info("Saved the band summary at %s.", fpath)
+
+    @staticmethod
+    def load(fpath):
+        """Reads a summary stored at fpath, returning None if it can't be read."""
+        try:
+            with open(fpath, "rb") as f:
+                summary = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            mt.LOGGER.warning("Could not read the band summary at %s (%s).", fpath, e)
+            return None
+        return summary if isinstance(summary, BandSummary) else None
+
+    def is_compatible(self, sources, bands=tuple(mt.BAND_LIST), bins=MAG_BINS):
+        """Checks whether the summary has been constructed from the given files with the
+        given bands and bins."""
+        return tuple(sources) == self.sources and tuple(bands) == self.bands \
+            and np.array_equal(bins, self.bins)
+
+    def update(self, df):
+        """Adds a chunk of a DataFrame with Type, ZSPEC and magnitude columns."""
+        for ttype, subset in df.groupby("Type", observed=True):
+            ttype = str(ttype)
+            bitmask = np.zeros(len(subset), dtype=np.int64)
+            for i, band in enumerate(self.bands):
+                colname = f"mag_{band}"
+                if colname not in subset:
+                    continue
+                mags = subset[colname].to_numpy(dtype=float)
+                is_good = mags > 0
+                bitmask |= is_good.astype(np.int64) << i
+                counts, _ = np.histogram(mags[~np.isnan(mags)], bins=self.bins)
+                key = (ttype, band)
+                self.histograms[key] = self.histograms.get(key, 0) + counts
+                self.num_good[key] = self.num_good.get(key, 0) + int(is_good.sum())
+                self.sketches.setdefault(key, KLLSketch()).update(mags[is_good])
+            has_z = subset["ZSPEC"].to_numpy(dtype=float) > 0
+            bitmask |= has_z.astype(np.int64) << ZSPEC_BIT
+            counts = pd.Series(bitmask).value_counts()
+            self.patterns[ttype] = counts.add(
+                self.patterns.get(ttype, pd.Series(dtype=np.int64)), fill_value=0)
+
+    def merge(self, other):
+        """Adds the counts of another BandSummary with the same bands and bins."""
+        for ttype, counts in other.patterns.items():
+            self.patterns[ttype] = counts.add(
+                self.patterns.get(ttype, pd.Series(dtype=np.int64)), fill_value=0)
+        for key, counts in other.histograms.items():
+            self.histograms[key] = self.histograms.get(key, 0) + counts
+        for key, num in other.num_good.items():
+            self.num_good[key] = self.num_good.get(key, 0) + num
+        for key, sketch in other.sketches.items():
+            self.sketches.setdefault(key, KLLSketch()).merge(sketch)
+        return self
+
+    def _give_patterns(self, ttype=None):
+        """Returns the bitmasks and their counts for the given ttype (or all ttypes if None)."""
+        ttypes = list(self.patterns) if ttype is None else [ttype]
+        patterns = pd.Series(dtype=np.int64)
+        for ttype_ in ttypes:
+            patterns = patterns.add(
+                self.patterns.get(ttype_, pd.Series(dtype=np.int64)), fill_value=0)
+        return patterns.index.to_numpy(dtype=np.int64), patterns.to_numpy(dtype=np.int64)
+
+    def give_bit(self, band):
+        """Returns the bit of the given band (or 'ZSPEC') in the availability patterns."""
+        return ZSPEC_BIT if band == "ZSPEC" else self.bands.index(band)
+
+    def give_source_num(self, ttype=None):
+        """Returns the number of sources of the given ttype (or all ttypes if None)."""
+        return int(self._give_patterns(ttype)[1].sum())
+
+    def give_cumulative_availability(self, ttype, band_list):
+        """Returns the number of sources of ttype with photometry in the first, the first
+        two, ... of the bands in band_list (as construct_band_availability_dataframe)."""
+        bitmasks, counts = self._give_patterns(ttype)
+        required, nums = 0, []
+        for band in band_list:
+            required |= 1 << self.give_bit(band)
+            nums.append(int(counts[(bitmasks & required) == required].sum()))
+        return nums
+
+    def give_band_number_counts(self, band_list, ttype=None):
+        """Returns a DataFrame with the number of sources of ttype (or all ttypes if None) with
+        and without spec-z (columns) for each number of available bands in band_list (index)."""
+        bitmasks, counts = self._give_patterns(ttype)
+        num_bands = np.zeros(len(bitmasks), dtype=np.int64)
+        for band in band_list:
+            num_bands += (bitmasks >> self.give_bit(band)) & 1
+        has_z = (bitmasks >> ZSPEC_BIT) & 1 == 1
+        length = len(band_list) + 1
+        return pd.DataFrame({
+            "with_z": np.bincount(num_bands[has_z], weights=counts[has_z],
+                                  minlength=length).astype(np.int64),
+            "without_z": np.bincount(num_bands[~has_z], weights=counts[~has_z],
+                                     minlength=length).astype(np.int64)})
+
+    def give_histogram(self, band, ttype=None):
+        """Returns the magnitude histogram counts of the band for ttype (or all ttypes if None)."""
+        ttypes = list(self.patterns) if ttype is None else [ttype]
+        counts = np.zeros(len(self.bins) - 1, dtype=np.int64)
+        for ttype_ in ttypes:
+            counts = counts + self.histograms.get((ttype_, band), 0)
+        return counts
+
+    def give_num_good(self, band, ttype=None):
+        """Returns the number of sources with good photometry in the band for ttype (or all if None)."""
+        ttypes = list(self.patterns) if ttype is None else [ttype]
+        return sum(self.num_good.get((ttype_, band), 0) for ttype_ in ttypes)
+
+    def give_magnitude_percentiles(self, band, percentiles=(50, 90, 95), ttype=None):
+        """Returns the estimated percentiles of the good magnitudes in the band for ttype
+        (or all ttypes if None), e.g. the 95th percentile as an estimate of the magnitude limit."""
+        ttypes = list(self.patterns) if ttype is None else [ttype]
+        sketch = merge_sketches([self.sketches[(ttype_, band)] for ttype_ in ttypes
+                                 if (ttype_, band) in self.sketches])
+        return sketch.percentiles(percentiles)
+
+
+@profiling.profile_stage()
+def give_chunked_output_aggregates(chunksize=DEFAULT_CHUNKSIZE):
+    """Passes over the output files chunk by chunk, returning dictionaries with the
+    ttypes as keys and the OutputStatistics and TemplateCounts as values."""
+    stats = {ttype: OutputStatistics() for ttype in mt.USED_TTYPES}
+    counts = {ttype: TemplateCounts() for ttype in mt.USED_TTYPES}
+    for ttype, df in iter_saved_df_chunks("out", chunksize=chunksize):
+        stats[ttype].update(df)
+        counts[ttype].update(df)
+    return stats, counts
+
+
+def give_sharded_output_statistics(fpaths, chunksize=DEFAULT_CHUNKSIZE):
+    """Returns the OutputStatistics of several output fits files (e.g. shards of a zphota
+    run), aggregated per file and merged without concatenating the files."""
+    total = OutputStatistics()
+    for fpath in fpaths:
+        stats = OutputStatistics()
+        for df in iter_fits_chunks(fpath, give_output_columns(), chunksize):
+            stats.update(mt.add_outlier_information(df))
+        total.merge(stats)
+    return total
+
+
+@profiling.profile_stage()
+def give_chunked_band_summary(chunksize=DEFAULT_CHUNKSIZE):
+    """Passes over the processed input tables chunk by chunk to construct a BandSummary."""
+    summary = BandSummary()
+    for _, df in iter_saved_df_chunks("in_processed", chunksize=chunksize):
+        summary.update(df)
+    return summary
+
+
+def give_band_summary(df=None, chunksize=DEFAULT_CHUNKSIZE):
+    """Returns the BandSummary of the processed input tables.
+    It is read from the cache file if that is newer than the tables; otherwise it is
+    constructed from the df (if given) or chunk by chunk, and stored in the cache file."""
+    fpath = mt.give_band_summary_fname()
+    sources = list(mt.give_saved_df_fpaths("in_processed").values())
+    if os.path.isfile(fpath) and mt.is_file_fresh(fpath, sources):
+        summary = BandSummary.load(fpath)
+        if summary is not None and summary.is_compatible(sources):
+            mt.LOGGER.info("Using the cached band summary at %s.", fpath)
+            return summary
+    summary = BandSummary.from_dataframe(df) if df is not None \
+        else give_chunked_band_summary(chunksize)
+    try:
+        summary.save(fpath, sources)
+    except OSError as e:
+        mt.LOGGER.warning("Could not store the band summary at %s (%s).", fpath, e)
+    return summary
+
+
+def read_projected_df(cat_type="out", columns=None, row_filter=None):
+    """Projected equivalent of mt.read_saved_df, only reading the given columns (if they
+    are available) and the rows selected by the row_filter (see mt.read_fits_as_dataframe).
+    No further columns are added."""
+    df_list = []
+    for ttype, fpath in mt.give_saved_df_fpaths(cat_type).items():
+        fcolumns = None
+        if columns is not None:
+            available = {name.lower(): name for name in give_fits_colnames(fpath)}
+            fcolumns = [available[col.lower()] for col in columns if col.lower() in available]
+        df = mt.read_fits_as_dataframe(fpath, columns=fcolumns, row_filter=row_filter)
+        df["Type"] = mt.give_ttype_column(ttype, len(df))
+        df_list.append(mt.apply_dtype_plan(df))
+    joined = pd.concat(df_list)
+    profiling.record_rows(len(joined))
+    return joined
+
+
+def read_good_redshift_df(columns=None):
+    """Reads only the output rows with good spec-z and photo-z (which are all the rows the
+    spec-z-photo-z and colour plots use), restricted to the given columns if provided."""
+    df = read_projected_df(
+        "out", columns, row_filter=lambda data: (data["ZSPEC"] > 0) & (data["Z_BEST"] > 0))
+    return mt.apply_dtype_plan(mt.add_filter_columns(df))
@@ -12,7 +12,9 @@ import os
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
+import numpy as np
 from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.colors import LinearSegmentedColormap, LogNorm, to_rgb
 
 import util.my_tools as mt
 
@@ -23,6 +25,11 @@ LATEXWIDTH = 5.87614
 # TODO: Change this to actually search for the availability of LaTeX (this is just a workaround)
 USE_LATEX = "LEPHAREDIR" not in os.environ.keys()
 
+# In rasterized mode, point sets larger than this are binned into density images
+RASTER_THRESHOLD = 5000
+# Number of bins per axis of these density images
+RASTER_BINS = 300
+
 
 def set_figsize(width=LATEXWIDTH, height=None, fraction=1, subplots=(1, 1), aspect=False):
     """Set figure dimensions to avoid scaling in LaTeX.
@@ -56,12 +63,14 @@ def set_figsize(width=LATEXWIDTH, height=None, fraction=1, subplots=(1, 1), aspe
     return (fig_width, fig_height)
 
 
-def save_figure(fig, name="", directory="", stem="", format_="pdf"):
-    """Save a given figure while removing excess whitespace"""
+def save_figure(fig, name="", directory="", stem="", format_="pdf", dependencies=()):
+    """Save a given figure while removing excess whitespace.
+    The dependencies (paths of the data files) are used to check whether an existing
+    figure is still up to date."""
     directory = directory + "/" if directory != "" else directory
     stem = stem + "_" if stem != "" else stem
     fpath = f"{mt.GEN_CONFIG['PATHS']['plot']}{directory}{stem}{name}.{format_}"
-    if mt.assert_file_overwrite(fpath):
+    if mt.assert_file_overwrite(fpath, dependencies, policy=mt.give_plot_overwrite_policy()):
         fig.savefig(fpath, format=format_, bbox_inches='tight')
         mt.LOGGER.info(
             f"Successfully saved the {stem}{name}.{format_} plot at {directory}.")
@@ -69,6 +78,33 @@ def save_figure(fig, name="", directory="", stem="", format_="pdf"):
         mt.LOGGER.info(f"Skipped writing the {stem}{name} plot.")
 
 
+def plot_points(ax, x, y, color="k", marker=".", size=1, label=None, alpha=1.):
+    """Rasterized alternative to scattering the given points on ax.
+    If there are more than RASTER_THRESHOLD points, they are binned into a fixed-resolution
+    density image (shaded in the given color) that is embedded as a raster in the figure,
+    so the file size and rendering time don't depend on the number of points.
+    Smaller point sets are scattered, but rasterized as well.
+    All other artists (lines, annotations, text) stay vector graphics."""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    finite = np.isfinite(x) & np.isfinite(y)
+    x, y = x[finite], y[finite]
+    if len(x) <= RASTER_THRESHOLD:
+        ax.scatter(x, y, s=size, color=color, marker=marker, label=label,
+                   alpha=alpha, rasterized=True)
+        return
+    extent = [x.min(), x.max(), y.min(), y.max()]
+    hist, _, _ = np.histogram2d(x, y, bins=RASTER_BINS, range=[extent[:2], extent[2:]])
+    # The color map fades from a transparent to an opaque version of the given color
+    rgb = to_rgb(color)
+    cmap = LinearSegmentedColormap.from_list("", [(*rgb, 0.2), (*rgb, 1)])
+    cmap.set_bad(alpha=0)
+    ax.imshow(np.ma.masked_equal(hist.T, 0), extent=extent, origin="lower", aspect="auto",
+              cmap=cmap, norm=LogNorm(vmin=1), alpha=alpha, interpolation="nearest",
+              rasterized=True)
+    if label is not None:  # Proxy artist so the point set still appears in legends
+        ax.scatter([], [], s=size, color=color, marker=marker, label=label, alpha=alpha)
+
+
 def save_current_figures(name, format_="pdf"):
     """Takes the current instances of figures and saves them all to a single file"""
     path = f"{mt.PLOTPATH}{name}.{format_}"
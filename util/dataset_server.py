@@ -0,0 +1,240 @@
+"""
+Helper module sharing the derived tables of a run (the output, input and template
+DataFrames) between analysis processes via a cache of memory-mapped column files.
+
+This takes the role of a local dataset service without a separate serving process: The
+OS page cache of the mapped files is what is shared between the processes, and the
+files themselves are the protocol, so nothing needs to be started, kept alive or
+serialized for each request.
+The first process loading a dataset stores each of its columns as a .npy file in a
+directory of the cache, along with the original dtypes and the masks of the missing
+values of the object and nullable columns, so the tables are restored exactly.
+Any process requesting the same dataset afterwards memory-maps these files
+copy-on-write, so the numeric columns are built without copying or parsing anything,
+and all processes on a node share the same pages of the OS page cache instead of
+holding their own copy. The DataFrames can be modified as usual, as writing into a
+column only copies the pages written to (privately for the writing process).
+A dataset is identified by its name and the paths, sizes and modification times of the
+files it is derived from, so it is rebuilt as soon as one of them changes.
+A manifest (guarded by a file lock) records the size and last use of each dataset,
+and the least recently used ones are evicted once the cache exceeds its size limit.
+Evicting a dataset that is still mapped by another process is safe on POSIX systems,
+as its pages stay valid until they are unmapped.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from util.my_logger import LOGGER
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    try:
+        import msvcrt
+    except ImportError:
+        msvcrt = None
+
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = "manifest.lock"
+META_NAME = "meta.json"
+# Column name used to store the index of the DataFrames
+INDEX_COLUMN = "__index__"
+# The nullable pandas arrays, which are stored as their values and their mask
+MASKED_ARRAYS = (pd.arrays.IntegerArray, pd.arrays.FloatingArray, pd.arrays.BooleanArray)
+# Values of the null masks of the object columns, distinguishing None from NaN
+NOT_NULL, NULL_NONE, NULL_NAN = 0, 1, 2
+
+
+def give_dataset_key(name, source_fpaths):
+    """Returns the key of a dataset derived from the given files, which changes if any of
+    the files are modified."""
+    state = [name] + [(fpath, os.stat(fpath).st_size, os.stat(fpath).st_mtime_ns)
+                      for fpath in source_fpaths]
+    return name + "_" + hashlib.sha1(json.dumps(state).encode("utf-8")).hexdigest()[:12]
+
+
+def give_directory_size(path):
+    """Returns the total size of the files in the directory at path (in bytes)."""
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+@contextmanager
+def lock_file(f):
+    """Holds an exclusive lock on the opened file f (only on the process level if neither
+    fcntl nor msvcrt are available)."""
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+    elif msvcrt is not None:
+        while True:
+            try:
+                # Blocks for up to 10 seconds before raising
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                continue
+    try:
+        yield
+    finally:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_UN)
+        elif msvcrt is not None:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def give_null_mask(series):
+    """Returns the null mask of an object column, distinguishing None from other missing values."""
+    is_none = np.array([val is None for val in series.to_numpy()], dtype=bool)
+    return np.where(is_none, NULL_NONE, np.where(series.isna().to_numpy(), NULL_NAN, NOT_NULL)
+                    ).astype(np.int8)
+
+
+def write_column(series, path, stem):
+    """Stores the values (and the mask of the missing values if needed) of the series in
+    files starting with stem in the directory at path.
+    returns:
+        The meta entry of the column with the file names and the dtype."""
+    dtype = series.dtype
+    entry = {"name": series.name, "dtype": str(dtype), "file": stem + ".npy"}
+    mask = None
+    if isinstance(dtype, pd.CategoricalDtype):
+        entry["categories"] = dtype.categories.tolist()
+        entry["ordered"] = bool(dtype.ordered)
+        array = series.cat.codes.to_numpy()
+    elif isinstance(series.array, MASKED_ARRAYS):
+        mask = series.isna().to_numpy()
+        array = series.to_numpy(dtype=dtype.numpy_dtype, na_value=0)
+    elif dtype == object or isinstance(dtype, pd.api.extensions.ExtensionDtype):
+        # Strings (and the other extension dtypes) are stored as strings and restored via
+        # the dtype, with the null mask for the missing values
+        series = series.astype(object)
+        mask = give_null_mask(series)
+        array = series.where(mask == NOT_NULL, "").to_numpy().astype(str)
+    else:
+        array = series.to_numpy()
+    np.save(os.path.join(path, entry["file"]), np.ascontiguousarray(array))
+    if mask is not None:
+        entry["mask_file"] = stem + "_mask.npy"
+        np.save(os.path.join(path, entry["mask_file"]), mask)
+    return entry
+
+
+def read_column(path, entry):
+    """Restores the column described by the meta entry from the files at path, with the
+    numeric values memory-mapped copy-on-write."""
+    array = np.load(os.path.join(path, entry["file"]), mmap_mode="c")
+    mask = np.load(os.path.join(path, entry["mask_file"])) if "mask_file" in entry else None
+    dtype = entry["dtype"]
+    if "categories" in entry:
+        return pd.Categorical.from_codes(array, categories=entry["categories"],
+                                         ordered=entry["ordered"])
+    if mask is None:
+        return array
+    if mask.dtype == bool:
+        # The masks of the nullable arrays are boolean, those of the object columns not
+        return pd.api.types.pandas_dtype(dtype).construct_array_type()(array, mask)
+    values = array.astype(object)
+    values[mask == NULL_NONE] = None
+    values[mask == NULL_NAN] = np.nan
+    return values if dtype == "object" else pd.array(values, dtype=dtype)
+
+
+def write_dataset(df, path):
+    """Stores each column of the DataFrame as a .npy file in the directory at path,
+    along with a file with the column order and dtypes."""
+    meta = {"columns": [], "num_rows": len(df)}
+    columns = [(INDEX_COLUMN, df.index.to_series())] + list(df.items())
+    for i, (col, series) in enumerate(columns):
+        meta["columns"].append(write_column(series.rename(col), path, str(i)))
+    meta["index_name"] = df.index.name
+    with open(os.path.join(path, META_NAME), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def read_dataset(path):
+    """Returns a DataFrame of the columns stored at path, the numeric ones being
+    copy-on-write memory maps of their files."""
+    with open(os.path.join(path, META_NAME), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    col_dict = {entry["name"]: read_column(path, entry) for entry in meta["columns"]}
+    index = pd.Index(col_dict.pop(INDEX_COLUMN), name=meta.get("index_name"))
+    # Without copying, pandas keeps each column as its own block backed by the mapped file
+    return pd.DataFrame(col_dict, index=index, copy=False)
+
+
+class DatasetCache:
+    """Cache of memory-mapped datasets in the directory cache_dir, evicting the least
+    recently used ones if their total size exceeds max_bytes."""
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @contextmanager
+    def _locked_manifest(self):
+        """Yields the manifest while holding the exclusive lock, and writes it back afterwards."""
+        with open(os.path.join(self.cache_dir, LOCK_NAME), "w", encoding="utf-8") as lock, \
+                lock_file(lock):
+            fpath = os.path.join(self.cache_dir, MANIFEST_NAME)
+            try:
+                with open(fpath, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                manifest = {}
+            yield manifest
+            with open(fpath + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=1)
+            os.replace(fpath + ".tmp", fpath)
+
+    def _give_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _evict(self, manifest, keep):
+        """Removes the least recently used datasets (apart from keep) until the cache
+        fits into max_bytes."""
+        total = sum(entry["size"] for entry in manifest.values())
+        for key in sorted(manifest, key=lambda key: manifest[key]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._give_path(key), ignore_errors=True)
+            total -= manifest.pop(key)["size"]
+            LOGGER.info("Evicted the dataset %s from the dataset cache.", key)
+
+    def give(self, name, source_fpaths, loader):
+        """Returns the dataset derived from the given files, calling loader (without
+        arguments, returning a DataFrame) and storing its result if it isn't cached yet."""
+        key = give_dataset_key(name, source_fpaths)
+        path = self._give_path(key)
+        with self._locked_manifest() as manifest:
+            if key in manifest and os.path.isdir(path):
+                manifest[key]["last_used"] = time.time()
+                LOGGER.info("Mapping the dataset %s from the dataset cache.", key)
+                return read_dataset(path)
+        # The dataset is built outside of the lock so other datasets can be read meanwhile
+        df = loader()
+        tmp_path = tempfile.mkdtemp(prefix=key + "_", dir=self.cache_dir)
+        write_dataset(df, tmp_path)
+        with self._locked_manifest() as manifest:
+            if key in manifest and os.path.isdir(path):
+                # Another process has stored the same dataset in the meantime
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+                os.rename(tmp_path, path)
+                manifest[key] = {"size": give_directory_size(path), "sources": source_fpaths}
+                LOGGER.info("Stored the dataset %s in the dataset cache.", key)
+            manifest[key]["last_used"] = time.time()
+            self._evict(manifest, keep=key)
+        return read_dataset(path)
@@ -0,0 +1,205 @@
+"""
+Helper module caching the zphota results of the individual sources, so reruns only
+fit the sources whose inputs have changed.
+
+Each source is identified by a hash of its row in the LePhare input file (fluxes, errors,
+context, ZSPEC and the String column, but not the IDENT), and the cache of a ttype is
+keyed by a hash of the fit configuration (magnitude libraries, parameter files,
+GLB_CONTEXT, MAG_ABS prior, extinction settings and the remaining zphota arguments).
+On a rerun, only the new or changed sources are written to a delta input file and
+fitted. The output lines of all sources are then merged from the cache into the
+usual .out file, which is post-processed as before.
+The cache only keeps the results of the sources of the current input, and only the
+MAX_CACHES most recently used configurations of each ttype are kept.
+"""
+import glob
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import util.my_tools as mt
+
+# The zphota arguments that only point to the input and output files
+PATH_ARGS = ("CAT_IN", "CAT_OUT", "PARA_OUT")
+# Number of caches (i. e. configurations) kept for each ttype
+MAX_CACHES = 3
+
+
+def give_file_hash(fpath, blocksize=2**20):
+    """Returns the sha1 hash of the contents of a file (None if it doesn't exist)."""
+    if not os.path.isfile(fpath):
+        return None
+    sha = hashlib.sha1()
+    with open(fpath, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def give_config_hash(ttype, arg_dict):
+    """Returns a hash of everything the zphota results of ttype depend on apart from the
+    photometry: the magnitude libraries, the (output) parameter files, the zphota
+    arguments (including GLB_CONTEXT and MAG_ABS) and the extinction settings."""
+    libraries = [mt.give_temp_libname(lib, "mag", suffix=".dat")
+                 for lib in arg_dict["ZPHOTLIB"].split(",")]
+    state = {"args": {key: str(val) for key, val in arg_dict.items() if key not in PATH_ARGS},
+             "libraries": [give_file_hash(fpath) for fpath in libraries],
+             "para": give_file_hash(mt.give_parafile_fpath()),
+             "para_out": give_file_hash(mt.give_parafile_fpath(out=True)),
+             "extinction": mt.give_extinction_settings(ttype)}
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+def split_ident(line):
+    """Returns the IDENT (first field) and the rest of a data line of a LePhare file."""
+    ident, rest = line.split(None, 1)
+    return ident, rest.strip()
+
+
+def give_source_hashes(data_lines):
+    """Returns a 64 bit hash of the inputs of each source, given the data lines of a
+    LePhare input file.
+    The lines are hashed as they are written apart from the IDENT, as splitting them into
+    columns would misalign all fields after a String column containing spaces."""
+    rests = np.array([split_ident(line)[1] for line in data_lines], dtype=object)
+    return pd.util.hash_array(rests)
+
+
+def give_cache_fpath(ttype, config_hash):
+    """Provides the path of the cache of ttype for the given configuration."""
+    return mt.give_lephare_filename(ttype, out=True, suffix=f"_fitcache_{config_hash}.pkl")
+
+
+def remove_stale_caches(ttype, max_caches=MAX_CACHES):
+    """Removes the least recently used caches of ttype (i. e. of configurations that
+    haven't been used for a while) if there are more than max_caches."""
+    fpaths = sorted(glob.glob(give_cache_fpath(ttype, "*")), key=os.path.getmtime, reverse=True)
+    for fpath in fpaths[max_caches:]:
+        os.remove(fpath)
+        mt.LOGGER.info("Removed the stale fit cache at %s.", fpath)
+
+
+def read_data_lines(fpath):
+    """Returns the header (comment) lines and the data lines of a LePhare ASCII file."""
+    header, data = [], []
+    with open(fpath, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("#"):
+                header.append(line)
+            elif line.strip():
+                data.append(line)
+    return header, data
+
+
+class FitCache:
+    """The zphota output lines (without the IDENT) of the sources fitted with one
+    configuration, indexed by the source hashes."""
+
+    def __init__(self, header=None, lines=None):
+        self.header = [] if header is None else header
+        self.lines = pd.Series(dtype=object) if lines is None else lines
+
+    def __len__(self):
+        return len(self.lines)
+
+    def save(self, fpath):
+        """Stores the cache at fpath."""
+        with open(fpath, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        mt.LOGGER.info("Saved %d fit results to the cache at %s.", len(self), fpath)
+
+    @staticmethod
+    def load(fpath):
+        """Reads the cache stored at fpath, returning an empty one if it can't be read."""
+        if not os.path.isfile(fpath):
+            return FitCache()
+        try:
+            with open(fpath, "rb") as f:
+                cache = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            mt.LOGGER.warning("Could not read the fit cache at %s (%s).", fpath, e)
+            return FitCache()
+        return cache if isinstance(cache, FitCache) else FitCache()
+
+    def prune(self, hashes):
+        """Removes the results of the sources not among the given hashes (e.g. those no
+        longer in the input).
+        returns:
+            The number of removed results."""
+        kept = self.lines.index.isin(hashes)
+        self.lines = self.lines[kept]
+        return int((~kept).sum())
+
+    def give_missing(self, hashes):
+        """Returns a boolean array marking the hashes not contained in the cache."""
+        return ~np.isin(hashes, self.lines.index.to_numpy())
+
+    def add(self, hashes, out_lines, header):
+        """Adds the output lines of the sources with the given hashes (in the same order)."""
+        rests = [line.split(None, 1)[1] for line in out_lines]
+        new = pd.Series(rests, index=hashes, dtype=object)
+        lines = pd.concat([self.lines, new])
+        self.lines = lines[~lines.index.duplicated(keep="last")]
+        self.header = header
+
+    def write_output(self, fpath, idents, hashes):
+        """Writes a LePhare .out file with the cached results of the given sources."""
+        rests = self.lines.reindex(hashes).to_numpy()
+        with open(fpath, "w", encoding="utf-8") as f:
+            f.writelines(self.header)
+            f.writelines(f"{ident} {rest}" for ident, rest in zip(idents, rests))
+
+
+def write_delta_input(header, data, delta_fpath, is_new):
+    """Writes the header and the data lines of the LePhare input file marked by is_new into
+    the delta input file."""
+    with open(delta_fpath, "w", encoding="utf-8") as f:
+        f.writelines(header)
+        f.writelines(line for line, new in zip(data, is_new) if new)
+
+
+def run_cached_zphota(ttype, arg_dict):
+    """Runs zphota with the given arguments only for the sources of ttype that are not
+    in the cache yet, and writes the merged results of all sources to CAT_OUT.
+    returns:
+        False if the results couldn't be merged (so a full run is needed), True otherwise."""
+    in_fpath, out_fpath = arg_dict["CAT_IN"], arg_dict["CAT_OUT"]
+    in_header, in_data = read_data_lines(in_fpath)
+    idents = [split_ident(line)[0] for line in in_data]
+    hashes = give_source_hashes(in_data)
+    cache_fpath = give_cache_fpath(ttype, give_config_hash(ttype, arg_dict))
+    cache = FitCache.load(cache_fpath)
+    is_new = cache.give_missing(hashes)
+    mt.LOGGER.info("Found the results of %d of the %d %s sources in the fit cache.",
+                   (~is_new).sum(), len(in_data), ttype)
+    if is_new.any():
+        delta_in = mt.give_lephare_filename(ttype, suffix="_delta.in")
+        delta_out = mt.give_lephare_filename(ttype, out=True, suffix="_delta.out")
+        write_delta_input(in_header, in_data, delta_in, is_new)
+        mt.run_lephare_command("zphota", {**arg_dict, "CAT_IN": delta_in,
+                                          "CAT_OUT": delta_out}, ttype)
+        if mt.CUR_CONFIG["GENERAL"].getboolean("print_commands_only"):
+            return True
+        header, out_lines = read_data_lines(delta_out)
+        if len(out_lines) != is_new.sum():
+            mt.LOGGER.warning("The delta run for %s returned %d instead of %d sources, so "
+                              "its results can't be merged.", ttype, len(out_lines), is_new.sum())
+            return False
+        cache.add(hashes[is_new], out_lines, header)
+    num_pruned = cache.prune(hashes)
+    if num_pruned > 0:
+        mt.LOGGER.info("Removed %d results of sources no longer in the %s input from the "
+                       "fit cache.", num_pruned, ttype)
+    if is_new.any() or num_pruned > 0:
+        cache.save(cache_fpath)
+    elif os.path.isfile(cache_fpath):
+        # Mark the cache as recently used
+        os.utime(cache_fpath)
+    remove_stale_caches(ttype)
+    cache.write_output(out_fpath, idents, hashes)
+    mt.LOGGER.info("Wrote the merged results of the %s sources to %s.", ttype, out_fpath)
+    return True
@@ -7,7 +7,9 @@ Created on Mon Jul 19 09:31:46 2021
 
 
 import os
+import shlex
 import subprocess
+import threading
 from configparser import ConfigParser
 from datetime import datetime
 
@@ -17,6 +19,7 @@ from astropy.io import fits
 from astropy.table import Table
 from genericpath import isfile
 
+from util import profiling
 from util.my_logger import LOGGER
 
 
@@ -31,15 +34,120 @@ def get_yes_no_input(question):
         answer = input("Please answer with 'yes' or 'no'\n>>> ")
 
 
-def assert_file_overwrite(fpath):
-    """Asks the user whether to really overwrite the given file."""
-    if os.path.isfile(fpath):
-        if CUR_CONFIG["GENERAL"].getboolean("ask_overwrite"):
-            return get_yes_no_input(
-                f"The file '{fpath}' already exists.\nContinue to overwrite it?")
-        else:
-            LOGGER.warning("Overwriting the file '%s'", fpath.split("/")[-1])
-    return True
+# Possible values for the overwrite_policy key of the GENERAL section:
+OVERWRITE_POLICIES = ("ask", "overwrite", "skip", "skip_if_fresh", "version", "fail")
+# Overwrite decisions for files that have been made up front (see plan_overwrites in
+# assert_config) so batch runs don't block on prompts mid-run
+OVERWRITE_DECISIONS = {}
+# Decision for files that are going to be moved to a versioned path right before writing
+VERSION_PENDING = "version"
+# Policy for the plots decided up front (overriding 'ask'), see give_plot_overwrite_policy
+PLOT_OVERWRITE_POLICY = None
+
+
+def give_overwrite_policy():
+    """Returns the overwrite policy set in the current config.
+    If none is set, 'ask' or 'overwrite' are used depending on ask_overwrite."""
+    gen_con = CUR_CONFIG["GENERAL"]
+    fallback = "ask" if gen_con.getboolean(
+        "ask_overwrite", fallback=True) else "overwrite"
+    policy = gen_con.get("overwrite_policy", fallback=fallback).lower()
+    assert policy in OVERWRITE_POLICIES, f"The overwrite policy '{policy}' is not \
+one of {OVERWRITE_POLICIES}."
+    return policy
+
+
+def give_plot_overwrite_policy():
+    """Returns the overwrite policy for the plots, which are only named when they are
+    produced, so with the 'ask' policy the user is asked once up front whether to
+    overwrite or skip all of them."""
+    return give_overwrite_policy() if PLOT_OVERWRITE_POLICY is None else PLOT_OVERWRITE_POLICY
+
+
+def give_overwrite_decision(fpath):
+    """Returns the overwrite decision made up front for the file at fpath, or None if
+    there is none."""
+    return OVERWRITE_DECISIONS.get(fpath)
+
+
+def is_file_fresh(fpath, dependencies):
+    """Checks whether the file at fpath is newer than all of its dependencies.
+    Files without any known dependencies and files depending on a file that is
+    going to be rewritten in this run are never considered fresh."""
+    dependencies = [dep for dep in dependencies if os.path.isfile(dep)]
+    if len(dependencies) == 0:
+        return False
+    if any(give_overwrite_decision(dep) for dep in dependencies):
+        return False
+    mtime = os.path.getmtime(fpath)
+    return all(os.path.getmtime(dep) <= mtime for dep in dependencies)
+
+
+def give_versioned_fpath(fpath):
+    """Returns the first path of the form <stem>_v<N><ext> that does not exist yet."""
+    stem, ext = os.path.splitext(fpath)
+    version = 1
+    while os.path.exists(f"{stem}_v{version}{ext}"):
+        version += 1
+    return f"{stem}_v{version}{ext}"
+
+
+def move_to_versioned_fpath(fpath):
+    """Moves the existing file at fpath to the next free version-suffixed path."""
+    new_fpath = give_versioned_fpath(fpath)
+    os.rename(fpath, new_fpath)
+    LOGGER.info("Moved the existing file '%s' to '%s'",
+                fpath.split("/")[-1], new_fpath.split("/")[-1])
+
+
+def assert_file_overwrite(fpath, dependencies=(), planning=False, policy=None):
+    """Checks whether the given file may be (over)written according to the overwrite
+    policy, unless a decision has already been made for it up front.
+    Depending on the policy, the user is asked, the file is kept if it is skipped
+    or newer than all of its dependencies, moved to a version-suffixed path,
+    or a FileExistsError is raised.
+    parameters:
+        [planning]: bool
+            Whether the decision is only planned up front (see plan_overwrites), in which
+            case existing files aren't moved yet, but right before they are written
+            (i. e. when this is called again without planning).
+        [policy]: str
+            The policy to use instead of the one set in the config.
+    """
+    decision = give_overwrite_decision(fpath)
+    if decision == VERSION_PENDING and not planning:
+        if os.path.isfile(fpath):
+            move_to_versioned_fpath(fpath)
+        OVERWRITE_DECISIONS[fpath] = True
+        return True
+    if decision is not None:
+        return decision
+    if not os.path.isfile(fpath):
+        return True
+    fname = fpath.split("/")[-1]
+    policy = give_overwrite_policy() if policy is None else policy
+    if policy == "ask":
+        decision = get_yes_no_input(
+            f"The file '{fpath}' already exists.\nContinue to overwrite it?")
+    elif policy == "skip":
+        LOGGER.info("Keeping the existing file '%s'", fname)
+        decision = False
+    elif policy == "skip_if_fresh" and is_file_fresh(fpath, dependencies):
+        LOGGER.info("The file '%s' is up to date, keeping it.", fname)
+        decision = False
+    elif policy == "version" and planning:
+        decision = VERSION_PENDING
+    elif policy == "version":
+        move_to_versioned_fpath(fpath)
+        decision = True
+    elif policy == "fail":
+        raise FileExistsError(
+            f"The file '{fpath}' already exists and the overwrite policy is 'fail'.")
+    else:
+        LOGGER.warning("Overwriting the file '%s'", fname)
+        decision = True
+    OVERWRITE_DECISIONS[fpath] = decision
+    return decision
 
 
 def assert_file_exists(fpath, ftype):
@@ -185,6 +293,13 @@ def give_processed_table_name(ttype):
     return path + stem + "_" + ttype + "_processed.fits"
 
 
+def give_band_summary_fname():
+    """Provides the name of the file caching the band summary of the processed tables."""
+    path = GEN_CONFIG.get("PATHS", "match")
+    stem = CUR_CONFIG.get("CAT_ASSEMBLY", "cat_stem")
+    return path + stem + "_band_summary.pkl"
+
+
 def give_survey_name(survey_name: str):
     """Returns the survey name for the plots"""
     name_dict = {"galex": "GALEX (GR6+7)",
@@ -227,6 +342,47 @@ def give_parafile_fpath(out=False):
     return path + fname
 
 
+def give_para_value(key, out=False):
+    """Reads the value of the given keyword from the current LePhare parameter file
+    (None if it is not set)."""
+    with open(give_parafile_fpath(out), "r", encoding="utf-8") as f:
+        for line in f:
+            entries = line.split("#")[0].split()
+            if len(entries) > 1 and entries[0] == key:
+                return entries[1]
+    return None
+
+
+# The extinction laws and E(B-V) values used for the pointlike magnitude library:
+EXTINCTION_LAWS = ("SMC_prevot.dat", "SB_calzetti.dat")
+# The E(B-V) string is passed to mag_gal exactly as in the previous runs
+EB_V_VALUES = "0.,0.05,0.1,0.15,0.2,0.25,0.3,0.35,0.4"
+EB_V_GRID = tuple(float(ebv) for ebv in EB_V_VALUES.split(","))
+
+
+# The absolute magnitude priors (reference band number, range) used in the zphota runs:
+MAG_ABS_PRIORS = {"pointlike": ("7", "-30,-20"), "extended": ("7", "-24,-8")}
+
+
+def give_mag_abs_settings(ttype):
+    """Provides the zphota arguments for the absolute magnitude prior of ttype
+    (an empty dictionary if no prior is applied)."""
+    if ttype not in MAG_ABS_PRIORS:
+        return {}
+    mag_ref, mag_abs = MAG_ABS_PRIORS[ttype]
+    return {"MAG_REF": mag_ref, "MAG_ABS": mag_abs}
+
+
+def give_extinction_settings(ttype):
+    """Provides the mag_gal arguments for the extinction applied to the templates of ttype
+    (an empty dictionary if no extinction is applied)."""
+    if ttype != "pointlike" or "extinc_range_pointlike" not in CUR_CONFIG["LEPHARE"].keys():
+        return {}
+    return {"EXTINC_LAW": ",".join(EXTINCTION_LAWS),
+            "MOD_EXTINC": CUR_CONFIG["LEPHARE"]["extinc_range_pointlike"],
+            "EB_V": EB_V_VALUES}
+
+
 def give_filterfile_fpath(overview=True):
     """Provides the name of the requested filter file"""
     filtfilepath = GEN_CONFIG['PATHS']['params']
@@ -250,6 +406,13 @@ def give_lephare_filename(ttype, out=False, suffix: str = None, include_path=Tru
     return path + stem + "_" + ttype + suffix
 
 
+def give_ident_map_fpath(ttype: str) -> str:
+    """Provides the path of the table mapping the IDENTs of the LePhare input of ttype to
+    the sweep_idents.
+    WARNING: Needs to be synced with jy_tools!"""
+    return give_lephare_filename(ttype, suffix=".ident_map.fits")
+
+
 def give_temp_listname(ttype: str, altstem: str = None, include_path=True):
     """Provides the name of the list file with the templates."""
     listpath = GEN_CONFIG["PATHS"]["params"] + "template_lists/"
@@ -258,12 +421,28 @@ def give_temp_listname(ttype: str, altstem: str = None, include_path=True):
     return listpath + fname if include_path else fname
 
 
+def give_template_dependencies(ttype):
+    """Provides the paths of the files the magnitude library of ttype is generated from."""
+    return [give_temp_listname(ttype), give_parafile_fpath(), give_filterfile_fpath()]
+
+
+def give_zphota_dependencies(ttype):
+    """Provides the paths of the files the LePhare output of ttype is generated from."""
+    return [give_lephare_filename(ttype), give_temp_libname(ttype, "mag", suffix=".dat"),
+            give_parafile_fpath(), give_parafile_fpath(out=True)]
+
+
 def give_statsfile_fname():
     """Provides the name of the stats file used to provide concise information on the LePhare run."""
     listpath = GEN_CONFIG["PATHS"]["params"]
     return listpath + "lephare_run_stats.txt"
 
 
+def give_profile_fname():
+    """Provides the name of the file the stage timings of each run are appended to."""
+    return GEN_CONFIG["PATHS"]["params"] + "lephare_run_profile.jsonl"
+
+
 def give_list_of_tempnames(ttype, altstem: str = None):
     """Reads the currently selected list of templates and returns a list of the active ones."""
     fname = give_temp_listname(ttype, altstem=altstem)
@@ -337,39 +516,117 @@ def give_temp_libname(ttype, libtype="mag", suffix="", include_path=True, use_wo
     return temppath + fname
 
 
-def read_fits_as_dataframe(fname, saferead=False):
-    """Read a given .fits file with the specified filename to return a pandas dataframe"""
-    # This is the way to read the FITS data into a numpy structured array
-    # (using astropy.io.fits.getdata didn't work out of the box
-    # because it gives a FITSRec)
-    if saferead:
-        t = Table.read(fname, format="fits")
-        safe_names = [name for name in t.colnames if len(
-            t[name].shape) <= 1]
-        data = t[safe_names].to_pandas()
-    else:
-        table = Table.read(fname, 1, format="fits")
-        data = table.to_pandas()
-    df = pd.DataFrame(data)
-    return df
+# Memory-efficient dtypes for the columns of the loaded DataFrames:
+DTYPE_PLAN = {"IDENT": "int32", "sweep_ident": "int64", "MOD_BEST": "int16", "MOD_SEC": "int16",
+              "EXTLAW_BEST": "int8", "NBAND_USED": "int8", "nfilters": "int8", "CONTEXT": "int32",
+              "used_context": "int32", "model": "int16", "ext_law": "int8",
+              "ZMeasure": "float32", "TemplateScore": "float32"}
+# Columns starting with these prefixes (magnitudes, errors, k-corrections) are stored as float32:
+FLOAT32_PREFIXES = ("mag_", "MAG_OBS", "ERR_MAG_OBS", "kcor_")
+TTYPE_DTYPE = pd.CategoricalDtype(["pointlike", "extended", "star"])
+
+
+def give_ttype_column(ttype, length):
+    """Returns a categorical 'Type' column of the given length with all entries set to ttype."""
+    return pd.Categorical.from_codes(
+        np.full(length, TTYPE_DTYPE.categories.get_loc(ttype)), dtype=TTYPE_DTYPE)
+
+
+def give_dtype_plan(columns):
+    """Returns a dictionary with the memory-efficient dtype for each of the given columns
+    that has one assigned in DTYPE_PLAN or FLOAT32_PREFIXES."""
+    plan = {col: DTYPE_PLAN[col] for col in columns if col in DTYPE_PLAN}
+    plan.update({col: "float32" for col in columns if col.startswith(FLOAT32_PREFIXES)})
+    if "Type" in columns:
+        plan["Type"] = TTYPE_DTYPE
+    return plan
+
+
+def apply_dtype_plan(df):
+    """Converts the columns of the given DataFrame to the dtypes of the dtype plan.
+    Integer columns containing missing values keep their dtype."""
+    plan = give_dtype_plan(df.columns)
+    for col, dtype in list(plan.items()):
+        if df[col].dtype == dtype:
+            del plan[col]
+        elif dtype not in ["float32", TTYPE_DTYPE] and df[col].isna().any():
+            del plan[col]
+    return df.astype(plan) if plan else df
+
+
+def give_native_column(fits_col, array):
+    """Converts a column array of a FITS_rec into one pandas can use, only copying the
+    data if its byte order needs to be swapped or strings need to be decoded."""
+    if array.dtype.kind == "S":
+        return np.char.decode(array, "utf-8")
+    if not array.dtype.isnative:
+        array = array.astype(array.dtype.newbyteorder("="))
+    if array.dtype.kind in "iu" and fits_col.null is not None:
+        return pd.arrays.IntegerArray(array, array == fits_col.null)
+    return array
+
+
+def give_fits_column_names(fname):
+    """Returns the names of the columns of the table in the given .fits file."""
+    with fits.open(fname, memmap=True) as hdul:
+        return list(hdul[1].columns.names)
+
+
+def read_fits_as_dataframe(fname, saferead=False, columns=None, row_filter=None):
+    """Read a given .fits file with the specified filename to return a pandas dataframe.
+    The file is memory-mapped, so only the requested columns and rows are read.
+    parameters:
+        [saferead]: bool
+            Drop multidimensional columns instead of raising an error.
+        [columns]: list<str>
+            Only decode these columns (all if None).
+        [row_filter]: callable
+            Function taking the memory-mapped FITS_rec and returning a boolean mask
+            of the rows to keep, e.g. lambda data: data["ZSPEC"] > 0
+    """
+    # The FITS_rec can't be converted directly (using astropy.io.fits.getdata didn't work
+    # out of the box), so the columns are converted one by one
+    with fits.open(fname, memmap=True) as hdul:
+        data = hdul[1].data
+        names = data.columns.names if columns is None else list(columns)
+        mask = None if row_filter is None else np.asarray(row_filter(data), dtype=bool)
+        col_dict = {}
+        for name in names:
+            array = data[name]
+            if array.ndim > 1:
+                if saferead:
+                    continue
+                raise ValueError(
+                    f"Cannot convert the multidimensional column '{name}' of {fname}, use saferead.")
+            if mask is not None:
+                array = array[mask]
+            col_dict[name] = give_native_column(data.columns[name], array)
+    return pd.DataFrame(col_dict)
 
 
 def read_ascii_as_df(fname, out=True):
-    """Read a .out LePhare ASCII output file and return it as a dataframe."""
+    """Read a .out LePhare ASCII output file (or, if out is False, a .in LePhare input
+    file written by jystilts) and return it as a dataframe."""
+    if not out:
+        # The input files have a single header line with the column names, and the
+        # quoted 'String' column is read as one column
+        with open(fname, "r", encoding="utf-8") as f:
+            columns = f.readline().strip("# \n").split()
+        return pd.read_csv(fname, comment="#", names=columns, delim_whitespace=True)
     with open(fname, "r", encoding="utf-8") as f:
         lines = f.readlines()
         index = lines.index("# Format topcat: \n")
         header = lines[index + 1]
     columns = header.split()[1:header.split().index("MAG_OBS0")]
-    if out:
-        additional1 = [give_nice_band_name(band) for band in BAND_LIST]
-        additional2 = [give_nice_band_name(
-            band, err=True) for band in BAND_LIST]
-        columns = columns + additional1 + additional2
-    else:
-        raise NotImplementedError
-    df = pd.read_csv(fname, comment="#", names=columns, delim_whitespace=True)
-    return df
+    additional1 = [give_nice_band_name(band) for band in BAND_LIST]
+    additional2 = [give_nice_band_name(
+        band, err=True) for band in BAND_LIST]
+    columns = columns + additional1 + additional2
+    float32_cols = {col: dtype for col, dtype in give_dtype_plan(columns).items()
+                    if dtype == "float32"}
+    df = pd.read_csv(fname, comment="#", names=columns, delim_whitespace=True,
+                     dtype=float32_cols)
+    return apply_dtype_plan(df)
 
 
 def save_dataframe_as_fits(df, filename, overwrite=False):
@@ -380,21 +637,58 @@ def save_dataframe_as_fits(df, filename, overwrite=False):
     LOGGER.info("Successfully saved the dataframe at %s.", fpath)
 
 
+def give_saved_df_fpaths(cat_type="out"):
+    """Provides the paths of the pointlike and extended fits files read by read_saved_df."""
+    is_out = (cat_type == "out")
+    if cat_type == "in_processed":
+        return {ttype: give_processed_table_name(ttype) for ttype in USED_TTYPES}
+    return {ttype: give_lephare_filename(ttype, out=is_out, suffix=".fits") for ttype in USED_TTYPES}
+
+
+_DATASET_CACHE = None
+
+
+def give_dataset_cache():
+    """Returns the cache sharing the datasets between processes (see util/dataset_server.py),
+    or None if it is disabled."""
+    global _DATASET_CACHE
+    if not CUR_CONFIG["GENERAL"].getboolean("dataset_cache", fallback=False):
+        return None
+    if _DATASET_CACHE is None:
+        # Only imported when needed, as it is not used by most of the scripts
+        from util.dataset_server import DatasetCache
+        max_gb = CUR_CONFIG["GENERAL"].getfloat("dataset_cache_gb", fallback=8)
+        _DATASET_CACHE = DatasetCache(GEN_CONFIG["PATHS"]["data"] + "dataset_cache/",
+                                      int(max_gb * 1024**3))
+    return _DATASET_CACHE
+
+
+@profiling.profile_stage()
 def read_saved_df(cat_type="out"):
-    """Reads the pointlike and extended fits input file."""
+    """Reads the pointlike and extended fits input file.
+    If the dataset cache is enabled, the result is shared with the other processes
+    as memory-mapped columns."""
+    cache = give_dataset_cache()
+    if cache is None:
+        joined = _read_saved_df(cat_type)
+    else:
+        fpaths = list(give_saved_df_fpaths(cat_type).values())
+        joined = cache.give(f"saved_df_{cat_type}", fpaths, lambda: _read_saved_df(cat_type))
+    profiling.record_rows(len(joined))
+    return joined
+
+
+def _read_saved_df(cat_type):
+    """Reads and combines the fits files of the given cat_type (see read_saved_df)."""
     df_list = []
     is_out = (cat_type == "out")
-    for ttype in USED_TTYPES:
-        if cat_type in ["in", "out"]:
-            fpath = give_lephare_filename(ttype, out=is_out, suffix=".fits")
-        if cat_type == "in_processed":
-            fpath = give_processed_table_name(ttype)
-        df = read_fits_as_dataframe(fpath)
-        df["Type"] = ttype
+    for ttype, fpath in give_saved_df_fpaths(cat_type).items():
+        df = apply_dtype_plan(read_fits_as_dataframe(fpath))
+        df["Type"] = give_ttype_column(ttype, len(df))
         df_list.append(df)
     joined = pd.concat(df_list)
     joined = add_filter_columns(joined) if is_out else add_mag_columns(joined)
-    return joined
+    return apply_dtype_plan(joined)
 
 
 def read_glb_context(fname):
@@ -419,7 +713,16 @@ def read_ascii_as_dataframe(filename):
 
 
 def read_template_library():
-    """Reads the template library .dat files"""
+    """Reads the template library .dat files (shared via the dataset cache if it is enabled)."""
+    cache = give_dataset_cache()
+    if cache is None:
+        return _read_template_library()
+    fpaths = [give_temp_libname(ttype, suffix=".dat") for ttype in USED_TTYPES]
+    return cache.give("template_library", fpaths, _read_template_library)
+
+
+def _read_template_library():
+    """Reads and combines the template library .dat files of the used ttypes."""
     df_list = []
     for ttype in USED_TTYPES:
         fpath = give_temp_libname(ttype, suffix=".dat")
@@ -429,11 +732,12 @@ def read_template_library():
         cols = coltext.split()[1:]  # remove the hashtag
         cols = cols[:-3] + [f"mag_{band}"for band in BAND_LIST]
         cols = cols + [f"mag_err_{band}"for band in BAND_LIST]
+        float32_cols = {col: "float32" for col in cols if col.startswith("mag_")}
         df = pd.read_csv(fpath, delim_whitespace=True,
-                         header=None, skiprows=1, names=cols)
+                         header=None, skiprows=1, names=cols, dtype=float32_cols)
         df = df.rename(columns={"redshift": "ZSPEC"})
-        df["Type"] = ttype
-        df_list.append(df)
+        df["Type"] = give_ttype_column(ttype, len(df))
+        df_list.append(apply_dtype_plan(df))
     joined = pd.concat(df_list)
     return joined
 
@@ -508,49 +812,61 @@ def prepare_dataframe(df, is_input=True):
     return df
 
 
-def calculate_used_context(series, cols):
-    """Calculates the context of bands actually used.
+def calculate_used_context(mags):
+    """Calculates the context of bands actually used from an array of magnitudes
+    (one column per band, in the order of the context bits).
     TODO: Consider forbidden context"""
-    context = 0
-    for i, col in enumerate(cols):
-        if series[col] > 0 and series[col] < 50:
-            context += 2**i
-    return context
+    used = (mags > 0) & (mags < 50)
+    return used.astype(np.int32) @ (2**np.arange(used.shape[1], dtype=np.int32))
 
 
 def add_filter_columns(df):
-    """Adds columns with lists of the used filters and the count of these
+    """Adds columns with the context of the used filters and the count of these
     filters.
+    The lists of the band numbers of the filters used (the former filter_list column)
+    can be obtained via give_filter_lists.
     """
     mycols = [col for col in df.columns if "MAG" in col and "ERR" not in col]
-    df["used_context"] = df[mycols].apply(
-        lambda x: calculate_used_context(x, mycols), axis=1)
-    df["filter_list"] = df.apply(convert_context_to_band_indices, axis=1)
-    # this way, for each list the length is taken
-    df["nfilters"] = df["filter_list"].str.len()
+    mags = df[mycols].to_numpy(dtype=np.float32)
+    used_context = calculate_used_context(mags)
+    df["used_context"] = used_context
+    # A context of 0 corresponds to all bands being used
+    nfilters = ((mags > 0) & (mags < 50)).sum(axis=1)
+    df["nfilters"] = np.where(used_context > 0, nfilters,
+                              len(BAND_LIST)).astype(np.int8)
     # rename capitalized mag columns
     cols = [col for col in df.columns if "mag" in col]
     newnames = [col.replace("_", "-")
                 .replace("mag-", "mag_")
                 .replace("err-mag-", "mag_err_") for col in cols]
     df = df.rename(columns=dict(zip(cols, newnames)))
-    cols = [col for col in df.columns if "mag" in col]
-    for col in newnames:
-        df.loc[(df[col] <= 0) | (df[col] > 98.0), col] = None
+    mags = df[newnames]
+    df[newnames] = mags.where((mags > 0) & (mags <= 98.0))
     return add_outlier_information(df)
 
 
+def give_used_band_counts(used_context):
+    """Counts how often each of the bands in BAND_LIST has been used, given a
+    series of contexts (where a context <= 0 means all bands are used)."""
+    contexts = np.asarray(used_context, dtype=np.int64)[:, None]
+    bits = (contexts >> np.arange(len(BAND_LIST))) & 1
+    bits[contexts[:, 0] <= 0] = 1
+    return bits.sum(axis=0)
+
+
 def add_outlier_information(df):
     """Adds information on the outliers of the dataframe.
     Renames Z_BEST to ZBEST."""
     if "Z_BEST" in df.columns:
         df = df.rename(columns={"Z_BEST": "ZBEST"})
-    df["ZMeasure"] = (df["ZBEST"] - df["ZSPEC"]) / (1 + df["ZSPEC"])
+    df["ZMeasure"] = ((df["ZBEST"] - df["ZSPEC"]) /
+                      (1 + df["ZSPEC"])).astype(np.float32)
     df["IsOutlier"] = abs(df["ZMeasure"]) > 0.15
     df["HasGoodz"] = ((df["ZSPEC"] > 0) & (df["ZBEST"] > 0))
     df["IsFalsePositive"] = ((df["ZSPEC"] < 0.5) & (df["ZBEST"] > 0.5))
     df["IsFalseNegative"] = ((df["ZSPEC"] > 0.5) & (df["ZBEST"] < 0.5))
-    df["TemplateScore"] = np.exp(-df["ZMeasure"] - df["CHI_BEST"] / 2)
+    df["TemplateScore"] = np.exp(
+        -df["ZMeasure"] - df["CHI_BEST"] / 2).astype(np.float32)
     return df
 
 
@@ -574,14 +890,11 @@ def give_output_statistics(df, filters_used=False) -> dict:
     psi_pos = df['IsFalsePositive'].sum() / source_num
     psi_neg = df['IsFalseNegative'].sum() / source_num
     if filters_used:
-        df_good = df[~df["IsOutlier"]]
-        df_bad = df[df["IsOutlier"]]
-        bads = [item for sublist in df_bad["filter_list"] for item in sublist]
-        goods = [item for sublist in df_good["filter_list"]
-                 for item in sublist]
+        goods = give_used_band_counts(df[~df["IsOutlier"]]["used_context"])
+        bads = give_used_band_counts(df[df["IsOutlier"]]["used_context"])
         LOGGER.info("Filter\tgood photoz\tbad photoz")
         for n, filt in enumerate(BAND_LIST):
-            LOGGER.info(f"{filt}:\t{goods.count(n+1)}\t{bads.count(n+1)}")
+            LOGGER.info(f"{filt}:\t{goods[n]}\t{bads[n]}")
     stat_dict = {"eta": eta, "sig_nmad": sig_nmad,
                  "psi_pos": psi_pos, "psi_neg": psi_neg}
     return stat_dict
@@ -697,6 +1010,8 @@ def convert_context_to_band_indices(context):
     """
     if isinstance(context, pd.Series):
         context = int(context["used_context"])
+    if isinstance(context, np.integer):
+        context = int(context)
     if not isinstance(context, int):
         context = int(context)
         LOGGER.info(f"Forcing context to become {context}")
@@ -711,35 +1026,55 @@ def convert_context_to_band_indices(context):
     return filter_numbers[::-1]  # lastly, we reverse the list
 
 
+def give_filter_lists(used_context):
+    """Returns the lists of the band numbers used for each of the given contexts (e.g. the
+    used_context column), as in the filter_list column previously added by add_filter_columns."""
+    index = used_context.index if isinstance(used_context, pd.Series) else None
+    return pd.Series([convert_context_to_band_indices(int(context)) for context in used_context],
+                     index=index, dtype=object)
+
+
+def give_jystilts_argv(filename, *args, with_path=False):
+    """Returns the argument vector for running a .py file using the java jystilts
+    implementation, assuming the file is located in the 'jystilts_scripts' directory."""
+    scriptpath = "" if with_path else f"{GEN_CONFIG['PATHS']['scripts']}jystilts_scripts/"
+    return ["java", "-jar", GEN_CONFIG['PATHS']['JYSTILTS'], f"{scriptpath}{filename}", *args]
+
+
 def run_jystilts_program(filename, *args, with_path=False):
     """Runs a .py file using the java jystilts implementation,
     assuming the file is located in the 'jystilts_scripts' directory."""
-    run_jystilts = f"java -jar {GEN_CONFIG['PATHS']['JYSTILTS']}"
-    scriptpath = "" if with_path else f"{GEN_CONFIG['PATHS']['scripts']}jystilts_scripts/"
-    match_table_string = f"{run_jystilts} '{scriptpath}{filename}' {' '.join(args)}"
+    argv = give_jystilts_argv(filename, *args, with_path=with_path)
     if CUR_CONFIG["GENERAL"].getboolean("print_commands_only"):
-        print(match_table_string)
+        print(shlex.join(argv))
         return
     try:
-        subprocess.run(match_table_string, check=True, shell=True)
+        profiling.run_subprocess(argv, f"jystilts {filename}")
     except subprocess.CalledProcessError as err:
         LOGGER.error(
             "The following error was thrown when trying to run the jystilts code:\n%s", err)
 
 
-def run_lephare_command(command, arg_dict, ttype, additional=""):
-    """Runs a given LePhare command in the LePhare source file."""
-    main_command = f"{GEN_CONFIG['PATHS']['lepharedir']}/source/" + command
-    run_string = main_command + " " + \
-        " ".join([f"-{arg} {val}" for arg, val in arg_dict.items()]
-                 ) + " " + additional
+def give_lephare_argv(command, arg_dict):
+    """Returns the argument vector for a given LePhare command in the LePhare source file."""
+    argv = [f"{GEN_CONFIG['PATHS']['lepharedir']}/source/" + command]
+    for arg, val in arg_dict.items():
+        argv += [f"-{arg}", str(val)]
+    return argv
+
+
+def run_lephare_command(command, arg_dict, ttype, stdout_path=None):
+    """Runs a given LePhare command in the LePhare source file, writing its stdout to
+    stdout_path if it is given."""
+    argv = give_lephare_argv(command, arg_dict)
+    run_string = shlex.join(argv) + ("" if stdout_path is None else f" > {stdout_path}")
     if CUR_CONFIG["GENERAL"].getboolean("print_commands_only"):
         print(run_string)
         return
-    LOGGER.debug("Running the following shell command:\n%s", run_string)
+    LOGGER.debug("Running the following command:\n%s", run_string)
     LOGGER.info("Running %s for %s. This could take a while...", command, ttype)
     try:
-        subprocess.run(run_string, check=True, shell=True)
+        profiling.run_subprocess(argv, f"{command} ({ttype})", stdout_path)
     except subprocess.CalledProcessError as err:
         LOGGER.error(
             "The following error was thrown when running the last shell command:\n%s", err)
@@ -786,11 +1121,16 @@ def log_run_info():
                     CONTEXT, give_bands_for_context(CONTEXT))
 
 
+# Lock for appending to the stats file from several threads
+STATS_FILE_LOCK = threading.Lock()
+
+
 def assess_lephare_run(ttype, write=False):
     """Directly assess the quality of a photo-z run."""
-    df = read_fits_as_dataframe(
-        give_lephare_filename(ttype, out=True, suffix=".fits"))
-    df = add_filter_columns(df)
+    # Only the columns needed for the statistics are read
+    df = read_fits_as_dataframe(give_lephare_filename(ttype, out=True, suffix=".fits"),
+                                columns=["Z_BEST", "ZSPEC", "CHI_BEST"])
+    df = add_outlier_information(df)
     stat_dict = give_output_statistics(df)
     fpos = df['IsFalsePositive'].sum()
     fneg = df['IsFalseNegative'].sum()
@@ -818,11 +1158,13 @@ def assess_lephare_run(ttype, write=False):
     text = " & ".join([f"${stat_dict[key]:.3f}$" if not isinstance(
         stat_dict[key], str) else stat_dict[key] for key in order]) + " \\\\\n"
     fname = give_statsfile_fname()
-    if not isfile(fname):
-        # Write a header if the stats file is not yet available:
-        text = " & ".join(order) + " \\\\\n" + text
-    with open(fname, "a", encoding="utf-8") as f:
-        f.write(text)
+    # The assessments of several ttypes may run concurrently (see runner_commands)
+    with STATS_FILE_LOCK:
+        if not isfile(fname):
+            # Write a header if the stats file is not yet available:
+            text = " & ".join(order) + " \\\\\n" + text
+        with open(fname, "a", encoding="utf-8") as f:
+            f.write(text)
     LOGGER.info("Wrote the results to the stats file at '%s'", fname)
 
 
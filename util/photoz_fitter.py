@@ -0,0 +1,407 @@
+"""
+Built-in photo-z template fitter, a fast alternative backend to the LePhare zphota
+binary for exploratory runs (selected via zphota_backend = python in the LEPHARE section).
+
+For each source, the chi^2 of every grid point (template, E(B-V), redshift) of the
+magnitude library is computed with the best-fitting flux normalisation, which is solved
+analytically. The sources are fitted in blocks, which can be distributed over several
+processes sharing the template grid via fork (copy-on-write).
+Only the bands available for a source and allowed by its context and the GLB_CONTEXT
+are used, and grid points violating the MAG_ABS prior in the MAG_REF band are discarded.
+Optionally, a coarse-to-fine redshift search can be used instead of evaluating all grid points.
+In contrast to zphota, no systematic shifts or error rescaling are applied, and no star
+library is fitted: the star columns (CHI_STAR, MOD_STAR) are set to -99. As the
+pointlike sources rely on the galaxy/star chi^2 comparison, this backend refuses to
+fit them. The input needs to be given as AB fluxes or magnitudes (INP_TYPE F or M and
+CAT_MAG AB in the parameter file).
+The secondary solution (Z_SEC, CHI_SEC, MOD_SEC) is not searched for either and set to -99,
+while all other columns of the LePhare output are computed.
+"""
+import multiprocessing
+import time
+
+import numpy as np
+import pandas as pd
+from astropy.table import Table
+
+import util.my_tools as mt
+import util.source_index as s_i
+from util import profiling
+
+# Number of sources fitted at once
+BLOCK_SIZE = 2000
+# Value used for sources that couldn't be fitted (as done by LePhare)
+NO_FIT = -99
+# The template grid shared with the worker processes
+_GRID = None
+# The ttypes that need a star fit and can't be fitted with this backend
+UNSUPPORTED_TTYPES = ("pointlike",)
+
+
+class TemplateGrid:
+    """The model fluxes of all (template, E(B-V), redshift) grid points of a magnitude
+    library, sorted by redshift, together with the information needed for the prior."""
+
+    def __init__(self, temp_df):
+        temp_df = temp_df.sort_values("ZSPEC", kind="stable").reset_index(drop=True)
+        mags = temp_df[[f"mag_{band}" for band in mt.BAND_LIST]].to_numpy(dtype=float)
+        self.valid = (mags > 0) & (mags < 50)
+        self.fluxes = np.where(self.valid, 10**(-0.4 * (mags + 48.6)), 0.)
+        # Precomputed (band, grid point) terms for the matrix products of the fit
+        self.fluxes_t = np.ascontiguousarray(self.fluxes.T)
+        self.fluxes_sq_t = np.ascontiguousarray(self.fluxes.T**2)
+        self.invalid_t = np.ascontiguousarray((~self.valid).T, dtype=float)
+        self.mags = mags
+        self.model = temp_df["model"].to_numpy(dtype=np.int64)
+        self.ebv = temp_df["E(B-V)"].to_numpy(dtype=float)
+        self.z = temp_df["ZSPEC"].to_numpy(dtype=float)
+        self.z_grid, self.z_starts = np.unique(self.z, return_index=True)
+        self.z_index = np.searchsorted(self.z_grid, self.z)
+        # Each (template, extinction law, E(B-V)) track gets an id, and the lookup table
+        # gives the grid point of each (track, redshift) pair (-1 if not in the library)
+        ext_law = temp_df["ext_law"].to_numpy(dtype=float) \
+            if "ext_law" in temp_df else np.zeros(len(temp_df))
+        _, self.track_id = np.unique(np.column_stack([self.model, ext_law, self.ebv]),
+                                     axis=0, return_inverse=True)
+        self.track_id = self.track_id.ravel()
+        self.ext_law = ext_law.astype(np.int64)
+        self.lookup = np.full((self.track_id.max() + 1, len(self.z_grid)), -1, dtype=np.int64)
+        self.lookup[self.track_id, self.z_index] = np.arange(len(self.z))
+        self.dist_mod = temp_df["distance_modulus"].to_numpy(dtype=float) \
+            if "distance_modulus" in temp_df else np.zeros(len(temp_df))
+        # The k-corrections of the library are read into the mag_err_ columns
+        self.kcor = temp_df[[f"mag_err_{band}" for band in mt.BAND_LIST]].to_numpy(dtype=float)
+        self.ref_index = None
+        self.mag_abs = None
+
+    def __len__(self):
+        return len(self.z)
+
+    def set_prior(self, mag_ref=None, mag_abs=None):
+        """Sets the MAG_ABS prior (a range given as 'min,max', disabled by '0,0') in the band
+        with the number MAG_REF (starting at 1)."""
+        if mag_ref is None or mag_abs is None:
+            return
+        low, high = sorted(float(val) for val in mag_abs.split(","))
+        if low == high == 0:
+            return
+        self.ref_index = int(mag_ref) - 1
+        self.mag_abs = (low, high)
+
+    def give_prior_violations(self, scale, columns=None):
+        """Returns a boolean array (source, grid point) marking the grid points at which the
+        absolute magnitude of the scaled template lies outside of the MAG_ABS range.
+        columns are the grid indices of the scale columns (see give_chi2)."""
+        if self.mag_abs is None:
+            return np.zeros(scale.shape, dtype=bool)
+        columns = slice(None) if columns is None else columns
+        ref = self.ref_index
+        with np.errstate(divide="ignore", invalid="ignore"):
+            abs_mag = self.mags[columns, ref] - 2.5 * np.log10(scale) - \
+                self.dist_mod[columns] - self.kcor[columns, ref]
+        violated = (abs_mag < self.mag_abs[0]) | (abs_mag > self.mag_abs[1])
+        # The prior can't be evaluated at z = 0
+        return violated & (self.z[columns] > 0)
+
+    def give_coarse_columns(self, coarse_factor):
+        """Returns the grid indices of every coarse_factor-th redshift step of each track."""
+        columns = self.lookup[:, ::coarse_factor].ravel()
+        return np.sort(columns[columns >= 0])
+
+    def give_refined_columns(self, basins, coarse_factor):
+        """Returns the grid indices (source, candidate) of all redshift steps of the track of
+        each basin (source, basin) that lie within one coarse step of the basin."""
+        offsets = np.arange(1 - coarse_factor, coarse_factor)
+        z_index = np.clip(self.z_index[basins][..., None] + offsets, 0, len(self.z_grid) - 1)
+        columns = self.lookup[self.track_id[basins][..., None], z_index]
+        # Steps outside of the library are replaced by the basin itself
+        columns = np.where(columns >= 0, columns, basins[..., None])
+        return columns.reshape(len(basins), -1)
+
+
+def assert_fit_supported(ttypes):
+    """Raises a ValueError if the built-in fitter can't fit the given ttypes or the input
+    format set in the parameter file.
+    returns:
+        The input type (F for fluxes, M for magnitudes)."""
+    unsupported = [ttype for ttype in ttypes if ttype in UNSUPPORTED_TTYPES]
+    if unsupported:
+        raise ValueError(f"The built-in fitter (zphota_backend = python) doesn't fit the star "
+                         f"library needed for the {', '.join(unsupported)} sources, use "
+                         "zphota_backend = lephare for them.")
+    inp_type, cat_mag = mt.give_para_value("INP_TYPE"), mt.give_para_value("CAT_MAG")
+    if inp_type not in ("F", "M") or cat_mag not in (None, "AB"):
+        raise ValueError(f"The built-in fitter only supports AB fluxes or magnitudes as input, "
+                         f"but INP_TYPE = {inp_type} and CAT_MAG = {cat_mag} are set.")
+    return inp_type
+
+
+def give_source_arrays(df, inp_type="F"):
+    """Returns the fluxes, errors and a boolean array of the bands used for the fit
+    (available and allowed by the source context and the GLB_CONTEXT) of a LePhare input
+    DataFrame with AB fluxes (inp_type F) or magnitudes (M)."""
+    fluxes = df[mt.BAND_LIST].to_numpy(dtype=float)
+    errors = df[[f"{band}_err" for band in mt.BAND_LIST]].to_numpy(dtype=float)
+    if inp_type == "M":
+        valid = (fluxes > 0) & (fluxes < 50) & (errors > 0)
+        fluxes = np.where(valid, 10**(-0.4 * (fluxes + 48.6)), -99.)
+        errors = np.where(valid, 0.4 * np.log(10) * fluxes * errors, -99.)
+    # A context <= 0 means that all bands are used
+    context = df["CONTEXT"].to_numpy(dtype=np.int64)
+    context = np.where(context > 0, context, 2**len(mt.BAND_LIST) - 1)
+    if mt.CONTEXT > 0:
+        context &= mt.CONTEXT
+    allowed = (context[:, None] >> np.arange(len(mt.BAND_LIST))) & 1 == 1
+    used = allowed & (fluxes > 0) & (errors > 0)
+    return fluxes, errors, used
+
+
+def give_weights(fluxes, errors, used):
+    """Returns the weights w = 1/sigma^2, the weighted fluxes w F (both 0 for unused bands)
+    and C = sum(w F^2) of each source."""
+    weights = np.where(used, 1 / np.where(used, errors, 1)**2, 0.)
+    weighted_fluxes = np.where(used, weights * fluxes, 0.)
+    const = np.einsum("nb,nb->n", weighted_fluxes, np.where(used, fluxes, 0.))
+    return weights, weighted_fluxes, const
+
+
+def give_chi2(grid, weights, weighted_fluxes, const, used, columns=None):
+    """Computes the chi^2 and best scales of the sources at the given grid points.
+    With the weights w = 1/sigma^2, the best scale of a grid point is s = A/B with
+    A = sum(w F T) and B = sum(w T^2), and its chi^2 is C - A^2/B with C = sum(w F^2),
+    so the whole (source, grid point) array is given by two matrix products.
+    parameters:
+        [columns]: array
+            The grid indices to evaluate, either shared by all sources (1D) or given for
+            each source (2D, source x candidate). By default, all grid points are used.
+    returns:
+        The chi^2 (inf for invalid grid points) and the scales, both (source, column)."""
+    if columns is None or columns.ndim == 1:
+        fluxes_t = grid.fluxes_t if columns is None else grid.fluxes_t[:, columns]
+        fluxes_sq_t = grid.fluxes_sq_t if columns is None else grid.fluxes_sq_t[:, columns]
+        invalid_t = grid.invalid_t if columns is None else grid.invalid_t[:, columns]
+        numerator = weighted_fluxes @ fluxes_t
+        denominator = weights @ fluxes_sq_t
+        missing = used.astype(float) @ invalid_t > 0
+    else:
+        # Few candidates per source, so the per-source templates can be gathered
+        temp_fluxes = grid.fluxes[columns]
+        numerator = np.einsum("nb,nmb->nm", weighted_fluxes, temp_fluxes)
+        denominator = np.einsum("nb,nmb->nm", weights, temp_fluxes**2)
+        missing = (used[:, None, :] & ~grid.valid[columns]).any(axis=2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = numerator / denominator
+        chi2 = const[:, None] - numerator * scale
+    # Cancellation can lead to slightly negative values for perfect fits
+    np.maximum(chi2, 0, out=chi2)
+    # Grid points without model magnitudes in a used band can't be fitted
+    invalid = missing | ~(scale > 0) | grid.give_prior_violations(scale, columns)
+    chi2[invalid] = np.inf
+    return chi2, scale
+
+
+def fit_block(grid, fluxes, errors, used, coarse_factor=1, top_k=5, tolerance=np.inf):
+    """Fits a block of sources to the grid points.
+    With a coarse_factor > 1, a coarse-to-fine search is done: The chi^2 is first evaluated
+    on every coarse_factor-th redshift step of each track, and only around the top_k coarse
+    minima (basins) per source within tolerance of the best coarse chi^2, all redshift
+    steps of the corresponding track are evaluated. Otherwise, all grid points are used.
+    returns:
+        Dictionary with the best-fit index (-1 if no fit was possible), the best chi^2 and scale
+        and the P(z) (source, redshift) of the sources."""
+    weights, weighted_fluxes, const = give_weights(fluxes, errors, used)
+    if coarse_factor <= 1:
+        chi2, scale = give_chi2(grid, weights, weighted_fluxes, const, used)
+        return summarize_chi2(grid, chi2, scale)
+    coarse_columns = grid.give_coarse_columns(coarse_factor)
+    coarse_chi2, coarse_scale = give_chi2(grid, weights, weighted_fluxes, const, used,
+                                          coarse_columns)
+    top_k = min(top_k, len(coarse_columns))
+    basin_index = np.argpartition(coarse_chi2, top_k - 1, axis=1)[:, :top_k]
+    basin_chi2 = np.take_along_axis(coarse_chi2, basin_index, axis=1)
+    # Basins too far above the best one are replaced by the best one
+    best_basin = basin_index[np.arange(len(basin_index)), np.argmin(basin_chi2, axis=1)]
+    with np.errstate(invalid="ignore"):
+        too_far = basin_chi2 > basin_chi2.min(axis=1, keepdims=True) + tolerance
+    basins = coarse_columns[np.where(too_far, best_basin[:, None], basin_index)]
+    fine_columns = grid.give_refined_columns(basins, coarse_factor)
+    fine_chi2, fine_scale = give_chi2(grid, weights, weighted_fluxes, const, used, fine_columns)
+    columns = np.hstack([np.broadcast_to(coarse_columns, coarse_chi2.shape), fine_columns])
+    return summarize_chi2(grid, np.hstack([coarse_chi2, fine_chi2]),
+                          np.hstack([coarse_scale, fine_scale]), columns)
+
+
+def summarize_chi2(grid, chi2, scale, columns=None):
+    """Extracts the best fits and the P(z) from the chi^2 array (source, column), where
+    columns gives the grid index of each entry (by default, the columns are the full grid).
+    For a partial grid, the P(z) is only sampled at the evaluated redshifts."""
+    best_column = np.argmin(chi2, axis=1)
+    rows = np.arange(len(chi2))
+    chi_best = chi2[rows, best_column]
+    best = best_column if columns is None else columns[rows, best_column]
+    has_fit = np.isfinite(chi_best)
+    # P(z) from the minimum chi^2 at each redshift
+    if columns is None:
+        # The full grid is sorted by redshift
+        chi2_z = np.minimum.reduceat(chi2, grid.z_starts, axis=1)
+    else:
+        chi2_z = np.full((len(chi2), len(grid.z_grid)), np.inf)
+        np.minimum.at(chi2_z, (np.broadcast_to(rows[:, None], chi2.shape),
+                               grid.z_index[columns]), chi2)
+    with np.errstate(invalid="ignore"):
+        pdz = np.exp(-(chi2_z - np.where(has_fit, chi_best, 0)[:, None]) / 2)
+    norm = pdz.sum(axis=1, keepdims=True)
+    pdz = np.divide(pdz, norm, out=np.zeros_like(pdz), where=norm > 0)
+    return {"best": np.where(has_fit, best, -1), "chi_best": chi_best,
+            "scale_best": scale[rows, best_column], "pdz": pdz.astype(np.float32)}
+
+
+def give_search_settings():
+    """Returns the settings of the redshift search (see fit_block) given in the LEPHARE section."""
+    config = mt.CUR_CONFIG["LEPHARE"]
+    return {"coarse_factor": config.getint("fit_coarse_factor", fallback=1),
+            "top_k": config.getint("fit_top_k", fallback=5),
+            "tolerance": config.getfloat("fit_tolerance", fallback=np.inf)}
+
+
+def _fit_block_worker(block):
+    """Fits a block of (fluxes, errors, used, search settings) with the grid shared by the
+    parent process."""
+    fluxes, errors, used, search = block
+    return fit_block(_GRID, fluxes, errors, used, **search)
+
+
+def fit_sources(grid, fluxes, errors, used, num_processes=1, search=None):
+    """Fits all sources in blocks of BLOCK_SIZE, using num_processes worker processes
+    that share the template grid (only if fork is available).
+    search are the keyword arguments for the redshift search of fit_block."""
+    global _GRID
+    _GRID = grid
+    search = {} if search is None else search
+    blocks = [(fluxes[start:start + BLOCK_SIZE], errors[start:start + BLOCK_SIZE],
+               used[start:start + BLOCK_SIZE], search)
+              for start in range(0, len(fluxes), BLOCK_SIZE)]
+    if num_processes > 1 and "fork" in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context("fork").Pool(num_processes) as pool:
+            results = pool.map(_fit_block_worker, blocks)
+    else:
+        results = [_fit_block_worker(block) for block in blocks]
+    return {key: np.concatenate([result[key] for result in results]) for key in results[0]}
+
+
+def give_pdz_summary(grid, pdz, z_best):
+    """Returns the median of the P(z) (Z_ML) and the probability (in percent) within
+    0.1 (1 + z) of z_best (PDZ_BEST) of each source."""
+    cdf = np.cumsum(pdz, axis=1)
+    z_ml = grid.z_grid[np.argmax(cdf >= 0.5, axis=1)]
+    close = np.abs(grid.z_grid[None, :] - z_best[:, None]) <= 0.1 * (1 + z_best[:, None])
+    return z_ml, 100 * (pdz * close).sum(axis=1)
+
+
+def give_result_table(df, grid, fit, fluxes, errors, used):
+    """Returns a DataFrame in the format of the rewritten LePhare .fits output (with the
+    columns of the output parameter file, see the module docstring for those set to -99)."""
+    has_fit = fit["best"] >= 0
+    best = np.where(has_fit, fit["best"], 0)
+    z_ml, pdz_best = give_pdz_summary(grid, fit["pdz"], grid.z[best])
+    not_computed = np.full(len(df), NO_FIT)
+    result = pd.DataFrame({
+        "IDENT": df["IDENT"].to_numpy(),
+        "Z_BEST": np.where(has_fit, grid.z[best], NO_FIT),
+        "Z_ML": np.where(has_fit, z_ml, NO_FIT),
+        "CHI_BEST": np.where(has_fit, fit["chi_best"], NO_FIT),
+        "MOD_BEST": np.where(has_fit, grid.model[best], NO_FIT),
+        "EXTLAW_BEST": np.where(has_fit, grid.ext_law[best], NO_FIT),
+        "EBV_BEST": np.where(has_fit, grid.ebv[best], NO_FIT),
+        "PDZ_BEST": np.where(has_fit, pdz_best, NO_FIT),
+        "SCALE_BEST": np.where(has_fit, fit["scale_best"], NO_FIT),
+        "NBAND_USED": used.sum(axis=1),
+        "Z_SEC": not_computed,
+        "CHI_SEC": not_computed,
+        "MOD_SEC": not_computed,
+        "CHI_STAR": not_computed,
+        "MOD_STAR": not_computed,
+        "CONTEXT": df["CONTEXT"].to_numpy(),
+        "ZSPEC": df["ZSPEC"].to_numpy()})
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mags = np.where(fluxes > 0, mt.flux_to_AB(fluxes), NO_FIT)
+        mag_errs = np.where(fluxes > 0, 2.5 / np.log(10) * errors / fluxes, NO_FIT)
+    for i, band in enumerate(mt.BAND_LIST):
+        result[mt.give_nice_band_name(band)] = mags[:, i]
+        result[mt.give_nice_band_name(band, err=True)] = mag_errs[:, i]
+    return result
+
+
+def validate_search(df, grid, fluxes, errors, used, search, num_processes=1):
+    """Compares the results of the given (coarse-to-fine) redshift search with those of
+    the exhaustive search over all grid points.
+    returns:
+        Dictionary with the fit times, the fraction of sources with a different best-fit grid
+        point, the median and maximum |delta Z_BEST|, the mean chi^2 increase, and eta and
+        sig_nmad of both searches."""
+    report = {}
+    results = {}
+    for name, settings in [("exhaustive", {"coarse_factor": 1}), ("search", search)]:
+        start = time.perf_counter()
+        fit = fit_sources(grid, fluxes, errors, used, num_processes, settings)
+        report[f"time_{name}"] = time.perf_counter() - start
+        results[name] = fit
+        result = mt.add_outlier_information(give_result_table(df, grid, fit, fluxes, errors, used))
+        for key, value in mt.give_output_statistics(result).items():
+            if key in ["eta", "sig_nmad"]:
+                report[f"{key}_{name}"] = value
+        report[f"z_{name}"] = result["ZBEST"].to_numpy()
+    has_fit = (results["exhaustive"]["best"] >= 0) & (results["search"]["best"] >= 0)
+    delta_z = np.abs(report.pop("z_search") - report.pop("z_exhaustive"))[has_fit]
+    delta_chi2 = results["search"]["chi_best"][has_fit] - results["exhaustive"]["chi_best"][has_fit]
+    report["speedup"] = report["time_exhaustive"] / report["time_search"]
+    report["frac_changed"] = np.mean(
+        results["search"]["best"] != results["exhaustive"]["best"])
+    report["median_delta_z"] = np.median(delta_z) if len(delta_z) > 0 else np.nan
+    report["max_delta_z"] = delta_z.max() if len(delta_z) > 0 else np.nan
+    report["mean_delta_chi2"] = delta_chi2.mean() if len(delta_chi2) > 0 else np.nan
+    return report
+
+
+def write_search_validation(report, ttype, search):
+    """Writes the validation report of the redshift search for ttype and logs a summary."""
+    fpath = mt.give_lephare_filename(ttype, out=True, suffix="_search_validation.txt")
+    with open(fpath, "w", encoding="utf-8") as f:
+        f.write(f"# Coarse-to-fine search {search} vs. exhaustive search for {ttype}\n")
+        for key, value in report.items():
+            f.write(f"{key}\t{value:.6g}\n")
+    mt.LOGGER.info("Coarse-to-fine search for %s: %.1fx faster, eta %.4f -> %.4f, "
+                   "sig_nmad %.4f -> %.4f, %.2f%% of the best fits changed (see '%s').",
+                   ttype, report["speedup"], report["eta_exhaustive"], report["eta_search"],
+                   report["sig_nmad_exhaustive"], report["sig_nmad_search"],
+                   100 * report["frac_changed"], fpath)
+
+
+@profiling.profile_stage()
+def run_python_zphota(ttype):
+    """Fits the LePhare input sources of ttype with the built-in fitter and writes the
+    results to the .fits output file and the P(z) to a _pdz.npz file."""
+    inp_type = assert_fit_supported([ttype])
+    df = mt.read_ascii_as_df(mt.give_lephare_filename(ttype), out=False)
+    fluxes, errors, used = give_source_arrays(df, inp_type)
+    temp_df = mt.read_template_library()
+    grid = TemplateGrid(temp_df[temp_df["Type"] == ttype])
+    mag_abs_settings = mt.give_mag_abs_settings(ttype)
+    grid.set_prior(mag_abs_settings.get("MAG_REF"), mag_abs_settings.get("MAG_ABS"))
+    num_processes = mt.CUR_CONFIG["LEPHARE"].getint("fit_processes", fallback=1)
+    search = give_search_settings()
+    if search["coarse_factor"] > 1 and \
+            mt.CUR_CONFIG["LEPHARE"].getboolean("fit_validate_search", fallback=False):
+        report = validate_search(df, grid, fluxes, errors, used, search, num_processes)
+        write_search_validation(report, ttype, search)
+    mt.LOGGER.info("Fitting %d %s sources to %d grid points with the built-in fitter.",
+                   len(df), ttype, len(grid))
+    fit = fit_sources(grid, fluxes, errors, used, num_processes, search)
+    result = s_i.add_sweep_idents(give_result_table(df, grid, fit, fluxes, errors, used), ttype)
+    fpath = mt.give_lephare_filename(ttype, out=True, suffix=".fits")
+    Table.from_pandas(result).write(fpath, overwrite=True)
+    np.savez(mt.give_lephare_filename(ttype, out=True, suffix="_pdz.npz"),
+             ident=result["IDENT"].to_numpy(), z=grid.z_grid, pdz=fit["pdz"])
+    profiling.record_rows(len(result))
+    mt.LOGGER.info("Wrote the results of the built-in fitter to %s.", fpath)
+    return result
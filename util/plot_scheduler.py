@@ -0,0 +1,131 @@
+"""
+Scheduler for producing the independent figures of the plot containers in parallel.
+
+The containers (and thus their DataFrames) are loaded only once in the main process.
+Where the 'fork' start method is available (Linux), the worker processes are forked
+afterwards so they inherit the data read-only via copy-on-write instead of having to
+read or pickle it again.
+With the 'spawn' start method (Windows, the macOS default), each worker has to rebuild
+the containers from the factories they were registered with. This is only done if the
+dataset cache is enabled (GENERAL dataset_cache, see util/dataset_server.py), so the
+workers map the tables the main process has stored instead of reading them again;
+otherwise the plots are produced sequentially.
+Each worker renders its figures using the non-interactive Agg backend.
+"""
+import multiprocessing as mp
+import os
+import time
+
+import matplotlib.pyplot as plt
+
+import util.my_tools as mt
+from util import profiling
+
+# The containers need to be known before forking so the workers inherit them
+_CONTAINERS = {}
+
+
+def _init_worker(factories=None, plot_policy=None):
+    """Switches to a non-interactive backend in each of the worker processes, and
+    rebuilds the containers from the given factories and adopts the plot overwrite
+    policy of the main process (in spawned workers)."""
+    plt.switch_backend("Agg")
+    if plot_policy is not None:
+        mt.PLOT_OVERWRITE_POLICY = plot_policy
+    if factories is not None:
+        for name, (cls, args, kwargs) in factories.items():
+            _CONTAINERS[name] = cls(*args, **kwargs)
+
+
+def _run_task(task):
+    """Runs the given plotting task and closes all of its figures.
+    returns:
+        The description of the task, its profiling record and an error message (or None)."""
+    container_name, method_name, args, kwargs = task
+    description = f"{container_name}.{method_name}{args if args else ''}"
+    error = None
+    with profiling.stage(description, pid=os.getpid()) as record:
+        try:
+            getattr(_CONTAINERS[container_name], method_name)(*args, **kwargs)
+        except Exception as e:  # The remaining plots should still be produced
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            plt.close("all")
+    return description, record, error
+
+
+class PlotScheduler:
+    """Collects plotting tasks on plot containers and runs them, in parallel if possible."""
+
+    def __init__(self, num_processes=1):
+        self.num_processes = max(1, num_processes)
+        self.tasks = []
+        self.factories = {}
+
+    def add_container(self, name, container, factory=None):
+        """Registers a (loaded) plot container under the given name.
+        parameters:
+            [factory]: tuple
+                The class, args and kwargs to rebuild the container in spawned workers.
+        """
+        _CONTAINERS[name] = container
+        if factory is not None:
+            self.factories[name] = factory
+
+    def add_task(self, container_name, method_name, *args, **kwargs):
+        """Schedules the method with the given name to be called on the container."""
+        if container_name not in _CONTAINERS:
+            raise KeyError(f"No plot container named '{container_name}' registered.")
+        self.tasks.append((container_name, method_name, args, kwargs))
+
+    def _give_start_method(self):
+        """Returns the start method used to distribute the tasks to worker processes,
+        or None if they need to be run sequentially."""
+        if self.num_processes == 1 or len(self.tasks) < 2:
+            return None
+        if mt.give_plot_overwrite_policy() == "ask":
+            mt.LOGGER.info(
+                "Producing the plots sequentially since overwriting them may require user input.")
+            return None
+        if "fork" in mp.get_all_start_methods():
+            return "fork"
+        used = {task[0] for task in self.tasks}
+        if mt.give_dataset_cache() is None or not used.issubset(self.factories):
+            mt.LOGGER.warning(
+                "Parallel plotting without the 'fork' start method requires the dataset cache "
+                "(GENERAL dataset_cache), producing the plots sequentially.")
+            return None
+        return "spawn"
+
+    def run(self):
+        """Runs all scheduled tasks and clears the queue afterwards.
+        returns:
+            List of the descriptions and error messages of the tasks that failed."""
+        start = time.perf_counter()
+        start_method = self._give_start_method()
+        if start_method is not None:
+            num_processes = min(self.num_processes, len(self.tasks))
+            mt.LOGGER.info(f"Producing {len(self.tasks)} plot tasks using {num_processes} "
+                           f"{start_method}ed processes.")
+            # Spawned workers need to be told the plot policy decided in this process
+            initargs = (self.factories, mt.give_plot_overwrite_policy()) \
+                if start_method == "spawn" else ()
+            with mp.get_context(start_method).Pool(num_processes, initializer=_init_worker,
+                                                   initargs=initargs) as pool:
+                results = list(pool.imap_unordered(_run_task, self.tasks, chunksize=1))
+            # The records of the workers need to be collected in the main process:
+            profiling.add_records(record for _, record, _ in results)
+        else:
+            results = [_run_task(task) for task in self.tasks]
+        failures = []
+        for description, record, error in results:
+            if error is not None:
+                mt.LOGGER.error(f"Failed to produce {description}: {error}")
+                failures.append((description, error))
+            else:
+                mt.LOGGER.debug(
+                    f"Produced {description} in {record['wall_s']:.1f} s.")
+        mt.LOGGER.info(
+            f"Finished all plot tasks in {time.perf_counter() - start:.1f} s.")
+        self.tasks.clear()
+        return failures
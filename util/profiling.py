@@ -0,0 +1,179 @@
+"""
+Helper module for recording the wall time, CPU time (including child processes
+such as the LePhare binaries), peak memory and row counts of the pipeline stages.
+
+Stages are recorded using the stage context manager or the profile_stage decorator
+and can be nested. Each thread has its own stack of running stages, so stages running
+concurrently in worker threads (see the supervisor and run_zphota_pipelined) get the
+right parents and row counts.
+Note that cpu_s, process_children_cpu_s and peak_rss_mb are measured for the whole process,
+so they include the usage of other stages running at the same time, while thread_cpu_s
+only covers the thread of the stage.
+At the end of a run, write_report appends one JSON line per stage to the profile file
+next to the stats file.
+"""
+import functools
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from util.my_logger import LOGGER
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+RUN_ID = datetime.now().strftime("%y-%m-%d_%H:%M:%S")
+# All finished stage records of this run (only to be extended via add_records)
+RECORDS = []
+_RECORDS_LOCK = threading.Lock()
+# The records of the currently running (nested) stages of each thread
+_LOCAL = threading.local()
+
+
+def _give_active():
+    """Returns the stack of the running stages of the current thread."""
+    if not hasattr(_LOCAL, "active"):
+        _LOCAL.active = []
+    return _LOCAL.active
+
+
+def add_records(records):
+    """Adds finished stage records (e.g. of worker processes) to the records of this run."""
+    with _RECORDS_LOCK:
+        RECORDS.extend(records)
+
+
+def give_active_stage():
+    """Returns the name of the innermost running stage of the current thread (or None)."""
+    active = _give_active()
+    return active[-1]["stage"] if active else None
+
+
+def _give_max_rss_mb(who):
+    """Returns the peak resident set size of the process (or its waited-for children) in MB."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kB elsewhere
+    return max_rss / 1024**2 if sys.platform == "darwin" else max_rss / 1024
+
+
+def _give_child_cpu_time():
+    """Returns the CPU time used by all terminated and waited-for child processes
+    (of all threads of this process)."""
+    if resource is None:
+        return 0.
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@contextmanager
+def stage(name, parent=None, **info):
+    """Context manager recording the resource usage of the enclosed code as a stage.
+    Additional information (e.g. the ttype) can be provided as keyword arguments.
+    parameters:
+        [parent]: str
+            Name of the parent stage, by default the innermost running stage of the
+            current thread (to be given for stages started in worker threads).
+    yields:
+        The dictionary of the stage record, which is completed on exit."""
+    active = _give_active()
+    if parent is None and active:
+        parent = active[-1]["stage"]
+    record = {"run_id": RUN_ID, "stage": name, "parent": parent, "rows": None,
+              "thread": threading.current_thread().name, **info}
+    active.append(record)
+    wall, cpu, thread_cpu = time.perf_counter(), time.process_time(), time.thread_time()
+    child_cpu = _give_child_cpu_time()
+    try:
+        yield record
+    finally:
+        record["wall_s"] = time.perf_counter() - wall
+        record["cpu_s"] = time.process_time() - cpu
+        record["thread_cpu_s"] = time.thread_time() - thread_cpu
+        record["process_children_cpu_s"] = _give_child_cpu_time() - child_cpu
+        if resource is not None:
+            record["peak_rss_mb"] = _give_max_rss_mb(resource.RUSAGE_SELF)
+        active.remove(record)
+        add_records([record])
+        LOGGER.debug("Stage '%s' took %.2f s (%.2f s CPU, %.2f s CPU of all children).",
+                     name, record["wall_s"], record["cpu_s"], record["process_children_cpu_s"])
+
+
+@contextmanager
+def attach(record):
+    """Context manager making the given (externally timed) record the innermost running
+    stage of the current thread, e.g. for a job run in a worker thread, so the stages
+    started and rows processed within are attributed to it."""
+    active = _give_active()
+    active.append(record)
+    try:
+        yield record
+    finally:
+        active.remove(record)
+
+
+def profile_stage(name=None):
+    """Decorator recording each call of the decorated function as a stage.
+    If no name is given, the name of the function is used."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name if name is not None else func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_rows(num_rows):
+    """Adds the given number of processed rows to the innermost running stage."""
+    active = _give_active()
+    if active:
+        active[-1]["rows"] = (active[-1]["rows"] or 0) + int(num_rows)
+
+
+def run_subprocess(argv, name, stdout_path=None):
+    """Runs the given argument vector (without a shell) and records its individual
+    resource usage as a stage. The stdout is written to stdout_path if it is given.
+    raises:
+        subprocess.CalledProcessError if the command exits with a non-zero code."""
+    with stage(name, command=shlex.join(argv)) as record:
+        stdout_file = None if stdout_path is None else open(stdout_path, "wb")
+        try:
+            proc = subprocess.Popen(argv, stdout=stdout_file)
+        finally:
+            if stdout_file is not None:
+                stdout_file.close()
+        if not hasattr(os, "wait4"):
+            proc.wait()
+        else:
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            record["process_cpu_s"] = usage.ru_utime + usage.ru_stime
+            max_rss = usage.ru_maxrss
+            record["process_peak_rss_mb"] = max_rss / 1024**2 if sys.platform == "darwin" \
+                else max_rss / 1024
+        record["returncode"] = proc.returncode
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, argv)
+
+
+def write_report(fpath):
+    """Appends all stage records of this run to the JSON lines file at fpath."""
+    with _RECORDS_LOCK:
+        records = list(RECORDS)
+    if len(records) == 0:
+        return
+    with open(fpath, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, default=str) + "\n")
+    LOGGER.info("Wrote the timing information of %d stages to %s.",
+                len(records), fpath)
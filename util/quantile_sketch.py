@@ -0,0 +1,115 @@
+"""
+Helper module providing a mergeable streaming quantile sketch (KLL sketch, see
+Karnin, Lang & Liberty 2016), used to estimate medians and percentiles of columns
+that are read chunk by chunk or spread over several files or processes.
+
+The sketch keeps a hierarchy of compactors: the items on level h represent 2**h
+values each. Whenever a level exceeds its capacity, it is sorted and every second
+item (starting at a random offset) is promoted to the next level.
+The rank error of the quantiles is of the order of 1/k, independent of the number of values.
+"""
+import numpy as np
+
+DEFAULT_K = 400
+# Factor by which the capacities of the lower levels shrink
+CAPACITY_DECAY = 2 / 3
+
+
+class KLLSketch:
+    """Mergeable streaming quantile sketch.
+    parameters:
+        [k]: int
+            Capacity of the top level, controlling the accuracy and size of the sketch.
+        [seed]: int
+            Seed of the random offsets of the compactions, for reproducible results.
+    """
+
+    def __init__(self, k=DEFAULT_K, seed=42):
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.compactors = [np.empty(0)]
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def __len__(self):
+        return self.count
+
+    def _give_capacity(self, level):
+        """Returns the maximum number of items on the given level."""
+        depth = len(self.compactors) - level - 1
+        return max(int(np.ceil(self.k * CAPACITY_DECAY**depth)), 2)
+
+    def _compress(self):
+        """Compacts all levels exceeding their capacity, starting from the bottom."""
+        level = 0
+        while level < len(self.compactors):
+            items = self.compactors[level]
+            if len(items) > self._give_capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append(np.empty(0))
+                items = np.sort(items)
+                # An odd item stays on its level
+                num_compacted = len(items) - len(items) % 2
+                offset = self.rng.integers(2)
+                promoted = items[offset:num_compacted:2]
+                self.compactors[level] = items[num_compacted:]
+                self.compactors[level + 1] = np.concatenate(
+                    [self.compactors[level + 1], promoted])
+            level += 1
+
+    def update(self, values):
+        """Adds the (non-NaN) values to the sketch."""
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self._compress()
+
+    def merge(self, other):
+        """Adds the items of another sketch (which is not altered)."""
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.empty(0))
+        for level, items in enumerate(other.compactors):
+            self.compactors[level] = np.concatenate([self.compactors[level], items])
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """Returns the estimated q-quantile(s) (0 <= q <= 1) of all values added so far."""
+        q = np.asarray(q, dtype=float)
+        if self.count == 0:
+            return np.full(q.shape, np.nan) if q.ndim > 0 else np.nan
+        values = np.concatenate(self.compactors)
+        weights = np.concatenate([np.full(len(items), 2**level, dtype=np.int64)
+                                  for level, items in enumerate(self.compactors)])
+        order = np.argsort(values, kind="stable")
+        values, cumulative = values[order], np.cumsum(weights[order])
+        indices = np.searchsorted(cumulative, q * cumulative[-1], side="left")
+        result = values[np.clip(indices, 0, len(values) - 1)]
+        # The extremes are known exactly:
+        result = np.where(q <= 0, self.min, np.where(q >= 1, self.max, result))
+        return result if q.ndim > 0 else float(result)
+
+    def median(self):
+        """Returns the estimated median of all values added so far."""
+        return self.quantile(0.5)
+
+    def percentiles(self, percentiles):
+        """Returns the estimated percentiles (0 to 100) of all values added so far."""
+        return self.quantile(np.asarray(percentiles, dtype=float) / 100)
+
+
+def merge_sketches(sketches, k=DEFAULT_K):
+    """Returns a new sketch containing the items of all given sketches."""
+    merged = KLLSketch(k)
+    for sketch in sketches:
+        merged.merge(sketch)
+    return merged
@@ -7,40 +7,65 @@ Helper script for the commands to run
 """
 
 
+import functools
 import os
+from concurrent.futures import ThreadPoolExecutor
 from shutil import move
 
+import util.fit_cache as f_c
 import util.my_tools as mt
+import util.photoz_fitter as p_f
+import util.template_triage as t_t
+from util import profiling, supervisor
+from util.profiling import profile_stage
 
 
+@profile_stage()
 def assemble_catalog():
-    """Runs the jython script to match the input files."""
-    mt.run_jystilts_program("match_tables.py")
+    """Runs the jython script to match the input files.
+    The LePhare input files that are to be kept according to the overwrite policy are
+    passed to the script so it doesn't write them."""
+    kept = []
+    if mt.CUR_CONFIG["CAT_ASSEMBLY"].getboolean("write_lephare_input"):
+        # Versioned input files are moved right before they are rewritten
+        kept = [ttype for ttype in mt.USED_TTYPES
+                if not mt.assert_file_overwrite(mt.give_lephare_filename(ttype),
+                                                [mt.give_processed_table_name(ttype)])]
+    if kept:
+        mt.LOGGER.info("The catalogue assembly keeps the existing LePhare input for %s.",
+                       ", ".join(kept))
+    mt.run_jystilts_program("match_tables.py", *kept)
     mt.LOGGER.debug(
         "Successfully ran the jython program to match and write the tables.")
 
 
+def give_filter_arg_dict():
+    """Provides the arguments of the LePhare filter routine."""
+    return {"c": mt.give_parafile_fpath(),
+            "FILTER_REP": f"{mt.GEN_CONFIG['PATHS']['params']}filters",
+            "FILTER_FILE": mt.CUR_CONFIG["LEPHARE"]["filter_stem"]}
+
+
+@profile_stage()
 def run_filters():
     """Runs the LePhare filter routine with the requested settings"""
-    arg_dict = {"c": mt.give_parafile_fpath(),
-                "FILTER_REP": f"{mt.GEN_CONFIG['PATHS']['params']}filters",
-                "FILTER_FILE": mt.CUR_CONFIG["LEPHARE"]["filter_stem"]}
-    additional = ">" + mt.give_filterfile_fpath()
-    mt.run_lephare_command(
-        "filter", arg_dict, ttype="everything", additional=additional)
+    mt.run_lephare_command("filter", give_filter_arg_dict(), ttype="everything",
+                           stdout_path=mt.give_filterfile_fpath())
 
 
-def run_templates(ttype):
-    """Runs the LePhare template routine with the requested settings"""
-    if not mt.assert_file_overwrite(mt.give_temp_libname(ttype, "mag", suffix=".dat")):
-        mt.LOGGER.info("Skipping the template run for %s.", ttype)
-        return
+def give_sedtolib_arg_dict(ttype):
+    """Provides the arguments of the LePhare sedtolib routine for ttype."""
     prefix = "STAR" if ttype == "star" else "GAL"
     arg_dict_sed = {"c": mt.give_parafile_fpath(),
                     f"{prefix}_SED": mt.give_temp_listname(ttype),
                     f"{prefix}_LIB": mt.give_temp_libname(ttype, "sed", include_path=False)}
     arg_dict_sed["t"] = "S" if ttype == "star" else "G"
-    mt.run_lephare_command("sedtolib", arg_dict_sed, ttype)
+    return arg_dict_sed
+
+
+def give_mag_gal_arg_dict(ttype):
+    """Provides the arguments of the LePhare mag_gal routine for ttype."""
+    prefix = "STAR" if ttype == "star" else "GAL"
     arg_dict_mag = {"c": mt.give_parafile_fpath(),
                     f"{prefix}_LIB_IN": mt.give_temp_libname(ttype, "sed", include_path=False),
                     f"{prefix}_LIB_OUT": mt.give_temp_libname(ttype, "mag", include_path=False),
@@ -49,26 +74,39 @@ def run_templates(ttype):
                     "FILTER_FILE": mt.CUR_CONFIG["LEPHARE"]["filter_stem"]}
     arg_dict_mag["t"] = "S" if ttype == "star" else "G"
     # Add extinction yinformation
-    if ttype == "pointlike" and "extinc_range_pointlike" in mt.CUR_CONFIG["LEPHARE"].keys():
-        arg_dict_mag["EXTINC_LAW"] = "SMC_prevot.dat,SB_calzetti.dat"
-        arg_dict_mag["MOD_EXTINC"] = mt.CUR_CONFIG["LEPHARE"]["extinc_range_pointlike"]
-        arg_dict_mag["EB_V"] = "0.,0.05,0.1,0.15,0.2,0.25,0.3,0.35,0.4"
-    mt.run_lephare_command("mag_gal", arg_dict_mag, ttype)
+    arg_dict_mag.update(mt.give_extinction_settings(ttype))
+    return arg_dict_mag
+
+
+def move_magnitude_library(ttype):
+    """Moves the ASCII magnitude library written by mag_gal to the library directory."""
+    # LePhare writes the output file in the same directory, so we need to move it:
+    move(mt.give_temp_libname(ttype, "mag", use_workpath=True, suffix=".dat"),
+         mt.give_temp_libname(ttype, "mag", suffix=".dat"))
+
+
+@profile_stage()
+def run_templates(ttype):
+    """Runs the LePhare template routine with the requested settings"""
+    lib_fpath = mt.give_temp_libname(ttype, "mag", suffix=".dat")
+    if not mt.assert_file_overwrite(lib_fpath, mt.give_template_dependencies(ttype),
+                                    planning=True):
+        mt.LOGGER.info("Skipping the template run for %s.", ttype)
+        return
+    mt.run_lephare_command("sedtolib", give_sedtolib_arg_dict(ttype), ttype)
+    mt.run_lephare_command("mag_gal", give_mag_gal_arg_dict(ttype), ttype)
     try:
-        # LePhare writes the output file in the same directory, so we need to move it:
-        move(mt.give_temp_libname(ttype, "mag", use_workpath=True, suffix=".dat"),
-             mt.give_temp_libname(ttype, "mag", suffix=".dat"))
+        # Versioned files are only moved once they are about to be replaced
+        mt.assert_file_overwrite(lib_fpath)
+        move_magnitude_library(ttype)
         mt.run_jystilts_program("rewrite_fits_header.py", ttype, "MAG")
     except OSError:
         mt.LOGGER.error(
             "Something went wrong trying to move the ASCII magnitude files.")
 
 
-def run_zphota(ttype):
-    """Runs the LePhare zphota routine with the requested settings"""
-    if not mt.assert_file_overwrite(mt.give_lephare_filename(ttype, out=True)):
-        mt.LOGGER.info("Skipping the zphota run for %s.", ttype)
-        return
+def give_zphota_arg_dict(ttype):
+    """Provides the arguments of the LePhare zphota routine for ttype."""
     star_lib = mt.give_temp_libname('star', include_path=False) if os.path.isfile(
         mt.give_temp_libname('star')) else "baseline_star_mag_lib"
     arg_dict_sed = {"c": mt.give_parafile_fpath(),
@@ -86,22 +124,182 @@ def run_zphota(ttype):
         arg_dict_sed["CAT_LINES"] = "10,10"
         mt.LOGGER.info(
             "Producing .spec files, so only the first 10 rows are considered.")
-    if ttype == "pointlike":
-        arg_dict_sed["MAG_REF"] = "7"
-        arg_dict_sed["MAG_ABS"] = "-30,-20"
-        # arg_dict_sed["APPLY_SYSSHIFT"] = "-0.2837,-0.1676,-0.0306,-0.0604,-0.0427,-0.0000,0.0304,0.0801,0.0240,-0.0225,0.0626,0.2107,-0.3830,0.0786,0.0394,-0.0746,-0.0785"
-    if ttype == "extended":
-        arg_dict_sed["MAG_REF"] = "7"
-        arg_dict_sed["MAG_ABS"] = "-24,-8"
-        # arg_dict_sed["APPLY_SYSSHIFT"] = "-0.2099,-0.1264,0.0228,-0.1534,-0.1234,-0.1437,-0.1797,-0.5375,-0.3046,-0.2395,-0.2261,-0.0718,0.0000,0.0000,-0.0294,-0.0755,-0.1896"
-    mt.run_lephare_command("zphota", arg_dict_sed, ttype)
-    mt.run_jystilts_program("rewrite_fits_header.py", ttype, "OUT")
+    arg_dict_sed.update(mt.give_mag_abs_settings(ttype))
+    # pointlike: arg_dict_sed["APPLY_SYSSHIFT"] = "-0.2837,-0.1676,-0.0306,-0.0604,-0.0427,-0.0000,0.0304,0.0801,0.0240,-0.0225,0.0626,0.2107,-0.3830,0.0786,0.0394,-0.0746,-0.0785"
+    # extended: arg_dict_sed["APPLY_SYSSHIFT"] = "-0.2099,-0.1264,0.0228,-0.1534,-0.1234,-0.1437,-0.1797,-0.5375,-0.3046,-0.2395,-0.2261,-0.0718,0.0000,0.0000,-0.0294,-0.0755,-0.1896"
+    return arg_dict_sed
+
+
+def use_python_backend():
+    """Checks whether the built-in fitter is used instead of zphota."""
+    return mt.CUR_CONFIG["LEPHARE"].get("zphota_backend", fallback="lephare") == "python"
+
+
+def use_fit_cache():
+    """Checks whether only the sources not in the fit cache are passed to zphota
+    (not possible when producing .spec files for a subset of the sources)."""
+    lep_con = mt.CUR_CONFIG["LEPHARE"]
+    return lep_con.getboolean("fit_cache", fallback=False) and \
+        not lep_con.getboolean("spec_out")
+
+
+def give_zphota_out_fpath(ttype):
+    """Provides the path of the output file checked before the fit of ttype
+    (the built-in fitter directly writes the .fits output)."""
+    return mt.give_lephare_filename(ttype, out=True,
+                                    suffix=".fits" if use_python_backend() else None)
+
+
+def fit_zphota(ttype):
+    """Runs the LePhare zphota routine (or the built-in fitter, depending on the
+    zphota_backend) with the requested settings.
+    returns:
+        Whether the fit has been run (and needs to be post-processed)."""
+    if not mt.assert_file_overwrite(give_zphota_out_fpath(ttype),
+                                    mt.give_zphota_dependencies(ttype)):
+        mt.LOGGER.info("Skipping the zphota run for %s.", ttype)
+        return False
+    if use_python_backend():
+        p_f.run_python_zphota(ttype)
+    elif not use_fit_cache() or not f_c.run_cached_zphota(ttype, give_zphota_arg_dict(ttype)):
+        mt.run_lephare_command("zphota", give_zphota_arg_dict(ttype), ttype)
+    return True
+
+
+def postprocess_zphota(ttype):
+    """Rewrites the zphota output to .fits (not needed for the built-in fitter) and
+    assesses the run."""
+    if not use_python_backend():
+        mt.run_jystilts_program("rewrite_fits_header.py", ttype, "OUT")
     mt.assess_lephare_run(ttype, write=True)
 
 
+@profile_stage()
+def run_zphota(ttype):
+    """Runs the zphota fit for ttype and post-processes it."""
+    if fit_zphota(ttype):
+        postprocess_zphota(ttype)
+
+
+def run_postprocessing_stage(ttype, parent):
+    """Post-processes the zphota run of ttype as a stage of the given parent, as it runs
+    in a worker thread."""
+    with profiling.stage("postprocess_zphota", parent=parent, ttype=ttype):
+        postprocess_zphota(ttype)
+
+
+@profile_stage()
+def run_zphota_pipelined(ttypes):
+    """Runs the zphota fits of the ttypes one after the other, while the post-processing
+    of each fit runs in a background thread concurrently with the next fit, so the total
+    runtime approaches the sum of the fits alone."""
+    parent = profiling.give_active_stage()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = {ttype: executor.submit(run_postprocessing_stage, ttype, parent)
+                   for ttype in ttypes if fit_zphota(ttype)}
+    for ttype, future in futures.items():
+        try:
+            future.result()
+        except Exception as err:  # The other ttypes should still be assessed
+            mt.LOGGER.error("The post-processing of the %s run failed with %s: %s",
+                            ttype, type(err).__name__, err)
+
+
+def give_lephare_jobs():
+    """Builds the graph of the requested LePhare commands for the supervisor:
+    filters -> sedtolib -> mag_gal -> library rewrite -> (triage) -> zphota -> output
+    rewrite -> assessment for each ttype, where the jobs of different ttypes are
+    independent apart from the star library used by all zphota runs.
+    The overwrite decisions are made up front so no prompts occur while the jobs run."""
+    lep_con = mt.CUR_CONFIG["LEPHARE"]
+    timeout = lep_con.getfloat("job_timeout", fallback=0)
+    # The fits are limited separately so their post-processing overlaps with the next fit
+    sup = supervisor.Supervisor(
+        lep_con.getint("max_parallel_jobs", fallback=1), timeout if timeout > 0 else None,
+        resource_limits={"zphota": lep_con.getint("max_parallel_fits", fallback=1)})
+    filter_deps = []
+    if lep_con.getboolean("run_filters"):
+        sup.add(supervisor.Job("filter", mt.give_lephare_argv("filter", give_filter_arg_dict()),
+                               stdout_path=mt.give_filterfile_fpath()))
+        filter_deps = ["filter"]
+    library_deps = {ttype: list(filter_deps) for ttype in list(mt.USED_TTYPES) + ["star"]}
+    if lep_con.getboolean("run_templates"):
+        ttypes = list(mt.USED_TTYPES) + (["star"] if os.path.isfile(mt.give_temp_listname("star")) else [])
+        for ttype in ttypes:
+            lib_fpath = mt.give_temp_libname(ttype, "mag", suffix=".dat")
+            if not mt.assert_file_overwrite(lib_fpath, mt.give_template_dependencies(ttype),
+                                            planning=True):
+                mt.LOGGER.info("Skipping the template run for %s.", ttype)
+                continue
+            sup.add(supervisor.Job(f"sedtolib_{ttype}", mt.give_lephare_argv(
+                "sedtolib", give_sedtolib_arg_dict(ttype)), deps=filter_deps))
+            sup.add(supervisor.Job(f"mag_gal_{ttype}", mt.give_lephare_argv(
+                "mag_gal", give_mag_gal_arg_dict(ttype)), deps=[f"sedtolib_{ttype}"]))
+            # Versioned files are only moved once they are about to be replaced
+            sup.add(supervisor.Job(f"prepare_mag_lib_{ttype}", func=functools.partial(
+                mt.assert_file_overwrite, lib_fpath), deps=[f"mag_gal_{ttype}"]))
+            sup.add(supervisor.Job(f"move_mag_lib_{ttype}", func=functools.partial(
+                move_magnitude_library, ttype), deps=[f"prepare_mag_lib_{ttype}"]))
+            sup.add(supervisor.Job(f"rewrite_mag_lib_{ttype}", mt.give_jystilts_argv(
+                "rewrite_fits_header.py", ttype, "MAG"), deps=[f"move_mag_lib_{ttype}"]))
+            library_deps[ttype] = [f"rewrite_mag_lib_{ttype}"]
+    triage_threshold = lep_con.getfloat("triage_threshold", fallback=0)
+    if not lep_con.getboolean("run_zphota"):
+        return sup
+    for ttype in mt.USED_TTYPES:
+        fit_deps = library_deps[ttype] + library_deps["star"]
+        if triage_threshold > 0:
+            sup.add(supervisor.Job(f"triage_{ttype}", func=functools.partial(
+                t_t.run_ttype_triage, ttype, triage_threshold), deps=library_deps[ttype]))
+            fit_deps = fit_deps + [f"triage_{ttype}"]
+        out_fpath = give_zphota_out_fpath(ttype)
+        if not mt.assert_file_overwrite(out_fpath, mt.give_zphota_dependencies(ttype),
+                                        planning=True):
+            mt.LOGGER.info("Skipping the zphota run for %s.", ttype)
+            continue
+        sup.add(supervisor.Job(f"prepare_out_{ttype}", func=functools.partial(
+            mt.assert_file_overwrite, out_fpath), deps=fit_deps))
+        fit_deps = [f"prepare_out_{ttype}"]
+        if use_python_backend() or use_fit_cache():
+            # The python steps decide which sources need to be fitted
+            sup.add(supervisor.Job(f"zphota_{ttype}", func=functools.partial(
+                fit_zphota, ttype), deps=fit_deps, resource="zphota"))
+        else:
+            sup.add(supervisor.Job(f"zphota_{ttype}", mt.give_lephare_argv(
+                "zphota", give_zphota_arg_dict(ttype)), deps=fit_deps, resource="zphota"))
+        post_deps = [f"zphota_{ttype}"]
+        if not use_python_backend():
+            sup.add(supervisor.Job(f"rewrite_out_{ttype}", mt.give_jystilts_argv(
+                "rewrite_fits_header.py", ttype, "OUT"), deps=post_deps))
+            post_deps = [f"rewrite_out_{ttype}"]
+        sup.add(supervisor.Job(f"assess_{ttype}", func=functools.partial(
+            mt.assess_lephare_run, ttype, write=True), deps=post_deps))
+    return sup
+
+
+@profile_stage()
+def run_supervised_lephare_commands():
+    """Runs the requested LePhare commands as a dependency graph (see give_lephare_jobs),
+    overlapping the independent jobs."""
+    sup = give_lephare_jobs()
+    if mt.CUR_CONFIG["GENERAL"].getboolean("print_commands_only"):
+        for job in sup.jobs.values():
+            print(job.record["command"] or f"# python step {job.name}")
+        return
+    sup.run()
+
+
+@profile_stage()
 def run_lephare_commands():
     """Runs the requested LePhare commands specified in the current config file."""
     lep_con = mt.CUR_CONFIG["LEPHARE"]
+    if lep_con.getboolean("run_zphota") and use_python_backend():
+        # Fail before any of the (long) library runs
+        p_f.assert_fit_supported(mt.USED_TTYPES)
+    if lep_con.getboolean("supervised", fallback=False):
+        run_supervised_lephare_commands()
+        mt.LOGGER.debug("Finished the LePhare commands")
+        return
     if lep_con.getboolean("run_filters"):
         run_filters()
 
@@ -112,7 +310,10 @@ def run_lephare_commands():
             run_templates("star")
 
     if lep_con.getboolean("run_zphota"):
-        for ttype in mt.USED_TTYPES:
-            run_zphota(ttype)
+        # Flag the sources outside of the template coverage before the fit:
+        triage_threshold = lep_con.getfloat("triage_threshold", fallback=0)
+        if triage_threshold > 0:
+            t_t.run_triage(triage_threshold)
+        run_zphota_pipelined(mt.USED_TTYPES)
 
     mt.LOGGER.debug("Finished the LePhare commands")
@@ -0,0 +1,119 @@
+"""
+Helper module for the source IDs and a persisted sorted index of them, so tables of
+different stages or runs can be joined with integer lookups instead of string merges.
+
+Two IDs are used: The IDENT is the compact 32 bit running number that LePhare reads and
+writes, which only identifies the sources within one catalogue assembly. The sweep_ident
+is the packed 64 bit ID RELEASE << 40 | BRICKID << 20 | OBJID of the sweep identifiers
+(see SOURCE_ID_EXPR in jystilts_scripts/modules/jy_tools.py), which is stable across
+assemblies and runs. It is written to an IDENT map next to the LePhare input, and added
+to the .fits outputs via that map, so the outputs of different runs are joined by it.
+The index of a table is a .npy file next to it containing the sorted IDs and the row
+of each of them, which is memory-mapped for the lookups (O(log n) each).
+"""
+import os
+
+import numpy as np
+
+import util.my_tools as mt
+
+INDEX_DTYPE = np.dtype([("ident", np.int64), ("row", np.int64)])
+
+
+class SourceIndex:
+    """Sorted index of the IDs of a table, mapping each ID to its row."""
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def from_idents(cls, idents):
+        """Builds the index of a table with the given ID column."""
+        idents = np.asarray(idents, dtype=np.int64)
+        order = np.argsort(idents, kind="stable")
+        entries = np.empty(len(idents), dtype=INDEX_DTYPE)
+        entries["ident"] = idents[order]
+        entries["row"] = order
+        return cls(entries)
+
+    def save(self, fpath):
+        """Stores the index as a .npy file."""
+        np.save(fpath, self.entries)
+
+    @classmethod
+    def load(cls, fpath):
+        """Memory-maps an index stored with save."""
+        return cls(np.load(fpath, mmap_mode="r"))
+
+    def lookup(self, idents):
+        """Returns the rows of the given IDs in the indexed table (-1 for unknown IDs)."""
+        idents = np.asarray(idents, dtype=np.int64)
+        if len(self) == 0:
+            return np.full(idents.shape, -1, dtype=np.int64)
+        sorted_ids = self.entries["ident"]
+        pos = np.clip(np.searchsorted(sorted_ids, idents), 0, len(self) - 1)
+        found = sorted_ids[pos] == idents
+        return np.where(found, self.entries["row"][pos], -1)
+
+    def join(self, idents):
+        """Returns the positions in idents and the rows of the indexed table of all IDs
+        contained in both (an inner join)."""
+        rows = self.lookup(idents)
+        positions = np.flatnonzero(rows >= 0)
+        return positions, rows[positions]
+
+
+def add_sweep_idents(df, ttype):
+    """Adds the sweep_ident column to a LePhare output DataFrame of ttype via the IDENT
+    map written with the input (-1 for IDENTs not in the map)."""
+    fpath = mt.give_ident_map_fpath(ttype)
+    if not os.path.isfile(fpath):
+        mt.LOGGER.warning("No IDENT map found at %s, so the %s output has no sweep_ident.",
+                          fpath, ttype)
+        return df
+    ident_map = mt.read_fits_as_dataframe(fpath, columns=["IDENT", "sweep_ident"])
+    rows = SourceIndex.from_idents(ident_map["IDENT"].to_numpy()).lookup(df["IDENT"].to_numpy())
+    sweep_idents = ident_map["sweep_ident"].to_numpy(dtype=np.int64)
+    df["sweep_ident"] = np.where(rows >= 0, sweep_idents[rows], -1)
+    return df
+
+
+def give_index_fpath(fpath, id_col="IDENT"):
+    """Provides the path of the index of the id_col column of the table at fpath."""
+    return os.path.splitext(fpath)[0] + f"_{id_col.lower()}_index.npy"
+
+
+def give_source_index(fpath, idents=None, id_col="IDENT"):
+    """Returns the index of the id_col column of the .fits table at fpath, reading it from
+    its index file if that is newer than the table and (re)building it otherwise.
+    The IDs can be provided if the table has already been read."""
+    index_fpath = give_index_fpath(fpath, id_col)
+    if os.path.isfile(index_fpath) and mt.is_file_fresh(index_fpath, [fpath]):
+        return SourceIndex.load(index_fpath)
+    if idents is None:
+        idents = mt.read_fits_as_dataframe(fpath, columns=[id_col])[id_col].to_numpy()
+    index = SourceIndex.from_idents(idents)
+    index.save(index_fpath)
+    mt.LOGGER.debug("Saved the %s index of %s at %s.", id_col, fpath, index_fpath)
+    return index
+
+
+def join_tables(left, right, right_fpath=None, suffixes=("", "_right"), id_col="IDENT"):
+    """Joins the rows of two DataFrames with an id_col column by their IDs (inner join,
+    in the order of left), using the persisted index of the right table if its path is given.
+    returns:
+        DataFrame with the columns of both tables (the id_col column only once)."""
+    if right_fpath is None:
+        index = SourceIndex.from_idents(right[id_col].to_numpy())
+    else:
+        index = give_source_index(right_fpath, right[id_col].to_numpy(), id_col)
+    positions, rows = index.join(left[id_col].to_numpy())
+    left_part = left.iloc[positions].reset_index(drop=True)
+    right_part = right.iloc[rows].drop(columns=id_col).reset_index(drop=True)
+    overlap = set(left_part.columns) & set(right_part.columns)
+    left_part = left_part.rename(columns={col: col + suffixes[0] for col in overlap})
+    right_part = right_part.rename(columns={col: col + suffixes[1] for col in overlap})
+    return left_part.join(right_part)
@@ -0,0 +1,216 @@
+"""
+Helper module for running the LePhare and jystilts commands (and python steps in between)
+as a dependency graph of jobs with asyncio.
+
+Commands are started with argument vectors instead of a shell, their stdout and stderr
+are streamed into the log line by line with a per-job prefix, and each job gets a timeout.
+A job starts as soon as all of its dependencies have succeeded and one of the
+max_concurrent slots is free, so independent jobs (e.g. of different ttypes) overlap.
+Jobs depending on a failed job are skipped.
+The exit code, wall time, CPU time and peak memory (via wait4) of each job are added
+to the profiling records.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from util import profiling
+from util.my_logger import LOGGER
+
+# Exit status used for the records of jobs that were killed after a timeout
+TIMEOUT_STATUS = "timeout"
+
+
+class Job:
+    """A command (argv) or python function (func) to be run once all of its dependencies
+    have succeeded.
+    parameters:
+        name: str
+            Unique name of the job, used as the log prefix and for the dependencies.
+        [argv]: list
+            The program and its arguments.
+        [func]: callable
+            A function (without arguments) run in a worker thread instead of a command.
+        [deps]: list
+            The names of the jobs that need to succeed first.
+        [timeout]: float
+            Seconds after which the command is killed (None for no limit).
+        [stdout_path]: str
+            File the stdout of the command is written to instead of the log.
+        [resource]: str
+            Name of a resource (see Supervisor) the job needs exclusively.
+    """
+
+    def __init__(self, name, argv=None, func=None, deps=(), timeout=None, stdout_path=None,
+                 resource=None):
+        assert (argv is None) != (func is None), "A job needs either an argv or a func."
+        self.name = name
+        self.argv = None if argv is None else [str(arg) for arg in argv]
+        self.func = func
+        self.deps = list(deps)
+        self.timeout = timeout
+        self.stdout_path = stdout_path
+        self.resource = resource
+        self.record = {"run_id": profiling.RUN_ID, "stage": name, "parent": "supervisor",
+                       "rows": None, "command": None if argv is None else " ".join(self.argv),
+                       "status": "pending"}
+
+    def __repr__(self):
+        return f"Job({self.name}, deps={self.deps})"
+
+
+async def _stream_to_log(stream, prefix, level):
+    """Logs the lines of a stream as they arrive."""
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        LOGGER.log(level, "[%s] %s", prefix, line.decode(errors="replace").rstrip())
+
+
+async def _open_stream(proc_pipe):
+    """Wraps the pipe of a Popen process in an asyncio StreamReader."""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), proc_pipe)
+    return reader
+
+
+def _run_func(job):
+    """Runs the function of the job in a worker thread, attributing the stages started
+    within to the job."""
+    with profiling.attach(job.record):
+        job.func()
+
+
+def _wait_for_process(proc):
+    """Waits for the process (blocking) and returns its exit code and resource usage."""
+    if not hasattr(os, "wait4"):
+        return proc.wait(), None
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, usage
+
+
+class Supervisor:
+    """Runs a graph of jobs with at most max_concurrent of them at the same time.
+    parameters:
+        [max_concurrent]: int
+            Maximum number of jobs running at once.
+        [default_timeout]: float
+            Timeout of the jobs that don't have their own one (None for no limit).
+        [resource_limits]: dict
+            Maximum number of jobs using each named resource at once (e.g. one zphota fit
+            at a time, while the post-processing of the previous fit overlaps with it).
+            Resources without a limit can be used by one job at a time.
+    """
+
+    def __init__(self, max_concurrent=1, default_timeout=None, resource_limits=None):
+        self.max_concurrent = max(int(max_concurrent), 1)
+        self.default_timeout = default_timeout
+        self.resource_limits = {} if resource_limits is None else dict(resource_limits)
+        self.jobs = {}
+
+    def add(self, job):
+        """Adds a job to the graph, its dependencies need to be added before."""
+        assert job.name not in self.jobs, f"There already is a job named {job.name}."
+        missing = [dep for dep in job.deps if dep not in self.jobs]
+        assert len(missing) == 0, f"The dependencies {missing} of {job.name} are unknown."
+        self.jobs[job.name] = job
+        return job
+
+    def run(self):
+        """Runs all jobs and returns a dictionary with the final status of each of them
+        ('ok', 'failed', 'timeout' or 'skipped')."""
+        if len(self.jobs) == 0:
+            return {}
+        asyncio.run(self._run_graph())
+        profiling.add_records(job.record for job in self.jobs.values())
+        statuses = {name: job.record["status"] for name, job in self.jobs.items()}
+        failed = [name for name, status in statuses.items() if status != "ok"]
+        if failed:
+            LOGGER.error("The following jobs did not succeed: %s", ", ".join(
+                f"{name} ({statuses[name]})" for name in failed))
+        return statuses
+
+    async def _run_graph(self):
+        """Starts a task for each job, each of them waiting for its dependencies first."""
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        resources = {job.resource for job in self.jobs.values() if job.resource is not None}
+        self._resources = {resource: asyncio.Semaphore(self.resource_limits.get(resource, 1))
+                           for resource in resources}
+        self._tasks = {}
+        for name, job in self.jobs.items():
+            self._tasks[name] = asyncio.create_task(self._run_job(job))
+        await asyncio.gather(*self._tasks.values())
+
+    async def _run_job(self, job):
+        """Runs the job once its dependencies are done, returning whether it succeeded."""
+        results = await asyncio.gather(*[self._tasks[dep] for dep in job.deps])
+        if not all(results):
+            job.record["status"] = "skipped"
+            LOGGER.warning("[%s] Skipped since a dependency did not succeed.", job.name)
+            return False
+        # The resource is acquired first so waiting jobs don't block a slot
+        async with contextlib.AsyncExitStack() as stack:
+            if job.resource is not None:
+                await stack.enter_async_context(self._resources[job.resource])
+            await stack.enter_async_context(self._slots)
+            start = time.perf_counter()
+            LOGGER.info("[%s] Started.", job.name)
+            try:
+                if job.func is not None:
+                    await asyncio.get_running_loop().run_in_executor(None, _run_func, job)
+                    job.record["status"] = "ok"
+                else:
+                    await self._run_command(job)
+            except Exception as err:  # The other branches of the graph should continue
+                job.record["status"] = "failed"
+                LOGGER.error("[%s] Failed with %s: %s", job.name, type(err).__name__, err)
+            job.record["wall_s"] = time.perf_counter() - start
+        LOGGER.info("[%s] Finished (%s) after %.1f s.", job.name, job.record["status"],
+                    job.record["wall_s"])
+        return job.record["status"] == "ok"
+
+    async def _run_command(self, job):
+        """Runs the command of the job, streaming its output, and records its resource usage."""
+        LOGGER.debug("[%s] Running %s", job.name, job.record["command"])
+        stdout_file = None if job.stdout_path is None else open(job.stdout_path, "wb")
+        try:
+            proc = subprocess.Popen(job.argv, stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE if stdout_file is None else stdout_file,
+                                    stderr=subprocess.PIPE)
+        finally:
+            if stdout_file is not None:
+                stdout_file.close()
+        streams = [_stream_to_log(await _open_stream(proc.stderr), job.name, logging.INFO)]
+        if proc.stdout is not None:
+            streams.append(_stream_to_log(await _open_stream(proc.stdout), job.name, logging.INFO))
+        loop = asyncio.get_running_loop()
+        waiter = loop.run_in_executor(None, _wait_for_process, proc)
+        timeout = job.timeout if job.timeout is not None else self.default_timeout
+        timed_out = False
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            LOGGER.error("[%s] Killed after exceeding the timeout of %s s.", job.name, timeout)
+            proc.kill()
+        returncode, usage = await waiter
+        await asyncio.gather(*streams)
+        job.record["returncode"] = returncode
+        if usage is not None:
+            job.record["process_cpu_s"] = usage.ru_utime + usage.ru_stime
+            job.record["process_peak_rss_mb"] = usage.ru_maxrss / 1024**2 \
+                if sys.platform == "darwin" else usage.ru_maxrss / 1024
+        if timed_out:
+            job.record["status"] = TIMEOUT_STATUS
+        elif returncode != 0:
+            job.record["status"] = "failed"
+            LOGGER.error("[%s] Exited with code %d.", job.name, returncode)
+        else:
+            job.record["status"] = "ok"
@@ -0,0 +1,177 @@
+"""
+Helper module computing the magnitudes of the templates of a template list on a
+(template x E(B-V) x redshift x band) grid directly from the SED files, the filter
+curves and the extinction laws, i. e. without running sedtolib and mag_gal.
+
+The integration through all filters is vectorized over the redshift grid (see
+FilterStore.give_synthetic_magnitudes), and the results are cached as .npz files
+next to the magnitude libraries, keyed by a hash of all of the inputs.
+In contrast to mag_gal, no IGM absorption or emission lines are considered, so the
+results are meant for exploring the template coverage rather than for fitting.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import input_scripts.collect_filter_data as c_f
+import util.my_tools as mt
+from util import profiling
+
+# Redshift grid (dz, zmin, zmax) used if Z_STEP is not given in the parameter file
+DEFAULT_Z_STEP = (0.02, 0., 6.)
+
+
+def give_sed_fpath(ttype, tempname):
+    """Provides the path of the SED file of a template given in the template list."""
+    sed_dir = "STAR" if ttype == "star" else "GAL"
+    return os.path.join(mt.GEN_CONFIG["PATHS"]["lepharedir"], "sed", sed_dir, tempname)
+
+
+def give_filter_fpaths():
+    """Provides the paths of the raw filter files of the bands in BAND_LIST."""
+    filter_dir = mt.GEN_CONFIG["PATHS"]["params"] + "filters"
+    return {band: os.path.join(filter_dir, mt.GEN_CONFIG["FILTERS"][band]) for band in mt.BAND_LIST}
+
+
+def read_sed(fpath):
+    """Reads an SED file with the wavelengths (in Angstrom) and f_lambda in the first two
+    columns, returning both sorted by wavelength."""
+    data = np.loadtxt(fpath, comments="#", ndmin=2, usecols=(0, 1))
+    order = np.argsort(data[:, 0])
+    return data[order, 0], data[order, 1]
+
+
+def read_extinction_law(law):
+    """Reads the wavelengths (in Angstrom) and k(lambda) of an extinction law from the LePhare ext directory."""
+    fpath = os.path.join(mt.GEN_CONFIG["PATHS"]["lepharedir"], "ext", law)
+    data = np.loadtxt(fpath, comments="#", ndmin=2, usecols=(0, 1))
+    return data[:, 0], data[:, 1]
+
+
+def give_z_grid():
+    """Returns the redshift grid set by Z_STEP in the parameter file."""
+    z_step = mt.give_para_value("Z_STEP")
+    dz, zmin, zmax = DEFAULT_Z_STEP if z_step is None else \
+        [float(val) for val in z_step.split(",")]
+    return np.arange(zmin, zmax + dz / 2, dz)
+
+
+def give_extinction_grid(ttype, num_templates):
+    """Returns the E(B-V) values and a list with the extinction law applied to each of the
+    templates (None for templates without extinction), following the MOD_EXTINC convention
+    of one model number range per law."""
+    settings = mt.give_extinction_settings(ttype)
+    if len(settings) == 0:
+        return np.array([0.]), [None] * num_templates
+    laws = settings["EXTINC_LAW"].split(",")
+    ranges = [int(val) for val in settings["MOD_EXTINC"].split(",")]
+    ebv = np.array([float(val) for val in settings["EB_V"].split(",")])
+    template_laws = [None] * num_templates
+    for i, law in enumerate(laws):
+        low, high = ranges[2 * i:2 * i + 2]
+        # Template numbering starts at 1, and a range of 0,0 disables the law
+        for temp_num in range(max(low, 1), min(high, num_templates) + 1):
+            template_laws[temp_num - 1] = law
+    return ebv, template_laws
+
+
+def give_cache_key(sed_fpaths, filter_fpaths, template_laws, ebv, redshifts):
+    """Returns a hash of all inputs of the magnitude grid."""
+    def file_state(fpath):
+        return [fpath, os.path.getsize(fpath), os.path.getmtime(fpath)] \
+            if os.path.isfile(fpath) else [fpath, None, None]
+    state = {"seds": [file_state(fpath) for fpath in sed_fpaths],
+             "filters": [file_state(fpath) for fpath in filter_fpaths],
+             "laws": template_laws, "ebv": list(ebv), "z": list(redshifts)}
+    return hashlib.sha1(json.dumps(state).encode("utf-8")).hexdigest()[:12]
+
+
+class SyntheticColours:
+    """Magnitude grid of the templates of a ttype with the shape
+    (template, E(B-V), redshift, band), NaN where a template has no extinction applied."""
+
+    def __init__(self, ttype, tempnames, ebv, redshifts, bands, mags):
+        self.ttype = ttype
+        self.tempnames = list(tempnames)
+        self.ebv = np.asarray(ebv, dtype=float)
+        self.redshifts = np.asarray(redshifts, dtype=float)
+        self.bands = list(bands)
+        self.mags = np.asarray(mags, dtype=np.float32)
+
+    def save(self, fpath):
+        """Caches the grid as a .npz file."""
+        np.savez(fpath, ttype=self.ttype, tempnames=np.array(self.tempnames), ebv=self.ebv,
+                 redshifts=self.redshifts, bands=np.array(self.bands), mags=self.mags)
+
+    @classmethod
+    def load(cls, fpath):
+        """Reads a grid cached with save."""
+        with np.load(fpath, allow_pickle=False) as data:
+            return cls(str(data["ttype"]), data["tempnames"].tolist(), data["ebv"],
+                       data["redshifts"], data["bands"].tolist(), data["mags"])
+
+    def give_colour(self, c1, c2):
+        """Returns the c1 - c2 colours with the shape (template, E(B-V), redshift)."""
+        return self.mags[..., self.bands.index(c1)] - self.mags[..., self.bands.index(c2)]
+
+    def to_dataframe(self):
+        """Converts the grid to a DataFrame in the format of mt.read_template_library
+        (with model, E(B-V), ZSPEC, mag_<band> and Type columns), so it can be used
+        for the template plots instead of the magnitude library."""
+        num_temps, num_ebv, num_z, num_bands = self.mags.shape
+        models, ebv, redshifts = np.meshgrid(np.arange(1, num_temps + 1), self.ebv,
+                                             self.redshifts, indexing="ij")
+        mags = self.mags.reshape(-1, num_bands)
+        df = pd.DataFrame(mags, columns=[f"mag_{band}" for band in self.bands])
+        df.insert(0, "model", models.ravel())
+        df.insert(1, "E(B-V)", ebv.ravel())
+        df.insert(2, "ZSPEC", redshifts.ravel())
+        df = df[~np.isnan(mags).all(axis=1)].reset_index(drop=True)
+        df["Type"] = mt.give_ttype_column(self.ttype, len(df))
+        return mt.apply_dtype_plan(df)
+
+
+@profiling.profile_stage()
+def compute_synthetic_colours(ttype, redshifts=None, use_cache=True):
+    """Computes (or reads from the cache) the magnitude grid of the active templates of ttype.
+    parameters:
+        [redshifts]: array
+            The redshift grid to use, by default the one given by Z_STEP.
+        [use_cache]: bool
+            Whether to use and store the cached grid.
+    """
+    tempnames = mt.give_list_of_tempnames(ttype)
+    sed_fpaths = [give_sed_fpath(ttype, tempname) for tempname in tempnames]
+    filter_fpaths = give_filter_fpaths()
+    ebv, template_laws = give_extinction_grid(ttype, len(tempnames))
+    redshifts = give_z_grid() if redshifts is None else np.asarray(redshifts, dtype=float)
+    key = give_cache_key(sed_fpaths, filter_fpaths.values(), template_laws, ebv, redshifts)
+    cache_fpath = mt.give_temp_libname(ttype, "colour", suffix=f"_{key}.npz")
+    if use_cache and os.path.isfile(cache_fpath):
+        mt.LOGGER.info("Using the cached synthetic magnitudes at %s.", cache_fpath)
+        return SyntheticColours.load(cache_fpath)
+    store = c_f.FilterStore.from_filter_fpaths(filter_fpaths)
+    law_curves = {law: read_extinction_law(law) for law in set(template_laws) if law is not None}
+    mags = np.full((len(tempnames), len(ebv), len(redshifts), len(store)), np.nan,
+                   dtype=np.float32)
+    for i, fpath in enumerate(sed_fpaths):
+        try:
+            wavelengths, flux = read_sed(fpath)
+        except OSError:
+            mt.LOGGER.warning("Could not read the SED file %s, skipping it.", fpath)
+            continue
+        law = template_laws[i]
+        k_lambda = None if law is None else np.interp(wavelengths, *law_curves[law])
+        for j, ebv_value in enumerate(ebv):
+            if law is None and ebv_value != 0:
+                continue
+            ext_flux = flux if law is None else flux * 10**(-0.4 * ebv_value * k_lambda)
+            mags[i, j] = store.give_synthetic_magnitudes(wavelengths, ext_flux, redshifts)
+    colours = SyntheticColours(ttype, tempnames, ebv, redshifts, store.names, mags)
+    if use_cache:
+        colours.save(cache_fpath)
+        mt.LOGGER.info("Saved the synthetic magnitudes at %s.", cache_fpath)
+    return colours
@@ -0,0 +1,131 @@
+"""
+Helper module for a quick triage of the LePhare input sources before running zphota.
+
+For each source, the distance of its colours to the closest template colours of the
+magnitude library (at any redshift and E(B-V)) is computed with a k-d tree.
+Since the colours depend on the bands available for a source, the sources are grouped
+by their availability pattern, and one tree is built for each pattern.
+Sources that are far away from all templates lie outside of the template coverage,
+and their IDs are written to a triage file so they can be inspected or treated separately.
+"""
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import util.my_tools as mt
+from util import profiling
+
+# Minimum number of bands a source needs for the triage (i. e. at least two colours)
+MIN_BANDS = 3
+
+
+def give_triage_fpath(ttype):
+    """Provides the path of the file the flagged sources of ttype are written to."""
+    return mt.give_lephare_filename(ttype, suffix="triage")
+
+
+def give_template_mags(ttype):
+    """Returns the magnitudes of the templates of ttype (one row per template, E(B-V) and
+    redshift, one column per band in BAND_LIST, NaN where not available) together with
+    the corresponding rows of the template library."""
+    temp_df = mt.read_template_library()
+    temp_df = temp_df[temp_df["Type"] == ttype].reset_index(drop=True)
+    mags = temp_df[[f"mag_{band}" for band in mt.BAND_LIST]].to_numpy(dtype=float)
+    mags[~((mags > 0) & (mags < 50))] = np.nan
+    return mags, temp_df
+
+
+def give_source_mags(df):
+    """Returns the magnitudes of the sources of a LePhare input DataFrame (one column per
+    band in BAND_LIST), NaN for the bands not available or excluded by the contexts."""
+    fluxes = df[mt.BAND_LIST].to_numpy(dtype=float)
+    errors = df[[f"{band}_err" for band in mt.BAND_LIST]].to_numpy(dtype=float)
+    # A source context <= 0 means all bands are used, same for the global context
+    context = df["CONTEXT"].to_numpy(dtype=np.int64)
+    all_bands = 2**len(mt.BAND_LIST) - 1
+    context = np.where(context > 0, context, all_bands)
+    if mt.CONTEXT > 0:
+        context &= mt.CONTEXT
+    allowed = (context[:, None] >> np.arange(len(mt.BAND_LIST))) & 1 == 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mags = mt.flux_to_AB(fluxes)
+    mags[~(allowed & (fluxes > 0) & (errors > 0))] = np.nan
+    return mags
+
+
+def give_colours(mags):
+    """Converts magnitudes (all of them available) into the colours of adjacent bands."""
+    return mags[:, :-1] - mags[:, 1:]
+
+
+@profiling.profile_stage()
+def triage_sources(ttype, threshold):
+    """Computes the colour-space distance of each input source of ttype to its closest template.
+    parameters:
+        ttype: str
+            The ttype of the input file and the template library.
+        threshold: float
+            Sources with a root mean square colour difference above this (in mag) are flagged.
+    returns:
+        DataFrame with IDENT, num_bands, distance (rms colour difference), the closest
+        model, E(B-V) and redshift, and whether the source is flagged."""
+    df = mt.read_ascii_as_df(mt.give_lephare_filename(ttype), out=False)
+    source_mags = give_source_mags(df)
+    temp_mags, temp_df = give_template_mags(ttype)
+    available = ~np.isnan(source_mags)
+    bits = available.astype(np.int64) @ (2**np.arange(len(mt.BAND_LIST), dtype=np.int64))
+    patterns, inverse = np.unique(bits, return_inverse=True)
+    distance = np.full(len(df), np.nan)
+    closest = np.full(len(df), -1, dtype=np.int64)
+    for i, pattern in enumerate(patterns):
+        band_mask = (pattern >> np.arange(len(mt.BAND_LIST))) & 1 == 1
+        if band_mask.sum() < MIN_BANDS:
+            continue
+        # Only the templates with magnitudes in all of the bands of the pattern are considered
+        temp_rows = np.flatnonzero(~np.isnan(temp_mags[:, band_mask]).any(axis=1))
+        if len(temp_rows) == 0:
+            continue
+        tree = cKDTree(give_colours(temp_mags[temp_rows][:, band_mask]))
+        sources = np.flatnonzero(inverse == i)
+        dist, index = tree.query(give_colours(source_mags[sources][:, band_mask]), k=1)
+        distance[sources] = dist / np.sqrt(band_mask.sum() - 1)
+        closest[sources] = temp_rows[index]
+    result = pd.DataFrame({"IDENT": df["IDENT"], "num_bands": available.sum(axis=1),
+                           "distance": distance})
+    has_closest = closest >= 0
+    for col, newcol in [("model", "closest_model"), ("E(B-V)", "closest_ebv"),
+                        ("ZSPEC", "closest_z")]:
+        values = np.full(len(df), np.nan)
+        values[has_closest] = temp_df[col].to_numpy(dtype=float)[closest[has_closest]]
+        result[newcol] = values
+    result["IsFlagged"] = result["distance"] > threshold
+    profiling.record_rows(len(result))
+    return result
+
+
+def write_triage_file(result, ttype):
+    """Writes the IDs and distances of the flagged sources into the triage file of ttype."""
+    fpath = give_triage_fpath(ttype)
+    flagged = result[result["IsFlagged"]]
+    with open(fpath, "w", encoding="utf-8") as f:
+        f.write("# IDENT distance closest_model closest_z\n")
+        for row in flagged.itertuples(index=False):
+            f.write(f"{row.IDENT} {row.distance:.4f} {row.closest_model:.0f} {row.closest_z:.3f}\n")
+    untriaged = result["distance"].isnull().sum()
+    mt.LOGGER.info("Flagged %d of %d %s sources as outside of the template coverage "
+                   "(%d with too few bands to be checked), see '%s'.",
+                   len(flagged), len(result), ttype, untriaged, fpath)
+
+
+def run_ttype_triage(ttype, threshold):
+    """Runs the triage for ttype and writes its triage file."""
+    write_triage_file(triage_sources(ttype, threshold), ttype)
+
+
+def run_triage(threshold):
+    """Runs the triage for all used ttypes and writes the triage files."""
+    for ttype in mt.USED_TTYPES:
+        try:
+            run_ttype_triage(ttype, threshold)
+        except FileNotFoundError as e:
+            mt.LOGGER.warning("Skipping the triage for %s (%s).", ttype, e)